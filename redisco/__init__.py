@@ -1,4 +1,16 @@
 # -*- coding: utf-8 -*-
+import os
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+from . import cluster
+from .pipelining import AutoPipeline, Batch, LazyResult, PendingResult, \
+        resolve
+from .policy import Policy, CircuitOpenError
+from .instrumentation import Instrumentation, InstrumentedClient
+
 default_connection_settings = {}
 try:
     import redislite as redis
@@ -11,15 +23,331 @@ except ImportError:
     }
 
 
+class _State(object):
+    pool = None
+    connection = None
+    replicas = None
+    next_replica = 0
+    latencies = None
+    probed = 0
+
+
+class _LocalState(threading.local):
+    pool = None
+    connection = None
+    replicas = None
+    next_replica = 0
+    latencies = None
+    probed = 0
+
+
 class Client(object):
+    """
+    Holds the connection settings and the connection pool shared by every
+    model and container.
+
+    Besides the arguments of ``redis.Redis`` (``socket_keepalive``,
+    ``health_check_interval``...) which are given to every connection, the
+    settings accept the options of the pool:
+
+    ``max_connections``
+        the number of connections the pool opens at most.
+    ``blocking``
+        when True, a ``BlockingConnectionPool`` makes the threads wait for
+        a free connection instead of raising when ``max_connections`` are
+        in use.
+    ``pool_timeout``
+        how many seconds a blocking pool waits before raising.
+    ``thread_local``
+        when True, each thread gets its own client and pool.
+    ``replicas``
+        a list of dicts overriding the settings (``host``, ``port``...)
+        for each replica the queries can read from.
+    ``replica_selection``
+        ``'round_robin'`` (the default) to use the replicas in turn, or
+        ``'latency'`` to use the one answering ``PING`` the fastest.
+    ``policy``
+        a ``redisco.Policy`` setting the timeouts, the retries of the
+        reads and the circuit breaker of the commands (see
+        ``redisco.policy``).
+    ``cluster``
+        when True, connects to a Redis Cluster through ``host`` and
+        ``port`` or ``startup_nodes``, and the keys of the models are
+        hash-tagged (see ``redisco.cluster``).
+
+    A process forked after the pool was created does not reuse the
+    connections of its parent: it creates its own pool on first use.
+
+    The clients report their commands to the listeners of
+    ``instrumentation`` (see ``redisco.instrumentation``).
+    """
+    POOL_OPTIONS = ('max_connections', 'blocking', 'pool_timeout',
+                    'thread_local', 'replicas', 'replica_selection',
+                    'policy')
+    BLOCKING_MAX_CONNECTIONS = 50
+    # Seconds between two measures of the latency of the replicas.
+    REPLICA_PROBE_INTERVAL = 10
+    # Weight of the last measure in the average latency of a replica.
+    REPLICA_LATENCY_WEIGHT = 0.3
+
     def __init__(self, **kwargs):
-        self.connection_settings = kwargs or default_connection_settings
+        self.connection_settings = kwargs or dict(default_connection_settings)
+        self.instrumentation = Instrumentation()
+        self._reset()
+
+    def _reset(self):
+        if getattr(self, '_pid', None) != os.getpid():
+            # the circuit breakers outlive disconnect and update, so an
+            # open circuit stays open, but not a fork
+            self._breakers = {}
+        self._pid = os.getpid()
+        self._shared = _State()
+        self._local = _LocalState()
+        self._pools = weakref.WeakSet()
+        self._scopes = threading.local()
+
+    def _state(self):
+        if self._pid != os.getpid():
+            # The sockets of the pools are shared with the parent process,
+            # they are dropped without being closed.
+            self._reset()
+        if self.connection_settings.get('thread_local'):
+            return self._local
+        return self._shared
+
+    @property
+    def pool(self):
+        return self._state().pool
 
     def redis(self):
-        return redis.Redis(**self.connection_settings)
+        if self.connection_settings.get('cluster'):
+            # the cluster client keeps a pool per node
+            return cluster.create_client(self.connection_settings)
+        if not hasattr(redis, 'ConnectionPool'):
+            # redislite runs its own server and manages its connections.
+            return redis.Redis(**self.connection_settings)
+        return self._client(self.connection_pool(), 'primary')
+
+    def _client(self, pool, server):
+        """
+        Returns a client of ``pool`` sending its commands according to the
+        ``policy`` of the settings, if any, and reporting them to the
+        listeners. The clients of a server share its circuit breaker.
+        """
+        policy = self.connection_settings.get('policy')
+        breaker = None
+        if policy is not None:
+            if server not in self._breakers:
+                self._breakers[server] = policy.circuit_breaker()
+            breaker = self._breakers[server]
+        return InstrumentedClient(policy, breaker, self.instrumentation,
+                                  connection_pool=pool)
+
+    def connection(self):
+        """
+        Returns the client of the process, or of the thread when
+        ``thread_local`` is set, and creates it on first use.
+        """
+        state = self._state()
+        autopipeline = getattr(self._scopes, 'autopipeline', None)
+        if autopipeline is not None:
+            return autopipeline
+        if state.connection is None:
+            state.connection = self.redis()
+        return state.connection
+
+    @contextmanager
+    def autopipeline(self):
+        """
+        Within the block, ``connection`` returns an AutoPipeline of the
+        current thread which is flushed on exit.
+        """
+        current = getattr(self._scopes, 'autopipeline', None)
+        if current is not None:
+            yield current
+            return
+        pipeline = AutoPipeline(self.connection())
+        self._scopes.autopipeline = pipeline
+        try:
+            yield pipeline
+        finally:
+            self._scopes.autopipeline = None
+            pipeline.close()
+
+    @contextmanager
+    def batch(self):
+        """
+        Within the block, the containers and the writes of the models use
+        a Batch of the current thread. Its transaction is executed on exit,
+        or discarded if the block raises.
+        """
+        current = self.current_batch()
+        if current is not None:
+            yield current
+            return
+        batch = Batch(self.connection())
+        self._scopes.batch = batch
+        try:
+            yield batch
+        except:
+            batch.discard()
+            raise
+        finally:
+            self._scopes.batch = None
+        batch.close()
+
+    def current_batch(self):
+        """Returns the Batch of the current thread, if any."""
+        self._state()
+        return getattr(self._scopes, 'batch', None)
+
+    def read_connection(self):
+        """
+        Returns the client the queries read from: a replica when some are
+        configured, the client of ``connection`` otherwise or within an
+        ``autopipeline`` or a ``batch``.
+        """
+        if (getattr(self._scopes, 'autopipeline', None) is not None or
+                getattr(self._scopes, 'batch', None) is not None):
+            return self.connection()
+        replica = self.replica_connection()
+        if replica is None:
+            return self.connection()
+        return replica
+
+    def replica_connection(self):
+        """
+        Returns the client of a replica picked according to
+        ``replica_selection``, None when there is no replica.
+        """
+        replicas = self.connection_settings.get('replicas')
+        if not replicas or not hasattr(redis, 'ConnectionPool'):
+            return None
+        state = self._state()
+        if state.replicas is None:
+            state.replicas = []
+            for i, settings in enumerate(replicas):
+                pool = self._create_pool(settings)
+                self._pools.add(pool)
+                state.replicas.append(self._client(pool, i))
+        if self.connection_settings.get('replica_selection') == 'latency':
+            latencies = self._replica_latencies(state)
+            return state.replicas[latencies.index(min(latencies))]
+        replica = state.replicas[state.next_replica % len(state.replicas)]
+        state.next_replica += 1
+        return replica
+
+    def _replica_latencies(self, state):
+        """
+        Returns the average latency of each replica, measured with PING
+        every ``REPLICA_PROBE_INTERVAL`` seconds by a thread of its own so
+        that the queries never wait for the probe. A replica that does not
+        answer is not picked until it does.
+        """
+        if state.latencies is None:
+            state.latencies = [None] * len(state.replicas)
+        now = time.time()
+        if now - state.probed >= self.REPLICA_PROBE_INTERVAL:
+            state.probed = now
+            # the list is updated in place, the state may be thread local
+            probe = threading.Thread(target=self._probe_replicas,
+                                     args=(state.replicas, state.latencies))
+            probe.daemon = True
+            probe.start()
+        # the replicas not measured yet are tried first
+        return [0 if l is None else l for l in state.latencies]
+
+    def _probe_replicas(self, replicas, latencies):
+        weight = self.REPLICA_LATENCY_WEIGHT
+        for i, replica in enumerate(replicas):
+            start = time.time()
+            try:
+                replica.ping()
+            except redis.RedisError:
+                latencies[i] = float('inf')
+                continue
+            elapsed = time.time() - start
+            if latencies[i] is None or latencies[i] == float('inf'):
+                latencies[i] = elapsed
+            else:
+                latencies[i] = weight * elapsed + (1 - weight) * latencies[i]
+
+    def connection_pool(self):
+        state = self._state()
+        if state.pool is None:
+            state.pool = self._create_pool()
+            self._pools.add(state.pool)
+        return state.pool
+
+    def _create_pool(self, overrides=None):
+        settings = dict(self.connection_settings)
+        settings.update(overrides or {})
+        options = dict((k, settings.pop(k)) for k in self.POOL_OPTIONS
+                       if k in settings)
+        if 'unix_socket_path' in settings:
+            settings['path'] = settings.pop('unix_socket_path')
+            settings['connection_class'] = redis.UnixDomainSocketConnection
+        if options.get('blocking'):
+            return redis.BlockingConnectionPool(
+                max_connections=(options.get('max_connections') or
+                                 self.BLOCKING_MAX_CONNECTIONS),
+                timeout=options.get('pool_timeout', 20),
+                **settings)
+        return redis.ConnectionPool(
+            max_connections=options.get('max_connections'), **settings)
 
     def update(self, d):
+        if ('policy' in d and
+                d['policy'] is not self.connection_settings.get('policy')):
+            self._breakers = {}
         self.connection_settings.update(d)
+        self.disconnect()
+
+    def disconnect(self):
+        """
+        Closes the connections of the pools of every thread, new ones are
+        created on use.
+        """
+        if self._pid == os.getpid():
+            for pool in list(self._pools):
+                pool.disconnect()
+        self._reset()
+
+    def pool_stats(self):
+        """
+        Returns a dict with the ``max_connections`` of the pool and the
+        number of connections ``created``, ``in_use`` and ``available``,
+        or None when there is no pool.
+
+        redis-py has no public API for these numbers: they are read from
+        the attributes of its pools, which are the same from 2.7 to 3.x.
+        The counts a custom or later pool does not have are None.
+        """
+        pool = self.pool
+        if pool is None:
+            return None
+        created = available = None
+        if isinstance(pool, redis.BlockingConnectionPool):
+            connections = getattr(pool, '_connections', None)
+            queue = getattr(getattr(pool, 'pool', None), 'queue', None)
+            if connections is not None:
+                created = len(connections)
+            if queue is not None:
+                available = len([c for c in list(queue) if c is not None])
+        else:
+            created = getattr(pool, '_created_connections', None)
+            connections = getattr(pool, '_available_connections', None)
+            if connections is not None:
+                available = len(connections)
+        in_use = None
+        if created is not None and available is not None:
+            in_use = created - available
+        return {
+            'max_connections': getattr(pool, 'max_connections', None),
+            'created': created,
+            'in_use': in_use,
+            'available': available,
+        }
 
 
 def connection_setup(**kwargs):
@@ -28,16 +356,84 @@ def connection_setup(**kwargs):
         client.update(kwargs)
     else:
         client = Client(**kwargs)
-    connection = client.redis()
+    connection = client.connection()
 
 
 def get_client():
-    global connection
-    return connection
+    return client.connection()
+
+
+def get_read_client():
+    """
+    Returns the client the queries read from, a replica if some are
+    configured.
+    """
+    return client.read_connection()
+
+
+def autopipeline():
+    """
+    Buffers the write commands issued within the block and sends them in
+    one pipeline, together with the next read or when a result is used::
+
+        with redisco.autopipeline():
+            for key in keys:
+                redisco.get_client().incr(key)
+    """
+    return client.autopipeline()
+
+
+def batch():
+    """
+    Queues the writes of the models and the commands of the containers
+    issued within the block in one transaction executed at the end of
+    the block. The results of the commands can be used after that::
+
+        with redisco.batch():
+            for user in users:
+                user.incr('visits')
+                Set('active').add(user.id)
+    """
+    return client.batch()
+
+
+def current_batch():
+    return client.current_batch()
+
+
+def pool_stats():
+    """Returns the statistics of the connection pool of the global client."""
+    return client.pool_stats()
+
+
+def add_listener(listener):
+    """
+    Reports the commands sent by the global client to ``listener``, a
+    ``redisco.instrumentation.CommandListener``.
+    """
+    client.instrumentation.add_listener(listener)
+
+
+def remove_listener(listener):
+    client.instrumentation.remove_listener(listener)
+
+
+def record():
+    """
+    Collects the commands the current thread sends within the block::
+
+        with redisco.record() as recorder:
+            Person.objects.filter(name="Einstein").first()
+        recorder.round_trips, recorder.commands, recorder.reply_bytes
+    """
+    return client.instrumentation.record()
 
 
 client = Client()
-connection = client.redis()
+connection = client.connection()
 default_expire_time = 60
 
-__all__ = ['connection_setup', 'get_client']
+__all__ = ['connection_setup', 'get_client', 'get_read_client',
+           'pool_stats', 'autopipeline',
+           'batch', 'resolve', 'LazyResult', 'PendingResult', 'Policy',
+           'CircuitOpenError', 'add_listener', 'remove_listener', 'record']
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+Redis Cluster support: key slots, hash-tagged keys and the cluster client.
+
+On a cluster, a command (or a Lua script) can only use keys of the same
+slot. A hash tag, the part of a key between the first ``{`` and the next
+``}``, decides the slot alone, so the keys of a model built from
+``{Model}`` all land in the slot of ``Model``.
+"""
+
+import inspect
+
+__all__ = ['CrossSlotError', 'key_slot', 'hash_tagged', 'check_slot',
+           'create_client', 'is_cluster', 'LegacyCommands']
+
+SLOTS = 16384
+
+
+class CrossSlotError(Exception):
+    """Raised when the keys of a multi-key command are in several slots."""
+
+
+def _crc16_table():
+    table = []
+    for byte in xrange(256):
+        crc = byte << 8
+        for _ in xrange(8):
+            if crc & 0x8000:
+                crc = (crc << 1) ^ 0x1021
+            else:
+                crc <<= 1
+        table.append(crc & 0xffff)
+    return table
+
+
+_CRC16_TABLE = _crc16_table()
+
+
+def crc16(data):
+    """CRC16-CCITT (XMODEM), the checksum Redis Cluster uses."""
+    crc = 0
+    for byte in bytearray(data):
+        crc = ((crc << 8) & 0xffff) ^ _CRC16_TABLE[((crc >> 8) ^ byte) & 0xff]
+    return crc
+
+
+def key_slot(key):
+    """Returns the slot of ``key``, following the hash tag if any."""
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    start = key.find('{')
+    if start > -1:
+        end = key.find('}', start + 1)
+        if end > start + 1:
+            key = key[start + 1:end]
+    return crc16(key) % SLOTS
+
+
+def hash_tagged(name, tag=True):
+    """
+    Returns the key prefix of a model named ``name``: ``{name}`` when
+    ``tag`` is True, ``{tag}:name`` when it is a string, for instance to
+    gather the models of a tenant in one slot, and ``name`` otherwise.
+    """
+    if tag is True:
+        return u"{%s}" % name
+    if tag:
+        return u"{%s}:%s" % (tag, name)
+    return name
+
+
+def check_slot(*keys):
+    """
+    Raises CrossSlotError if the cluster mode is on and ``keys`` are not
+    all in the same slot.
+    """
+    import redisco
+    if not redisco.client.connection_settings.get('cluster'):
+        return
+    slots = set(key_slot(k) for k in keys)
+    if len(slots) > 1:
+        raise CrossSlotError("Keys %s are in different slots." %
+                             ", ".join(keys))
+
+
+def _cluster_classes():
+    classes = []
+    try:
+        from redis.cluster import RedisCluster
+        classes.append(RedisCluster)
+    except ImportError:
+        pass
+    try:
+        from rediscluster import RedisCluster
+        classes.append(RedisCluster)
+    except ImportError:
+        pass
+    return classes
+
+
+def is_cluster(db):
+    """Tells if ``db`` is a Redis Cluster client."""
+    return any(isinstance(db, c) for c in _cluster_classes())
+
+
+class LegacyCommands(object):
+    """
+    Mixin giving a cluster client the argument order of the commands of
+    redis.Redis that redisco uses: ``zadd(name, member, score, ...)``,
+    ``zincrby(name, member, amount)``, ``lrem(name, value, num)`` and
+    ``setex(name, value, time)``. The arguments are only reordered for the
+    commands the client takes in another order, which ``_legacy_class``
+    reads from their signatures: redis-py-cluster 1.x already follows
+    redis.Redis, redis-py 2 StrictRedis swaps the arguments and redis-py 3
+    and later take a mapping for ``zadd``.
+    """
+    _zadd_mapping = False
+    _zadd_legacy = False
+    _zincrby_strict = False
+    _lrem_legacy = False
+    _setex_legacy = False
+
+    def zadd(self, name, *args, **kwargs):
+        if self._zadd_legacy:
+            return super(LegacyCommands, self).zadd(name, *args, **kwargs)
+        pairs = zip(args[::2], args[1::2]) + kwargs.items()
+        if self._zadd_mapping:
+            return super(LegacyCommands, self).zadd(name, dict(pairs))
+        scores = []
+        for member, score in pairs:
+            scores.extend((score, member))
+        return super(LegacyCommands, self).zadd(name, *scores)
+
+    def zincrby(self, name, value, amount=1):
+        if self._zincrby_strict:
+            return super(LegacyCommands, self).zincrby(name, amount, value)
+        return super(LegacyCommands, self).zincrby(name, value, amount)
+
+    def lrem(self, name, value, num=0):
+        if self._lrem_legacy:
+            return super(LegacyCommands, self).lrem(name, value, num)
+        return super(LegacyCommands, self).lrem(name, num, value)
+
+    def setex(self, name, value, time):
+        if self._setex_legacy:
+            return super(LegacyCommands, self).setex(name, value, time)
+        return super(LegacyCommands, self).setex(name, time, value)
+
+
+_legacy_classes = {}
+
+
+def _argument_names(method):
+    """Returns the names of the arguments of ``method`` after ``self``."""
+    return inspect.getargspec(method)[0][1:]
+
+
+def _legacy_class(base):
+    """Subclass of the client or pipeline class ``base`` with LegacyCommands."""
+    if base not in _legacy_classes:
+        names = dict((c, _argument_names(getattr(base, c)))
+                     for c in ('zadd', 'zincrby', 'lrem', 'setex'))
+        lrem_legacy = names['lrem'][1:2] == ['value']
+        mapping = 'mapping' in names['zadd']
+        _legacy_classes[base] = type(base.__name__, (LegacyCommands, base), {
+            '_zadd_mapping': mapping,
+            # zadd takes *args in both orders, the classes following
+            # redis.Redis override it together with lrem
+            '_zadd_legacy': not mapping and lrem_legacy,
+            '_zincrby_strict': names['zincrby'][1:2] == ['amount'],
+            '_lrem_legacy': lrem_legacy,
+            '_setex_legacy': names['setex'][1:2] == ['value'],
+        })
+    return _legacy_classes[base]
+
+
+_client_classes = {}
+
+
+def _client_class(base):
+    """
+    Subclass of the RedisCluster class ``base`` taking the arguments of
+    redis.Redis, its ``pipeline`` included. The pipelines of a cluster
+    are never transactions.
+    """
+    if base not in _client_classes:
+        class ClusterClient(_legacy_class(base)):
+            def pipeline(self, transaction=None, shard_hint=None):
+                pipe = super(ClusterClient, self).pipeline()
+                # the pipelines are created by the client, their class is
+                # swapped for one with the same arguments
+                pipe.__class__ = _legacy_class(pipe.__class__)
+                return pipe
+        _client_classes[base] = ClusterClient
+    return _client_classes[base]
+
+
+def create_client(settings):
+    """
+    Returns a cluster client from the connection settings: ``host`` and
+    ``port`` of one node or ``startup_nodes``, a list of dicts with the
+    ``host`` and ``port`` of several, and the options of the client.
+    Uses redis-py (4.1 and later) or redis-py-cluster.
+    """
+    classes = _cluster_classes()
+    if not classes:
+        raise ImportError("The cluster mode needs redis-py 4.1 or later, "
+                          "or redis-py-cluster.")
+    from redisco import Client
+    settings = dict((k, v) for k, v in settings.iteritems()
+                    if k not in Client.POOL_OPTIONS and
+                    k not in ('cluster', 'db'))
+    cls = classes[0]
+    nodes = settings.pop('startup_nodes', None)
+    if nodes:
+        if cls.__module__.startswith('redis.'):
+            # redis-py takes ClusterNode objects
+            from redis.cluster import ClusterNode
+            nodes = [ClusterNode(n['host'], n['port']) for n in nodes]
+        settings['startup_nodes'] = nodes
+    return _client_class(cls)(**settings)
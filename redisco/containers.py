@@ -4,6 +4,8 @@
 import collections
 from functools import partial
 from . import default_expire_time
+from .pipelining import resolve
+from .cluster import check_slot
 
 
 def _parse_values(values):
@@ -69,12 +71,11 @@ class Container(object):
             return self.pipeline
         if self._db is not None:
             return self._db
-        if hasattr(self, 'db_cache') and self.db_cache:
-            return self.db_cache
-        else:
-            from redisco import connection
-            self.db_cache = connection
-            return self.db_cache
+        from redisco import get_client, current_batch
+        batch = current_batch()
+        if batch is not None:
+            return batch
+        return get_client()
 
 
 class Set(Container):
@@ -268,7 +269,9 @@ class Set(Container):
             raise ValueError("Expect a (unicode) string as key")
         key = unicode(key)
 
-        self.db.sunionstore(key, [self.key] + [o.key for o in other_sets])
+        keys = [self.key] + [o.key for o in other_sets]
+        check_slot(key, *keys)
+        self.db.sunionstore(key, keys)
         return Set(key)
 
     def intersection(self, key, *other_sets):
@@ -300,7 +303,9 @@ class Set(Container):
             raise ValueError("Expect a (unicode) string as key")
         key = unicode(key)
 
-        self.db.sinterstore(key, [self.key] + [o.key for o in other_sets])
+        keys = [self.key] + [o.key for o in other_sets]
+        check_slot(key, *keys)
+        self.db.sinterstore(key, keys)
         return Set(key)
 
     def difference(self, key, *other_sets):
@@ -331,7 +336,9 @@ class Set(Container):
             raise ValueError("Expect a (unicode) string as key")
         key = unicode(key)
 
-        self.db.sdiffstore(key, [self.key] + [o.key for o in other_sets])
+        keys = [self.key] + [o.key for o in other_sets]
+        check_slot(key, *keys)
+        self.db.sdiffstore(key, keys)
         return Set(key)
 
     def update(self, *other_sets):
@@ -340,9 +347,12 @@ class Set(Container):
         :param other_sets: list of ``Set``
         :rtype: None
         """
-        self.db.sunionstore(self.key, [self.key] + [o.key for o in other_sets])
+        keys = [self.key] + [o.key for o in other_sets]
+        check_slot(*keys)
+        self.db.sunionstore(self.key, keys)
 
     def __ior__(self, other_set):
+        check_slot(self.key, other_set.key)
         self.db.sunionstore(self.key, [self.key, other_set.key])
         return self
 
@@ -353,9 +363,11 @@ class Set(Container):
         :param other_sets: list of ``Set``
         :rtype: None
         """
+        check_slot(self.key, *[o.key for o in other_sets])
         self.db.sinterstore(self.key, [o.key for o in [self.key] + other_sets])
 
     def __iand__(self, other_set):
+        check_slot(self.key, other_set.key)
         self.db.sinterstore(self.key, [self.key, other_set.key])
         return self
 
@@ -366,9 +378,11 @@ class Set(Container):
         :param other_sets: list of ``Set``
         :rtype: None
         """
+        check_slot(self.key, *[o.key for o in other_sets])
         self.db.sdiffstore(self.key, [o.key for o in [self.key] + other_sets])
 
     def __isub__(self, other_set):
+        check_slot(self.key, other_set.key)
         self.db.sdiffstore(self.key, [self.key, other_set.key])
         return self
 
@@ -402,7 +416,9 @@ class Set(Container):
         .. NOTE::
             This function return an actual ``set`` object (from python) and not a ``Set``. See func:``intersection``.
         """
-        return self.db.sinter([self.key] + [s.key for s in other_sets])
+        keys = [self.key] + [s.key for s in other_sets]
+        check_slot(*keys)
+        return self.db.sinter(keys)
 
     def sunion(self, *other_sets):
         """
@@ -411,7 +427,9 @@ class Set(Container):
         .. NOTE::
             This function return an actual ``set`` object (from python) and not a ``Set``.
         """
-        return self.db.sunion([self.key] + [s.key for s in other_sets])
+        keys = [self.key] + [s.key for s in other_sets]
+        check_slot(*keys)
+        return self.db.sunion(keys)
 
     def sdiff(self, *other_sets):
         """
@@ -422,7 +440,9 @@ class Set(Container):
             See function difference.
 
         """
-        return self.db.sdiff([self.key] + [s.key for s in other_sets])
+        keys = [self.key] + [s.key for s in other_sets]
+        check_slot(*keys)
+        return self.db.sdiff(keys)
 
     def scard(self):
         """
@@ -599,6 +619,7 @@ class List(Container):
         >>> l2.clear()
 
         """
+        check_slot(self.key, key)
         return self.db.rpoplpush(self.key, key)
 
     def lrem(self, value, num=1):
@@ -723,13 +744,14 @@ class TypedList(object):
 
     def typecast_item(self, value):
         if self._redisco_model:
-            return self.klass.objects.get_by_id(value)
+            return resolve(self.klass.objects.get_by_id(value))
         else:
             return self.klass(value, *self._klass_args, **self._klass_kwargs)
 
     def typecast_iter(self, values):
         if self._redisco_model:
-            return filter(lambda o: o is not None, [self.klass.objects.get_by_id(v) for v in values])
+            return filter(lambda o: o is not None,
+                          map(resolve, [self.klass.objects.get_by_id(v) for v in values]))
         else:
             return [self.klass(v, *self._klass_args, **self._klass_kwargs) for v in values]
 
@@ -1,6 +1,7 @@
 import unittest
 import redisco
 from redisco import containers as cont
+from redisco import instrumentation
 
 
 class SetTestCase(unittest.TestCase):
@@ -468,6 +469,235 @@ class HashTestCase(unittest.TestCase):
         h.hmset({'Blue': 100, 'Green': 19, 'Yellow': 1024})
         self.assertEqual(['100', '19'], h.hmget(['Blue', 'Green']))
 
+class ConnectionPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        settings = redisco.client.connection_settings
+        self.settings = dict((k, settings[k]) for k in ('host', 'port', 'db')
+                             if k in settings)
+
+    def test_shared_pool(self):
+        client = redisco.Client(max_connections=2, **self.settings)
+        self.assertEqual(None, client.pool_stats())
+        r1, r2 = client.redis(), client.redis()
+        self.assertTrue(r1.connection_pool is r2.connection_pool)
+        r1.ping()
+        r2.ping()
+        self.assertEqual({'max_connections': 2, 'created': 1,
+                          'in_use': 0, 'available': 1}, client.pool_stats())
+        client.update({'max_connections': 3})
+        self.assertEqual(None, client.pool_stats())
+        self.assertEqual(3, client.redis().connection_pool.max_connections)
+        client.disconnect()
+
+    def test_blocking_pool(self):
+        client = redisco.Client(blocking=True, max_connections=2,
+                                pool_timeout=1, **self.settings)
+        pool = client.connection_pool()
+        conn = pool.get_connection('PING')
+        self.assertEqual({'max_connections': 2, 'created': 1,
+                          'in_use': 1, 'available': 0}, client.pool_stats())
+        pool.release(conn)
+        self.assertEqual({'max_connections': 2, 'created': 1,
+                          'in_use': 0, 'available': 1}, client.pool_stats())
+        client.disconnect()
+
+    def test_fork(self):
+        import os
+        client = redisco.Client(**self.settings)
+        parent = client.connection()
+        parent.ping()
+        pid = os.fork()
+        if pid == 0:
+            child = client.connection()
+            ok = (child is not parent and
+                  child.connection_pool is not parent.connection_pool and
+                  child.ping())
+            os._exit(0 if ok else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(0, status)
+        self.assertTrue(client.connection() is parent)
+        self.assertEqual(1, client.pool_stats()['available'])
+        client.disconnect()
+
+    def test_thread_local(self):
+        import threading
+        client = redisco.Client(thread_local=True, **self.settings)
+        clients = []
+        def run():
+            clients.append(client.connection())
+            clients.append(client.connection())
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        self.assertTrue(clients[0] is clients[1])
+        self.assertTrue(client.connection() is not clients[0])
+        self.assertTrue(client.connection().connection_pool is not
+                        clients[0].connection_pool)
+        client.disconnect()
+
+    def test_containers_follow_connection_setup(self):
+        s = cont.Set('pooled')
+        self.assertTrue(s.db is redisco.get_client())
+        redisco.connection_setup()
+        self.assertTrue(s.db is redisco.get_client())
+
+
+class PolicyTestCase(unittest.TestCase):
+    def setUp(self):
+        settings = redisco.client.connection_settings
+        self.settings = dict((k, settings[k]) for k in ('host', 'port', 'db')
+                             if k in settings)
+        self.policy = redisco.Policy(timeout=2, timeouts={'blpop': None},
+                                     retries=2, backoff=0,
+                                     failure_threshold=3, reset_timeout=60)
+
+    def test_timeouts(self):
+        self.assertEqual(2, self.policy.timeout_of(['GET', 'SET']))
+        self.assertEqual(None, self.policy.timeout_of(['GET', 'BLPOP']))
+
+    def test_retries(self):
+        from redis.exceptions import ConnectionError
+        calls = []
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise ConnectionError("down")
+            return "ok"
+        self.assertEqual("ok", self.policy.run(['GET'], flaky))
+        self.assertEqual(3, len(calls))
+        del calls[:]
+        self.assertRaises(ConnectionError, self.policy.run, ['SET'], flaky)
+        self.assertEqual(1, len(calls))
+
+    def test_circuit_breaker(self):
+        from redis.exceptions import ConnectionError
+        calls = []
+        def down():
+            calls.append(1)
+            raise ConnectionError("down")
+        breaker = self.policy.circuit_breaker()
+        self.assertRaises(ConnectionError, self.policy.run, ['GET'], down,
+                          breaker)
+        self.assertEqual(3, len(calls))
+        self.assertTrue(breaker.is_open)
+        self.assertRaises(redisco.CircuitOpenError, self.policy.run, ['GET'],
+                          down, breaker)
+        self.assertEqual(3, len(calls))
+        breaker.reset_timeout = 0
+        self.assertEqual("ok", self.policy.run(['GET'], lambda: "ok", breaker))
+        self.assertFalse(breaker.is_open)
+
+    def test_client(self):
+        from redisco.policy import PolicyClient
+        client = redisco.Client(policy=self.policy, **self.settings)
+        db = client.connection()
+        self.assertTrue(isinstance(db, PolicyClient))
+        db.set('policy', 1)
+        self.assertEqual('1', db.get('policy'))
+        # the timeout of the command is only set while it runs
+        connection = client.pool.get_connection('GET')
+        self.assertEqual(None, connection.socket_timeout)
+        client.pool.release(connection)
+        pipe = db.pipeline()
+        pipe.incr('policy')
+        pipe.get('policy')
+        self.assertEqual([2, '2'], pipe.execute())
+        self.assertEqual(None, db.blpop('nothing', 1))
+        db.delete('policy')
+        client.disconnect()
+
+    def test_breakers_survive_update(self):
+        client = redisco.Client(policy=self.policy, **self.settings)
+        client.connection()
+        breaker = client._breakers['primary']
+        client.update({'max_connections': 5})
+        client.connection()
+        self.assertTrue(client._breakers['primary'] is breaker)
+        client.update({'policy': redisco.Policy()})
+        client.connection()
+        self.assertFalse(client._breakers['primary'] is breaker)
+        client.disconnect()
+
+
+class InstrumentationTestCase(unittest.TestCase):
+    def setUp(self):
+        settings = redisco.client.connection_settings
+        self.settings = dict((k, settings[k]) for k in ('host', 'port', 'db')
+                             if k in settings)
+        # the registry of the model keys is global
+        self.model_keys = set(instrumentation._model_keys)
+
+    def tearDown(self):
+        instrumentation._model_keys.clear()
+        instrumentation._model_keys.update(self.model_keys)
+
+    def test_key_pattern(self):
+        self.assertEqual(u'Person:*:friends',
+                         instrumentation.key_pattern('Person:12:friends'))
+        self.assertEqual(u'~*', instrumentation.key_pattern('~Person:all+x.1'))
+        instrumentation.register_model_key(u'{acme}:Order')
+        self.assertEqual(u'{acme}:Order:status:*',
+                         instrumentation.key_pattern('{acme}:Order:status:open'))
+        self.assertEqual(u'{acme}:Order:*',
+                         instrumentation.key_pattern('{acme}:Order:7'))
+        self.assertEqual(u'{acme}:Order:all',
+                         instrumentation.key_pattern('{acme}:Order:all'))
+
+    def test_listeners(self):
+        class Span(object):
+            def __init__(self, name, attributes):
+                self.name, self.attributes = name, dict(attributes)
+                self.ended = False
+            def set_attribute(self, key, value):
+                self.attributes[key] = value
+            def record_exception(self, e):
+                self.attributes['error'] = e
+            def end(self):
+                self.ended = True
+
+        spans = []
+        class FakeTracer(object):
+            def start_span(self, name, attributes=None):
+                spans.append(Span(name, attributes))
+                return spans[-1]
+
+        client = redisco.Client(**self.settings)
+        metrics = instrumentation.Metrics()
+        client.instrumentation.add_listener(metrics)
+        client.instrumentation.add_listener(instrumentation.Tracer(FakeTracer()))
+        db = client.connection()
+        with client.instrumentation.record() as recorder:
+            db.set('instrumented:1', 'abc')
+            pipe = db.pipeline(transaction=False)
+            pipe.get('instrumented:1')
+            pipe.get('instrumented:2')
+            self.assertEqual(['abc', None], pipe.execute())
+        self.assertEqual(2, recorder.round_trips)
+        self.assertEqual(3, recorder.commands)
+        self.assertEqual(3, recorder.events[1].reply_size)
+        self.assertEqual(['SET', 'PIPELINE'], [e.name for e in recorder.events])
+        self.assertEqual([u'instrumented:*', u'instrumented:*'],
+                         recorder.events[1].key_patterns)
+
+        self.assertEqual(2, len(spans))
+        self.assertEqual("redis PIPELINE", spans[1].name)
+        self.assertEqual(2, spans[1].attributes['db.redis.pipeline_length'])
+        self.assertEqual(3, spans[1].attributes['db.redis.reply_size'])
+        self.assertTrue(all(span.ended for span in spans))
+
+        self.assertEqual(2, metrics.commands[('GET', u'instrumented:*')])
+        text = metrics.render()
+        self.assertTrue(u'redisco_commands_total{command="GET",'
+                        u'key_pattern="instrumented:*"} 2' in text)
+        self.assertTrue(u'redisco_pipeline_size_count 1' in text)
+        self.assertTrue(u'redisco_command_duration_seconds_count'
+                        u'{command="SET"} 1' in text)
+
+        client.instrumentation.remove_listener(metrics)
+        db.delete('instrumented:1')
+        self.assertEqual(1, metrics.commands[('SET', u'instrumented:*')])
+        client.disconnect()
+
 if __name__ == "__main__":
     import sys
     unittest.main(argv=sys.argv)
@@ -0,0 +1,428 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentation of the commands sent to Redis.
+
+The clients of redisco report each command, and each pipeline as a
+whole, to the listeners added with ``redisco.add_listener``: their
+``command_started`` and ``command_finished`` methods receive a
+CommandEvent with the name of the command, the patterns of its keys, its
+duration, the size of the pipeline and the sizes of the request and of
+the reply.
+
+Metrics counts the commands in Prometheus histograms and counters, Tracer
+opens a span for each of them with an OpenTelemetry tracer, and
+``redisco.record()`` collects the commands issued within a block, for
+instance by a query or a ``save``.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+from .policy import PolicyClient, PolicyPipeline
+
+__all__ = ['CommandEvent', 'CommandListener', 'Instrumentation', 'Metrics',
+           'Recorder', 'Tracer', 'InstrumentedClient', 'key_pattern',
+           'register_model_key']
+
+
+# Commands without any key.
+KEYLESS_COMMANDS = frozenset([
+    'CLIENT', 'CONFIG', 'DBSIZE', 'DISCARD', 'ECHO', 'EXEC', 'FLUSHALL',
+    'FLUSHDB', 'INFO', 'KEYS', 'MULTI', 'PING', 'PUBLISH', 'SCAN', 'SCRIPT',
+    'SELECT', 'TIME', 'UNWATCH',
+])
+
+# The keys of the models: their ids and the values of their indices are
+# replaced by * in the key patterns.
+_model_keys = set()
+
+
+def register_model_key(key):
+    """Records the key of a model, for ``key_pattern``."""
+    _model_keys.add(unicode(key))
+
+
+def key_pattern(key):
+    """
+    Returns the pattern of ``key``: the ids of the objects and the values
+    of the indices are replaced by ``*``, the temporary keys of the
+    queries are all ``~*`` and the results of their sorts ``<key>#*``.
+    The values of the indices are only recognized in the keys of the
+    models, ``Person:name:Einstein`` becoming ``Person:name:*``.
+
+    >>> key_pattern('Person:12:friends')
+    u'Person:*:friends'
+    """
+    if isinstance(key, str):
+        key = key.decode('utf-8', 'replace')
+    elif not isinstance(key, unicode):
+        return None
+    if key.startswith(u'~'):
+        return u'~*'
+    if u'#' in key:
+        return u'%s#*' % key_pattern(key.split(u'#', 1)[0])
+    parts = key.split(u':')
+    for i in xrange(len(parts) - 1, 0, -1):
+        model = u':'.join(parts[:i])
+        if model in _model_keys:
+            return u':'.join([model] + _model_key_rest(parts[i:]))
+    return u':'.join(u'*' if p.isdigit() else p for p in parts)
+
+
+def _model_key_rest(parts):
+    """
+    Returns the pattern of the segments of a key following the key of
+    its model.
+    """
+    if parts[0].isdigit():
+        # Model:<id>, Model:<id>:<list>...
+        return [u'*'] + parts[1:]
+    if parts[0] == u'_ft' and len(parts) > 2:
+        # Model:_ft:<attribute>:<token>
+        return parts[:2] + [u'*']
+    if parts[0] in (u'_lex', u'_values') or len(parts) == 1:
+        # Model:all, Model:id, Model:_values:<attribute>...
+        return parts
+    # Model:<attribute>:<value>
+    return parts[:1] + [u'*']
+
+
+def _size(value):
+    """Returns the number of bytes of a request or a reply, roughly."""
+    if value is None:
+        return 0
+    if isinstance(value, basestring):
+        return len(value)
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sum(_size(v) for v in value)
+    if isinstance(value, dict):
+        return sum(_size(k) + _size(v) for k, v in value.iteritems())
+    return len(str(value))
+
+
+def _first_key(args):
+    """Returns the first key of the arguments of a command, if any."""
+    name = args[0].upper()
+    if name in KEYLESS_COMMANDS or len(args) < 2:
+        return None
+    if name in ('EVAL', 'EVALSHA'):
+        # EVALSHA <sha> <numkeys> <key>...
+        return args[3] if len(args) > 3 and int(args[2]) else None
+    return args[1]
+
+
+class CommandEvent(object):
+    """
+    A command, or a pipeline named ``PIPELINE`` or ``MULTI`` for a
+    transaction, sent to Redis.
+
+    ``commands`` holds the names of its commands and ``key_patterns`` the
+    pattern of their first key. ``duration`` (in seconds), ``reply_size``
+    and ``error`` are set when it finishes. The listeners can keep their
+    state of the command in the ``data`` dict.
+    """
+    def __init__(self, name, commands):
+        self.name = name.upper()
+        self.commands = [args[0].upper() for args in commands]
+        self.key_patterns = [key_pattern(_first_key(args))
+                             for args in commands]
+        self.pipeline_size = len(commands)
+        self.request_size = sum(_size(args) for args in commands)
+        self.thread = threading.current_thread().ident
+        self.started = time.time()
+        self.duration = None
+        self.reply_size = None
+        self.error = None
+        self.data = {}
+
+    def __repr__(self):
+        return "<CommandEvent %s %s>" % (self.name, self.key_patterns)
+
+
+class CommandListener(object):
+    """Base class of the listeners, whose methods do nothing."""
+    def command_started(self, event):
+        pass
+
+    def command_finished(self, event):
+        pass
+
+
+class Instrumentation(object):
+    """
+    The listeners of a ``redisco.Client``, which its clients report their
+    commands to.
+    """
+    def __init__(self):
+        self.listeners = ()
+
+    def add_listener(self, listener):
+        self.listeners = self.listeners + (listener,)
+
+    def remove_listener(self, listener):
+        self.listeners = tuple(l for l in self.listeners if l is not listener)
+
+    @contextmanager
+    def record(self):
+        recorder = Recorder()
+        self.add_listener(recorder)
+        try:
+            yield recorder
+        finally:
+            self.remove_listener(recorder)
+
+    def run(self, name, commands, func):
+        """
+        Returns ``func()``, which sends ``commands`` (their arguments),
+        and reports it to the listeners.
+        """
+        listeners = self.listeners
+        if not listeners:
+            return func()
+        event = CommandEvent(name, commands)
+        for listener in listeners:
+            listener.command_started(event)
+        try:
+            result = func()
+        except Exception as e:
+            event.error = e
+            raise
+        else:
+            event.reply_size = _size(result)
+            return result
+        finally:
+            event.duration = time.time() - event.started
+            for listener in listeners:
+                listener.command_finished(event)
+
+
+class Recorder(CommandListener):
+    """
+    Collects the commands of a thread in ``events``. See
+    ``redisco.record``.
+    """
+    def __init__(self):
+        self.thread = threading.current_thread().ident
+        self.events = []
+
+    def command_finished(self, event):
+        if event.thread == self.thread:
+            self.events.append(event)
+
+    @property
+    def round_trips(self):
+        return len(self.events)
+
+    @property
+    def commands(self):
+        return sum(e.pipeline_size for e in self.events)
+
+    @property
+    def request_bytes(self):
+        return sum(e.request_size for e in self.events)
+
+    @property
+    def reply_bytes(self):
+        return sum(e.reply_size or 0 for e in self.events)
+
+    @property
+    def duration(self):
+        return sum(e.duration for e in self.events)
+
+
+class _Histogram(object):
+    """The buckets, sum and count of the observed values of a label set."""
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+def _labels(**labels):
+    return u"{%s}" % u",".join(
+        u'%s="%s"' % (k, unicode(v).replace(u'\\', u'\\\\')
+                      .replace(u'"', u'\\"').replace(u'\n', u'\\n'))
+        for k, v in sorted(labels.iteritems()))
+
+
+class Metrics(CommandListener):
+    """
+    Prometheus metrics of the commands:
+
+    ``<prefix>_commands_total{command, key_pattern}``
+        the commands sent, those of the pipelines included.
+    ``<prefix>_errors_total{command, error}``
+        the commands and pipelines which failed.
+    ``<prefix>_command_duration_seconds{command}``
+        histogram of the durations of the round trips (``PIPELINE`` and
+        ``MULTI`` for the pipelines).
+    ``<prefix>_pipeline_size``
+        histogram of the number of commands of the pipelines.
+    ``<prefix>_request_bytes_total{command}`` and
+    ``<prefix>_reply_bytes_total{command}``
+        the sizes of the requests and of the replies.
+
+    ``render`` returns them in the text format of Prometheus, for an
+    HTTP endpoint or the textfile collector.
+    """
+    DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                        0.1, 0.25, 0.5, 1.0, 2.5, float('inf'))
+    SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, float('inf'))
+
+    def __init__(self, prefix='redisco'):
+        self.prefix = prefix
+        self.commands = {}
+        self.errors = {}
+        self.durations = {}
+        self.pipeline_sizes = _Histogram(self.SIZE_BUCKETS)
+        self.request_bytes = {}
+        self.reply_bytes = {}
+        self._lock = threading.Lock()
+
+    def command_finished(self, event):
+        with self._lock:
+            for command, pattern in zip(event.commands, event.key_patterns):
+                key = (command, pattern)
+                self.commands[key] = self.commands.get(key, 0) + 1
+            if event.error is not None:
+                key = (event.name, event.error.__class__.__name__)
+                self.errors[key] = self.errors.get(key, 0) + 1
+            if event.name not in self.durations:
+                self.durations[event.name] = _Histogram(self.DURATION_BUCKETS)
+            self.durations[event.name].observe(event.duration)
+            if event.name in ('PIPELINE', 'MULTI'):
+                self.pipeline_sizes.observe(event.pipeline_size)
+            self.request_bytes[event.name] = \
+                    self.request_bytes.get(event.name, 0) + event.request_size
+            self.reply_bytes[event.name] = \
+                    self.reply_bytes.get(event.name, 0) + \
+                    (event.reply_size or 0)
+
+    def render(self):
+        """Returns the metrics in the text format of Prometheus."""
+        p = self.prefix
+        lines = []
+        with self._lock:
+            lines.append(u"# TYPE %s_commands_total counter" % p)
+            for (command, pattern), n in sorted(self.commands.iteritems()):
+                lines.append(u"%s_commands_total%s %d" % (
+                    p, _labels(command=command, key_pattern=pattern or u''),
+                    n))
+            lines.append(u"# TYPE %s_errors_total counter" % p)
+            for (command, error), n in sorted(self.errors.iteritems()):
+                lines.append(u"%s_errors_total%s %d" % (
+                    p, _labels(command=command, error=error), n))
+            lines.append(u"# TYPE %s_command_duration_seconds histogram" % p)
+            for command, h in sorted(self.durations.iteritems()):
+                lines.extend(self._histogram(
+                    u"%s_command_duration_seconds" % p, h, command=command))
+            lines.append(u"# TYPE %s_pipeline_size histogram" % p)
+            lines.extend(self._histogram(u"%s_pipeline_size" % p,
+                                         self.pipeline_sizes))
+            for name, totals in ((u'request_bytes', self.request_bytes),
+                                 (u'reply_bytes', self.reply_bytes)):
+                lines.append(u"# TYPE %s_%s_total counter" % (p, name))
+                for command, n in sorted(totals.iteritems()):
+                    lines.append(u"%s_%s_total%s %d" % (
+                        p, name, _labels(command=command), n))
+        return u"\n".join(lines) + u"\n"
+
+    def _histogram(self, name, h, **labels):
+        lines = []
+        cumulative = 0
+        for bound, n in zip(h.buckets, h.counts):
+            cumulative += n
+            le = u"+Inf" if bound == float('inf') else repr(bound)
+            lines.append(u"%s_bucket%s %d" % (name, _labels(le=le, **labels),
+                                              cumulative))
+        suffix = _labels(**labels) if labels else u''
+        lines.append(u"%s_sum%s %s" % (name, suffix, repr(float(h.sum))))
+        lines.append(u"%s_count%s %d" % (name, suffix, h.count))
+        return lines
+
+
+class Tracer(CommandListener):
+    """
+    Opens a span for each command or pipeline with ``tracer``, an
+    OpenTelemetry tracer or any object whose ``start_span(name,
+    attributes=...)`` returns a span with ``set_attribute``,
+    ``record_exception`` and ``end`` methods::
+
+        from opentelemetry import trace
+        redisco.add_listener(Tracer(trace.get_tracer('redisco')))
+    """
+    def __init__(self, tracer):
+        self.tracer = tracer
+
+    def command_started(self, event):
+        patterns = sorted(set(p for p in event.key_patterns if p))
+        event.data[self] = self.tracer.start_span(
+            u"redis %s" % event.name,
+            attributes={
+                'db.system': 'redis',
+                'db.operation': event.name,
+                'db.redis.commands': event.commands,
+                'db.redis.key_patterns': patterns,
+                'db.redis.pipeline_length': event.pipeline_size,
+                'db.redis.request_size': event.request_size,
+            })
+
+    def command_finished(self, event):
+        span = event.data.pop(self, None)
+        if span is None:
+            return
+        if event.error is not None:
+            span.record_exception(event.error)
+        else:
+            span.set_attribute('db.redis.reply_size', event.reply_size)
+        span.end()
+
+
+class InstrumentedPipeline(PolicyPipeline):
+    """A pipeline reporting its execution to an Instrumentation."""
+    instrumentation = None
+
+    def execute(self, raise_on_error=True):
+        if self.instrumentation is None or not self.command_stack:
+            return super(InstrumentedPipeline, self).execute(raise_on_error)
+        name = 'MULTI' if self.transaction else 'PIPELINE'
+        return self.instrumentation.run(
+            name, [args for args, options in self.command_stack],
+            lambda: super(InstrumentedPipeline, self).execute(raise_on_error))
+
+
+class InstrumentedClient(PolicyClient):
+    """
+    The client of ``redisco.Client``: it follows the Policy of the
+    settings, if any, and reports its commands to an Instrumentation.
+    """
+    pipeline_class = InstrumentedPipeline
+
+    def __init__(self, policy=None, breaker=None, instrumentation=None,
+                 **kwargs):
+        super(InstrumentedClient, self).__init__(policy, breaker, **kwargs)
+        self.instrumentation = instrumentation
+
+    def execute_command(self, *args, **options):
+        if self.instrumentation is None:
+            return super(InstrumentedClient, self).execute_command(*args,
+                                                                   **options)
+        return self.instrumentation.run(
+            args[0], [args],
+            lambda: super(InstrumentedClient, self).execute_command(
+                *args, **options))
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = super(InstrumentedClient, self).pipeline(transaction,
+                                                        shard_hint)
+        pipe.instrumentation = self.instrumentation
+        return pipe
@@ -1,9 +1,12 @@
 from .base import *
 from .attributes import *
 from .exceptions import *
+from .query import Q
+from .aggregates import *
 
 __all__ = ['Model', 'Attribute', 'BooleanField', 'IntegerField',
-        'Counter', 'FloatField', 'DateTimeField', 'DateField', 'TimeDeltaField',
+        'Counter', 'FloatField', 'GeoField', 'DateTimeField', 'DateField', 'TimeDeltaField',
         'ReferenceField', 'ListField', 'ValidationError', 'from_key',
         'ValidationError', 'MissingID', 'AttributeNotIndexed',
-        'FieldValidationError', 'BadKeyError']
+        'FieldValidationError', 'BadKeyError', 'Q', 'Count', 'Sum',
+        'Avg', 'Min', 'Max']
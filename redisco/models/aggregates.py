@@ -0,0 +1,55 @@
+"""
+Aggregations computed by Redis over the sorted set indices.
+"""
+
+__all__ = ['Count', 'Sum', 'Avg', 'Min', 'Max']
+
+
+class Aggregate(object):
+    """
+    Base class of the aggregations accepted by ``ModelSet.aggregate``.
+
+    The field should be a numeric (``ZINDEXABLE``) indexed attribute.
+    Subclasses pick their result from the statistics of the field which
+    is a dict with the ``count``, ``sum``, ``min`` and ``max`` keys.
+    """
+    def __init__(self, field):
+        self.field = field
+
+    def resolve(self, stats):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self.field)
+
+
+class Count(Aggregate):
+    """Number of objects having a value for the field."""
+    def resolve(self, stats):
+        return stats['count']
+
+
+class Sum(Aggregate):
+    """Sum of the values of the field."""
+    def resolve(self, stats):
+        return stats['sum']
+
+
+class Avg(Aggregate):
+    """Average of the values of the field, None if there is none."""
+    def resolve(self, stats):
+        if not stats['count']:
+            return None
+        return stats['sum'] / stats['count']
+
+
+class Min(Aggregate):
+    """Smallest value of the field, None if there is none."""
+    def resolve(self, stats):
+        return stats['min']
+
+
+class Max(Aggregate):
+    """Largest value of the field, None if there is none."""
+    def resolve(self, stats):
+        return stats['max']
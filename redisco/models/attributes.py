@@ -2,18 +2,20 @@
 """
 Defines the fields that can be added to redisco models.
 """
+import re
 import time
 import sys
 from datetime import datetime, date, timedelta
 from dateutil.tz import tzutc, tzlocal
 from calendar import timegm
 from redisco.containers import List
+from redisco.pipelining import pipelined, resolve
 from .exceptions import FieldValidationError, MissingID
 
 __all__ = ['Attribute', 'CharField', 'ListField', 'DateTimeField',
         'DateField', 'TimeDeltaField', 'ReferenceField', 'Collection',
         'IntegerField', 'FloatField', 'BooleanField', 'Counter',
-        'ZINDEXABLE']
+        'GeoField', 'ZINDEXABLE']
 
 
 class Attribute(object):
@@ -32,6 +34,17 @@ class Attribute(object):
         validator -- a callable that can validate the value of the
                      attribute.
         default   -- Initial value of the attribute.
+        lex_indexed -- Keep the values in a lexicographic index so the
+                     attribute can be queried with the startswith, lt,
+                     lte, gt and gte lookups and ordered without sorting
+                     the strings. Default: False.
+        fulltext  -- Keep an inverted index of the words of the value so
+                     that the objects can be found with ModelSet.search.
+                     Default: False.
+        bitmap    -- Index the attribute with one bitmap per value, a bit
+                     per id, instead of a set of ids. Meant for booleans
+                     and other attributes with few values on models with
+                     integer ids. Default: False.
 
     """
     def __init__(self,
@@ -40,13 +53,19 @@ class Attribute(object):
                  required=False,
                  validator=None,
                  unique=False,
-                 default=None):
+                 default=None,
+                 lex_indexed=False,
+                 fulltext=False,
+                 bitmap=False):
         self.name = name
         self.indexed = indexed
         self.required = required
         self.validator = validator
         self.default = default
         self.unique = unique
+        self.lex_indexed = lex_indexed
+        self.fulltext = fulltext
+        self.bitmap = bitmap
 
     def __get__(self, instance, owner):
         try:
@@ -74,6 +93,16 @@ class Attribute(object):
         except UnicodeError:
             return value.decode('utf-8')
 
+    def tokenize(self, value):
+        """
+        Splits the value into the lowercase words stored in the full-text
+        index. Override it to add stemming or stop words.
+        """
+        if not value:
+            return []
+        return re.findall(r'\w+', self.typecast_for_storage(value).lower(),
+                          re.UNICODE)
+
     def value_type(self):
         return unicode
 
@@ -296,6 +325,48 @@ class TimeDeltaField(Attribute):
         return self.value_type()
 
 
+class GeoField(Attribute):
+    """
+    Stores a (latitude, longitude) pair.
+
+    When indexed, the position is also added to a Redis GEO sorted set
+    so the objects can be filtered with the ``near`` lookup, given
+    ``(lat, lon, radius_km)``, and the ``box`` lookup, given
+    ``(lat, lon, width_km, height_km)``.
+    """
+    MAX_LATITUDE = 85.05112878
+
+    def typecast_for_read(self, value):
+        try:
+            lat, lon = value.split(',')
+            return (float(lat), float(lon))
+        except (AttributeError, ValueError):
+            return None
+
+    def typecast_for_storage(self, value):
+        if value is None:
+            return None
+        return "%f,%f" % tuple(value)
+
+    def value_type(self):
+        return tuple
+
+    def acceptable_types(self):
+        return (tuple, list)
+
+    def validate(self, instance):
+        super(GeoField, self).validate(instance)
+        val = getattr(instance, self.name)
+        if val is None:
+            return
+        try:
+            lat, lon = [float(v) for v in val]
+        except (TypeError, ValueError):
+            raise FieldValidationError([(self.name, 'bad type')])
+        if abs(lat) > self.MAX_LATITUDE or abs(lon) > 180:
+            raise FieldValidationError([(self.name, 'out of range')])
+
+
 class ListField(object):
     """Stores a list of objects.
 
@@ -332,11 +403,12 @@ class ListField(object):
                 val = self.default
             else:
                 key = instance.key()[self.name]
-                val = List(key).members
+                val = List(key, db=instance.db).members
             if val is not None:
                 klass = self.value_type()
                 if self._redisco_model:
-                    val = filter(lambda o: o is not None, [klass.objects.get_by_id(v) for v in val])
+                    val = filter(lambda o: o is not None,
+                                 map(resolve, [klass.objects.get_by_id(v) for v in val]))
                 else:
                     val = [klass(v) for v in val]
             self.__set__(instance, val)
@@ -450,8 +522,8 @@ class ReferenceField(object):
     def __get__(self, instance, owner):
         try:
             if not hasattr(instance, '_' + self.name):
-                o = self.value_type().objects.get_by_id(
-                                    getattr(instance, self.attname))
+                o = resolve(self.value_type().objects.get_by_id(
+                                    getattr(instance, self.attname)))
                 setattr(instance, '_' + self.name, o)
             return getattr(instance, '_' + self.name)
         except AttributeError:
@@ -503,12 +575,16 @@ class Counter(IntegerField):
 
     def __get__(self, instance, owner):
         if not instance.is_new():
-            v = instance.db.hget(instance.key(), self.name)
-            if v is None:
-                return 0
-            return int(v)
+            return pipelined(instance.db,
+                             [('hget', (instance.key(), self.name))],
+                             self._typecast_count)
         else:
             return 0
 
+    def _typecast_count(self, value):
+        if value is None:
+            return 0
+        return int(value)
+
 
 ZINDEXABLE = (IntegerField, DateTimeField, DateField, FloatField, Counter)
@@ -8,6 +8,10 @@ from .key import Key
 from .managers import ManagerDescriptor, Manager
 from .exceptions import FieldValidationError, MissingID, BadKeyError, WatchError
 from .attributes import Counter
+from redisco.cluster import hash_tagged, is_cluster
+from redisco.pipelining import Batch, pipelined
+from redisco.sharding import HashRing
+from redisco.instrumentation import register_model_key
 
 __all__ = ['Model', 'from_key']
 
@@ -128,6 +132,16 @@ def _initialize_indices(model_class, name, bases, attrs):
             model_class._indices.append(k)
     if model_class._meta['indices']:
         model_class._indices.extend(model_class._meta['indices'])
+    model_class._compound_indices = [tuple(fields) for fields in
+                                     model_class._meta['compound_indices'] or []]
+    model_class._lex_indices = [k for k, v in model_class._attributes.iteritems()
+                                if v.lex_indexed]
+    model_class._bitmap_indices = [k for k, v in
+                                   model_class._attributes.iteritems()
+                                   if v.indexed and v.bitmap]
+    model_class._fulltext_indices = [k for k, v in
+                                     model_class._attributes.iteritems()
+                                     if v.fulltext]
 
 
 def _initialize_counters(model_class, name, bases, attrs):
@@ -154,7 +168,39 @@ def _initialize_key(model_class, name):
     """
     Initializes the key of the model.
     """
-    model_class._key = Key(model_class._meta['key'] or name)
+    model_class._keys = {}
+    # computes the key now, which registers it for the instrumentation
+    model_class._key
+
+
+class _ModelKey(object):
+    """
+    The key of a model. Unless ``Meta.hash_tag`` is set, the model is
+    hash-tagged when the cluster mode is on at the time the key is used,
+    so a model defined before ``connection_setup(cluster=True)`` gets the
+    keys of the cluster too.
+    """
+    def __get__(self, instance, owner):
+        hash_tag = owner._meta['hash_tag']
+        if hash_tag is None:
+            hash_tag = bool(redisco.client.connection_settings.get('cluster'))
+        keys = owner.__dict__.get('_keys')
+        if keys is None:
+            keys = owner._keys = {}
+        key = keys.get(hash_tag)
+        if key is None:
+            key = keys[hash_tag] = Key(hash_tagged(
+                owner._meta['key'] or owner.__name__, hash_tag))
+            register_model_key(key)
+        return key
+
+
+def _initialize_shards(model_class):
+    """
+    Initializes the hash ring of a model spread over ``Meta.shards``.
+    """
+    shards = model_class._meta['shards']
+    model_class._shards = HashRing(shards) if shards else None
 
 
 def _initialize_manager(model_class, name, bases, attrs):
@@ -185,6 +231,7 @@ class ModelOptions(object):
     ...     name = models.Attribute()
     ...     class Meta:
     ...         indices = ('full_name',)
+    ...         compound_indices = [('name', 'full_name')]
     ...         db = redis.Redis(host='localhost', port=29909)
 
     """
@@ -219,6 +266,7 @@ class ModelBase(type):
         _initialize_lists(cls, name, bases, attrs)
         _initialize_indices(cls, name, bases, attrs)
         _initialize_key(cls, name)
+        _initialize_shards(cls)
         _initialize_manager(cls, name, bases, attrs)
         # if targeted by a reference field using a string,
         # override for next try
@@ -232,6 +280,7 @@ class ModelBase(type):
 
 class Model(object):
     __metaclass__ = ModelBase
+    _key = _ModelKey()
 
     def __init__(self, **kwargs):
         self.update_attributes(**kwargs)
@@ -337,6 +386,17 @@ class Model(object):
         _new = self.is_new()
         if _new:
             self._initialize_id()
+        if self._shards is not None:
+            self._check_shard()
+            if _new and self._meta['shard_key'] is not None:
+                self._shards.nodes[0].hset(self._key['_shards'], self.id,
+                                           self._shards.name_of(self._shard))
+        writer = self._writer()
+        if isinstance(writer, Batch):
+            # the object stays locked until the batch is executed
+            writer.hold(self.key(), Mutex(self))
+            self._write(_new)
+            return True
         with Mutex(self):
             self._write(_new)
         return True
@@ -363,11 +423,12 @@ class Model(object):
 
     def delete(self):
         """Deletes the object from the datastore."""
-        pipeline = self.db.pipeline()
+        pipeline = self._pipeline()
         self._delete_from_indices(pipeline)
         self._delete_membership(pipeline)
         pipeline.delete(self.key())
         pipeline.execute()
+        self._forget_shards([self.id])
 
     def is_new(self):
         """
@@ -395,7 +456,9 @@ class Model(object):
         """
         if att not in self.counters:
             raise ValueError("%s is not a counter.")
-        self.db.hincrby(self.key(), att, val)
+        # the new value is not returned, so the increment can be buffered
+        pipelined(self._writer(), [('hincrby', (self.key(), att, val))],
+                  lambda value: None)
 
     def decr(self, att, val=1):
         """
@@ -466,7 +529,14 @@ class Model(object):
         Setting the id for the object will fetch it from the datastorage.
         """
         self._id = str(val)
-        stored_attrs = self.db.hgetall(self.key())
+        if self._shards is not None:
+            self._shard = self._find_shard(val)
+        self._load(self.db.hgetall(self.key()))
+
+    def _load(self, stored_attrs):
+        """
+        Sets the attributes of the instance from its stored hash.
+        """
         attrs = self.attributes.values()
         for att in attrs:
             if att.name in stored_attrs and not isinstance(att, Counter):
@@ -506,7 +576,14 @@ class Model(object):
 
     @property
     def db(self):
-        """Returns the Redis client used by the model."""
+        """
+        Returns the Redis client used by the model, the shard of the
+        object if the model is sharded.
+        """
+        if self._shards is not None:
+            if getattr(self, '_shard', None) is None:
+                self._shard = self._shards.get_node(self._shard_value())
+            return self._shard
         return redisco.get_client() if not self._meta['db'] else self._meta['db']
 
     @property
@@ -534,16 +611,104 @@ class Model(object):
     @classmethod
     def exists(cls, id):
         """Checks if the model with id exists."""
+        if cls._shards is not None:
+            db = cls._find_shard(id)
+            return db is not None and bool(
+                db.exists(cls._key[str(id)]) or
+                db.sismember(cls._key['all'], str(id)))
         return bool((cls._meta['db'] or redisco.get_client()).exists(cls._key[str(id)]) or
                     (cls._meta['db'] or redisco.get_client()).sismember(cls._key['all'], str(id)))
 
+    @classmethod
+    def _find_shard(cls, id):
+        """
+        Returns the shard storing the object ``id`` of a sharded model,
+        see ``_find_shards``.
+        """
+        return cls._find_shards([id])[0]
+
+    @classmethod
+    def _find_shards(cls, ids):
+        """
+        Returns the shards storing the objects ``ids`` of a sharded model:
+        the ones their ids hash to or, with a ``shard_key``, the ones
+        recorded in the ``_shards`` hash of the first shard when they were
+        created. None for the objects that are not recorded.
+        """
+        ids = [str(id) for id in ids]
+        if cls._meta['shard_key'] is None:
+            return [cls._shards.get_node(id) for id in ids]
+        if not ids:
+            return []
+        names = cls._shards.nodes[0].hmget(cls._key['_shards'], ids)
+        return [None if name is None else cls._shards.node_named(name)
+                for name in names]
+
+    @classmethod
+    def _forget_shards(cls, ids):
+        """
+        Removes the deleted objects ``ids`` from the ``_shards`` hash of a
+        model sharded on a ``shard_key``.
+        """
+        if cls._shards is None or cls._meta['shard_key'] is None or not ids:
+            return
+        cls._shards.nodes[0].hdel(cls._key['_shards'], *ids)
+
     ###################
     # Private methods #
     ###################
 
+    def _writer(self):
+        """
+        Returns the client the writes of the object go to: the current
+        ``redisco.batch()`` if it is on the database of the object.
+        """
+        batch = redisco.current_batch()
+        if batch is not None and batch.client is self.db:
+            return batch
+        return self.db
+
+    def _pipeline(self):
+        """Returns a pipeline for the writes of the object."""
+        return self._writer().pipeline()
+
     def _initialize_id(self):
-        """Initializes the id of the instance."""
-        self._id = str(self.db.incr(self._key['id']))
+        """
+        Initializes the id of the instance. The ids of a sharded model
+        are all allocated on its first shard.
+        """
+        db = self.db if self._shards is None else self._shards.nodes[0]
+        self._id = str(db.incr(self._key['id']))
+
+    def _shard_value(self):
+        """
+        Returns the value the shard of the object is picked from: its
+        ``shard_key`` attribute, or its id.
+        """
+        field = self._meta['shard_key']
+        if field is None:
+            return self.id
+        value = getattr(self, field)
+        if value is None:
+            return u''
+        att = self._attributes.get(field)
+        if att is not None:
+            return att.typecast_for_storage(value)
+        return unicode(value)
+
+    def _check_shard(self):
+        """
+        Raises a ValueError if the shard key of a stored object has been
+        changed: the object would be written on another shard than the
+        one it is stored on.
+        """
+        shard = self._shards.get_node(self._shard_value())
+        if getattr(self, '_shard', None) is None:
+            self._shard = shard
+        elif shard is not self._shard:
+            raise ValueError("%s is the shard key of %s and cannot be "
+                             "changed." % (self._meta['shard_key'],
+                                           self.__class__.__name__))
 
     def _write(self, _new=False):
         """Writes the values of the attributes to the datastore.
@@ -551,12 +716,17 @@ class Model(object):
         This method also creates the indices and saves the lists
         associated to the object.
         """
-        pipeline = self.db.pipeline()
+        pipeline = self._pipeline()
         self._create_membership(pipeline)
         self._update_indices(pipeline)
         h = {}
+        # the fields of the hash are updated in place: the counters are
+        # only changed by incr, which may still be queued in a batch
+        removed = []
         # attributes
         for k, v in self.attributes.iteritems():
+            if k in self.counters:
+                continue
             if isinstance(v, DateTimeField):
                 if v.auto_now:
                     setattr(self, k, datetime.now(tz=tzutc()))
@@ -570,6 +740,8 @@ class Model(object):
             for_storage = getattr(self, k)
             if for_storage is not None:
                 h[k] = v.typecast_for_storage(for_storage)
+            else:
+                removed.append(k)
         # indices
         for index in self.indices:
             if index not in self.lists and index not in self.attributes:
@@ -581,7 +753,10 @@ class Model(object):
                         h[index] = unicode(v)
                     except UnicodeError:
                         h[index] = unicode(v.decode('utf-8'))
-        pipeline.delete(self.key())
+                else:
+                    removed.append(index)
+        if removed and not _new:
+            pipeline.hdel(self.key(), *removed)
         if h:
             pipeline.hmset(self.key(), h)
 
@@ -620,51 +795,181 @@ class Model(object):
     def _update_indices(self, pipeline=None):
         """Updates the indices of the object."""
         self._delete_from_indices(pipeline)
+        batch = self._writer()
+        if isinstance(batch, Batch):
+            pipeline = _IndexRecorder(pipeline, self.key(),
+                                      batch.indices[self.key()])
         self._add_to_indices(pipeline)
 
     def _add_to_indices(self, pipeline):
         """Adds the base64 encoded values of the indices."""
         for att in self.indices:
             self._add_to_index(att, pipeline=pipeline)
+        for fields in self._compound_indices:
+            self._add_to_compound_index(fields, pipeline=pipeline)
+        for att in self._lex_indices:
+            self._add_to_lex_index(att, pipeline=pipeline)
+        for att in self._fulltext_indices:
+            self._add_to_fulltext_index(att, pipeline=pipeline)
 
     def _add_to_index(self, att, val=None, pipeline=None):
         """
         Adds the id to the index.
 
-        This also adds to the _indices set of the object.
+        This also adds to the _indices set of the object and increments
+        the reference count of the indexed values of the attribute.
         """
         index = self._index_key_for(att)
         if index is None:
             return
         t, index = index
         if t == 'attribute':
-            pipeline.sadd(index, self.id)
+            self._add_id_to_index(att, index, pipeline)
             pipeline.sadd(self.key()['_indices'], index)
+            keys = [index]
         elif t == 'list':
             for i in index:
                 pipeline.sadd(i, self.id)
                 pipeline.sadd(self.key()['_indices'], i)
+            keys = index
         elif t == 'sortedset':
             zindex, index = index
-            pipeline.sadd(index, self.id)
+            self._add_id_to_index(att, index, pipeline)
             pipeline.sadd(self.key()['_indices'], index)
             descriptor = self.attributes[att]
             score = descriptor.typecast_for_storage(getattr(self, att))
             pipeline.zadd(zindex, self.id, score)
             pipeline.sadd(self.key()['_zindices'], zindex)
+            keys = [index]
+        elif t == 'geo':
+            lat, lon = getattr(self, att)
+            pipeline.execute_command('GEOADD', index, lon, lat, self.id)
+            pipeline.sadd(self.key()['_zindices'], index)
+            keys = []
+        for key in set(keys):
+            pipeline.zincrby(self._values_key(att),
+                             self._value_from_index_key(att, key), 1)
+
+    def _add_id_to_index(self, att, index, pipeline):
+        """
+        Adds the id to the set index, or sets its bit when att has a
+        bitmap index.
+        """
+        if att in self._bitmap_indices:
+            pipeline.setbit(index, int(self.id), 1)
+        else:
+            pipeline.sadd(index, self.id)
+
+    def _add_to_compound_index(self, fields, pipeline=None):
+        """
+        Adds the id to the index of the combined values of fields. The
+        object is not indexed if one of the values is None.
+        """
+        values = []
+        for att in fields:
+            value = getattr(self, att)
+            if callable(value):
+                value = value()
+            if value is None:
+                return
+            values.append(value)
+        index = self._compound_index_key(fields, values)
+        pipeline.sadd(index, self.id)
+        pipeline.sadd(self.key()['_indices'], index)
+
+    def _add_to_lex_index(self, att, pipeline=None):
+        """
+        Adds the value and the id to the lexicographic index of att.
+        Missing values are indexed as empty strings so that they come
+        first when ordering.
+
+        The member is remembered in the _lexindices hash of the object
+        since it is needed to remove it.
+        """
+        value = getattr(self, att)
+        if value is None:
+            value = u''
+        else:
+            value = self.attributes[att].typecast_for_storage(value)
+        member = u"%s\x00%s" % (value, self.id)
+        pipeline.zadd(self._lex_index_key(att), member, 0)
+        pipeline.hset(self.key()['_lexindices'], self._lex_index_key(att),
+                      member)
+
+    def _add_to_fulltext_index(self, att, pipeline=None):
+        """
+        Adds the id to the sorted set of every word of att, scored by
+        the number of occurrences of the word. The sorted sets are
+        tracked in _zindices so they are cleaned up like the others.
+        """
+        frequencies = {}
+        for token in self.attributes[att].tokenize(getattr(self, att)):
+            frequencies[token] = frequencies.get(token, 0) + 1
+        for token, frequency in frequencies.iteritems():
+            zindex = self._fulltext_index_key(att, token)
+            pipeline.zadd(zindex, self.id, frequency)
+            pipeline.sadd(self.key()['_zindices'], zindex)
 
     def _delete_from_indices(self, pipeline):
         """Deletes the object's id from the sets(indices) it has been added
         to and removes its list of indices (used for housekeeping).
         """
-        s = Set(self.key()['_indices'], pipeline=self.db)
-        z = Set(self.key()['_zindices'], pipeline=self.db)
-        for index in s.members:
-            pipeline.srem(index, self.id)
-        for index in z.members:
+        batch = self._writer()
+        if isinstance(batch, Batch) and self.key() in batch.indices:
+            # saved earlier in the batch: Redis has not its indices yet
+            bookkeeping = batch.indices[self.key()]
+        else:
+            pipe = self.db.pipeline(transaction=False)
+            self._fetch_indices(pipe)
+            bookkeeping = pipe.execute()
+        self._remove_from_indices(pipeline, *bookkeeping)
+        if isinstance(batch, Batch):
+            batch.indices[self.key()] = [set(), set(), {}]
+
+    def _fetch_indices(self, pipeline):
+        """
+        Queues the reads of the bookkeeping of the indices of the object.
+        Their results are the arguments of ``_remove_from_indices``, so
+        the indices of many objects can be fetched in a single pipeline.
+        """
+        pipeline.smembers(self.key()['_indices'])
+        pipeline.smembers(self.key()['_zindices'])
+        if self._lex_indices:
+            pipeline.hgetall(self.key()['_lexindices'])
+
+    def _remove_from_indices(self, pipeline, indices, zindices, lex=None,
+                             registries=None):
+        """
+        Queues the removal of the object from the ``indices``, ``zindices``
+        and ``lex`` indices read by ``_fetch_indices``.
+
+        The registries whose counts are decremented are cleaned up, unless
+        a set is given in ``registries`` in which case they are only
+        added to it.
+        """
+        cleanup = registries is None
+        if cleanup:
+            registries = set()
+        for index in indices:
+            att, value = self._split_index_key(index)
+            if att in self._bitmap_indices:
+                pipeline.setbit(index, int(self.id), 0)
+            else:
+                pipeline.srem(index, self.id)
+            if att in self.indices:
+                pipeline.zincrby(self._values_key(att), value, -1)
+                registries.add(self._values_key(att))
+        for index in zindices:
             pipeline.zrem(index, self.id)
-        pipeline.delete(s.key)
-        pipeline.delete(z.key)
+        if cleanup:
+            for registry in registries:
+                pipeline.zremrangebyscore(registry, '-inf', 0)
+        for index, member in (lex or {}).iteritems():
+            pipeline.zrem(index, member)
+        pipeline.delete(self.key()['_indices'])
+        pipeline.delete(self.key()['_zindices'])
+        if self._lex_indices:
+            pipeline.delete(self.key()['_lexindices'])
 
     def _index_key_for(self, att, value=None):
         """Returns a key based on the attribute and its value.
@@ -684,6 +989,8 @@ class Model(object):
 
     def _get_index_key_for_non_list_attr(self, att, value):
         descriptor = self.attributes.get(att)
+        if descriptor and isinstance(descriptor, GeoField):
+            return ('geo', self._key[att])
         if descriptor and isinstance(descriptor, ZINDEXABLE):
             sval = descriptor.typecast_for_storage(value)
             return self._tuple_for_index_key_attr_zset(att, value, sval)
@@ -707,6 +1014,56 @@ class Model(object):
     def _index_key_for_attr_val(self, att, val):
         return self._key[att][val]
 
+    @classmethod
+    def _compound_index_key(cls, fields, values):
+        """
+        Returns the key of the compound index of fields for values,
+        ie: Model:tenant_id+status:1:open
+        """
+        key = cls._key['+'.join(fields)]
+        for att, value in zip(fields, values):
+            descriptor = cls._attributes.get(att)
+            if descriptor:
+                value = descriptor.typecast_for_storage(value)
+            key = key[value]
+        return key
+
+    @classmethod
+    def _lex_index_key(cls, att):
+        """
+        Returns the key of the lexicographic index of att. Its members
+        are the value and the id separated by a NUL byte, all scored 0.
+        """
+        return cls._key['_lex'][att]
+
+    @classmethod
+    def _fulltext_index_key(cls, att, token):
+        """
+        Returns the key of the sorted set of the ids whose att contains
+        token.
+        """
+        return cls._key['_ft'][att][token]
+
+    @classmethod
+    def _values_key(cls, att):
+        """
+        Returns the key of the registry of the values indexed for att.
+        It is a sorted set scored by the number of objects indexed under
+        each value.
+        """
+        return cls._key['_values'][att]
+
+    @classmethod
+    def _value_from_index_key(cls, att, index):
+        """Returns the value indexed by the index key of att."""
+        return index[len(cls._key[att]) + 1:]
+
+    @classmethod
+    def _split_index_key(cls, index):
+        """Returns the attribute and the value of an index key."""
+        att, _, value = index[len(cls._key) + 1:].partition(':')
+        return att, value
+
     ##################
     # Python methods #
     ##################
@@ -730,11 +1087,14 @@ class Model(object):
 def get_model_from_key(key):
     """Gets the model from a given key."""
     _known_models = {}
-    model_name = key.split(':', 2)[0]
     # populate
     for klass in Model.__subclasses__():
         _known_models[klass.__name__] = klass
-    return _known_models.get(model_name, None)
+        _known_models[klass._key] = klass
+    if key in _known_models:
+        return _known_models[key]
+    # the key of an object, the key of the model may be hash-tagged
+    return _known_models.get(key.rsplit(':', 1)[0], None)
 
 
 def from_key(key):
@@ -748,7 +1108,7 @@ def from_key(key):
     if model is None:
         raise BadKeyError
     try:
-        _, id = key.split(':', 2)
+        _, id = key.rsplit(':', 1)
         id = int(id)
     except ValueError:
         raise BadKeyError
@@ -757,6 +1117,33 @@ def from_key(key):
     return model.objects.get_by_id(id)
 
 
+class _IndexRecorder(object):
+    """
+    Pipeline proxy recording in ``bookkeeping``, a list of the
+    ``_indices`` and ``_zindices`` sets and the ``_lexindices`` dict, what
+    the commands it forwards add to the bookkeeping of the object ``key``.
+    """
+    def __init__(self, pipeline, key, bookkeeping):
+        self._pipeline = pipeline
+        self._key = key
+        self._bookkeeping = bookkeeping
+
+    def __getattr__(self, name):
+        return getattr(self._pipeline, name)
+
+    def sadd(self, name, *values):
+        if name == self._key['_indices']:
+            self._bookkeeping[0].update(values)
+        elif name == self._key['_zindices']:
+            self._bookkeeping[1].update(values)
+        return self._pipeline.sadd(name, *values)
+
+    def hset(self, name, key, value):
+        if name == self._key['_lexindices']:
+            self._bookkeeping[2][key] = value
+        return self._pipeline.hset(name, key, value)
+
+
 class Mutex(object):
     def __init__(self, instance):
         self.instance = instance
@@ -771,6 +1158,13 @@ class Mutex(object):
     def lock(self):
         o = self.instance
         _lock_key = o.key('_lock')
+        if is_cluster(o.db):
+            # The pipelines of a cluster cannot WATCH, SET NX takes the
+            # lock in one command and lets it expire like lock_timeout.
+            while not o.db.set(_lock_key, self.lock_timeout, px=1000,
+                               nx=True):
+                time.sleep(0.01)
+            return
         with o.db.pipeline() as pipe:
             while True:
                 try:
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import os
 import time
 from threading import Thread
 import redis
@@ -7,6 +8,7 @@ import unittest
 from datetime import date
 from redisco import models
 from redisco.models import managers
+from redisco.models import maintenance
 from redisco.models.base import Mutex
 from dateutil.tz import tzlocal
 
@@ -574,6 +576,975 @@ class ModelTestCase(RediscoTestCase):
 
         self.assert_('1' in self.client.smembers('People:all'))
 
+    def test_filter_planning(self):
+        Person.objects.create(first_name="Granny", last_name="Goose")
+        Person.objects.create(first_name="Clark", last_name="Kent")
+        Person.objects.create(first_name="Granny", last_name="Kent")
+
+        # a single filter reads the index without expiring it
+        self.assertEqual(2, len(Person.objects.filter(first_name="Granny")))
+        self.assertTrue(self.client.ttl('Person:first_name:Granny') in (None, -1))
+
+        persons = Person.objects.filter(first_name="Granny", last_name="Kent")
+        self.assertEqual(1, len(persons))
+        self.assertEqual('3', persons[0].id)
+
+        # an empty index short-circuits the intersection
+        persons = Person.objects.filter(first_name="Granny", last_name="Rahl")
+        self.assertEqual(0, len(persons))
+
+    def test_stale_index_entries(self):
+        Person.objects.create(first_name="Granny", last_name="Goose")
+        Person.objects.create(first_name="Granny", last_name="Kent")
+        # ids left in the indices by objects deleted without cleanup are
+        # only dropped by the maintenance, the filters skip Model:all
+        self.client.sadd('Person:first_name:Granny', '42')
+        self.client.sadd('Person:last_name:Kent', '42')
+        self.assertEqual(3, len(Person.objects.filter(first_name="Granny")))
+
+        maintenance.sweep(Person)
+        self.assertEqual(['1', '2'], [p.id for p in
+                                      Person.objects.filter(first_name="Granny")])
+        persons = Person.objects.filter(first_name="Granny", last_name="Kent")
+        self.assertEqual(['2'], [p.id for p in persons])
+
+    def test_filter_in(self):
+        Person.objects.create(first_name="Granny", last_name="Goose")
+        Person.objects.create(first_name="Clark", last_name="Kent")
+        Person.objects.create(first_name="Richard", last_name="Rahl")
+        Person.objects.create(first_name="Granny", last_name="Kent")
+
+        persons = Person.objects.filter(first_name__in=["Granny", "Clark"])
+        self.assertEqual(['1', '2', '4'], [p.id for p in persons])
+
+        persons = Person.objects.filter(first_name__in=["Granny", "Clark"],
+                                        last_name="Kent")
+        self.assertEqual(['2', '4'], [p.id for p in persons])
+
+        persons = Person.objects.filter(first_name__in=[])
+        self.assertEqual(0, len(persons))
+
+        persons = Person.objects.exclude(last_name__in=["Kent", "Rahl"])
+        self.assertEqual(['1'], [p.id for p in persons])
+
+    def test_filter_q(self):
+        Person.objects.create(first_name="Granny", last_name="Goose")
+        Person.objects.create(first_name="Clark", last_name="Kent")
+        Person.objects.create(first_name="Richard", last_name="Rahl")
+        Person.objects.create(first_name="Granny", last_name="Kent")
+
+        q = models.Q(first_name="Clark") | models.Q(last_name="Rahl")
+        self.assertEqual(['2', '3'], [p.id for p in Person.objects.filter(q)])
+
+        q = (models.Q(first_name="Granny", last_name="Kent") |
+                models.Q(first_name="Richard"))
+        self.assertEqual(['3', '4'], [p.id for p in Person.objects.filter(q)])
+
+        q = models.Q(last_name="Goose") | models.Q(first_name="Richard")
+        self.assertEqual(['2', '4'], [p.id for p in Person.objects.exclude(q)])
+
+        qs = Person.objects.filter(first_name="Granny")
+        qs.filter(last_name="Kent")
+        self.assertEqual(2, len(qs))
+
+    def test_aggregate(self):
+        class Order(models.Model):
+            status = models.Attribute()
+            amount = models.FloatField()
+
+        Order.objects.create(status="paid", amount=10.5)
+        Order.objects.create(status="paid", amount=20.0)
+        Order.objects.create(status="open", amount=4.0)
+
+        res = Order.objects.aggregate(total=models.Sum('amount'),
+                                      peak=models.Max('amount'),
+                                      low=models.Min('amount'),
+                                      n=models.Count('amount'))
+        self.assertEqual({'total': 34.5, 'peak': 20.0, 'low': 4.0, 'n': 3},
+                         res)
+
+        res = Order.objects.filter(status="paid").aggregate(
+                avg=models.Avg('amount'))
+        self.assertEqual({'avg': 15.25}, res)
+
+        res = Order.objects.filter(status="lost").aggregate(
+                avg=models.Avg('amount'), total=models.Sum('amount'))
+        self.assertEqual({'avg': None, 'total': 0.0}, res)
+
+        self.assertRaises(models.AttributeNotIndexed,
+                Order.objects.aggregate, total=models.Sum('status'))
+
+    def test_count_by(self):
+        Person.objects.create(first_name="Granny", last_name="Goose")
+        Person.objects.create(first_name="Clark", last_name="Kent")
+        Person.objects.create(first_name="Granny", last_name="Kent",
+                              active=True)
+
+        self.assertEqual({'Granny': 2, 'Clark': 1},
+                Person.objects.count_by('first_name'))
+        self.assertEqual({'Goose': 1, 'Kent': 1},
+                Person.objects.filter(first_name="Granny")
+                .count_by('last_name'))
+        self.assertEqual({True: 1, False: 2},
+                Person.objects.count_by('active'))
+        self.assertEqual({}, Person.objects.filter(first_name="Lana")
+                .count_by('last_name'))
+
+    def test_value_registry(self):
+        p1 = Person.objects.create(first_name="Granny", last_name="Goose")
+        p2 = Person.objects.create(first_name="Granny", last_name="Kent")
+        registry = 'Person:_values:first_name'
+        self.assertEqual(2, self.client.zscore(registry, 'Granny'))
+
+        p2.first_name = "Clark"
+        p2.save()
+        self.assertEqual(1, self.client.zscore(registry, 'Granny'))
+        self.assertEqual(1, self.client.zscore(registry, 'Clark'))
+        self.assertEqual(['Clark', 'Granny'],
+                sorted(Person.objects.distinct('first_name')))
+
+        p1.delete()
+        self.assertEqual(None, self.client.zscore(registry, 'Granny'))
+        self.assertEqual(['Clark'], Person.objects.distinct('first_name'))
+        self.assertEqual(['Kent'], Person.objects.filter(first_name="Clark")
+                .distinct('last_name'))
+
+    def test_compound_indices(self):
+        class Ticket(models.Model):
+            tenant_id = models.IntegerField()
+            status = models.Attribute()
+            owner = models.Attribute()
+
+            class Meta:
+                compound_indices = [('tenant_id', 'status')]
+
+        t1 = Ticket.objects.create(tenant_id=1, status="open", owner="bob")
+        Ticket.objects.create(tenant_id=1, status="closed", owner="bob")
+        Ticket.objects.create(tenant_id=2, status="open", owner="joe")
+        Ticket.objects.create(tenant_id=1, status="open", owner="joe")
+
+        self.assertEqual(set(['1', '4']),
+                self.client.smembers('Ticket:tenant_id+status:1:open'))
+        self.assertEqual(['1', '4'], [t.id for t in
+                Ticket.objects.filter(tenant_id=1, status="open")])
+        self.assertEqual(['4'], [t.id for t in
+                Ticket.objects.filter(tenant_id=1, status="open",
+                                      owner="joe")])
+
+        t1.status = "closed"
+        t1.save()
+        self.assertEqual(set(['4']),
+                self.client.smembers('Ticket:tenant_id+status:1:open'))
+        t1.delete()
+        self.assertEqual(set(['2']),
+                self.client.smembers('Ticket:tenant_id+status:1:closed'))
+
+    def test_histogram(self):
+        class Order(models.Model):
+            status = models.Attribute()
+            amount = models.IntegerField()
+
+        for amount in (1, 5, 10, 15, 20, 30):
+            Order.objects.create(status="paid", amount=amount)
+        Order.objects.create(status="open", amount=12)
+
+        self.assertEqual([(0, 10, 2), (10, 20, 3), (20, 30, 2)],
+                Order.objects.histogram('amount', [0, 10, 20, 30]))
+        self.assertEqual([(0, 10, 2), (10, 20, 2), (20, 30, 2)],
+                Order.objects.filter(status="paid").histogram(
+                    'amount', [0, 10, 20, 30]))
+
+    def test_lex_index(self):
+        class City(models.Model):
+            name = models.Attribute(lex_indexed=True)
+            country = models.Attribute()
+
+        for name, country in (("Paris", "FR"), ("Parma", "IT"),
+                              ("Lyon", "FR"), ("Berlin", "DE"), ("Par", "XX")):
+            City.objects.create(name=name, country=country)
+
+        names = lambda q: sorted(c.name for c in q)
+        self.assertEqual(["Par", "Paris", "Parma"],
+                         names(City.objects.filter(name__startswith="Par")))
+        self.assertEqual(["Paris"],
+                         names(City.objects.filter(name__startswith="Par",
+                                                   country="FR")))
+        self.assertEqual(["Berlin", "Lyon"],
+                         names(City.objects.filter(name__lt="Par")))
+        self.assertEqual(["Berlin", "Lyon", "Par"],
+                         names(City.objects.filter(name__lte="Par")))
+        self.assertEqual(["Paris", "Parma"],
+                         names(City.objects.filter(name__gt="Par")))
+        self.assertEqual(["Par", "Paris", "Parma"],
+                         names(City.objects.filter(name__gte="Par")))
+        self.assertEqual(["Lyon"],
+                         names(City.objects.filter(country="FR").exclude(
+                             name__startswith="Par")))
+
+        self.assertEqual(["Berlin", "Lyon", "Par", "Paris", "Parma"],
+                         [c.name for c in City.objects.order('name')])
+        self.assertEqual(["Parma", "Paris"],
+                         [c.name for c in City.objects.filter(
+                             name__gt="Par").order('-name')])
+        self.assertEqual(["Lyon"],
+                         [c.name for c in City.objects.order('name')
+                                                      .limit(1, 1)])
+
+        # a selective filter is sorted with SORT, the others walk the index
+        for i in range(30):
+            City.objects.create(name="Town %02d" % i, country="ZZ")
+        from redisco.models.modelset import ModelSet
+        for ratio in (ModelSet.LEX_SORT_RATIO, 0):
+            collection = City.objects.filter(country="FR").order('-name')
+            collection.LEX_SORT_RATIO = ratio
+            self.assertEqual(["Paris", "Lyon"], [c.name for c in collection])
+            collection = City.objects.filter(country="FR").order('name') \
+                                                          .limit(1, 1)
+            collection.LEX_SORT_RATIO = ratio
+            self.assertEqual(["Paris"], [c.name for c in collection])
+        for c in City.objects.filter(country="ZZ"):
+            c.delete()
+
+        paris = City.objects.filter(name="Paris")[0]
+        paris.name = "Nice"
+        paris.save()
+        self.assertEqual(["Par", "Parma"],
+                         names(City.objects.filter(name__startswith="Par")))
+        paris.delete()
+        self.assertEqual(4, self.client.zcard(City._lex_index_key('name')))
+        self.assertRaises(models.AttributeNotIndexed, lambda: list(
+                          City.objects.filter(country__startswith="F")))
+
+
+    def test_search(self):
+        class Article(models.Model):
+            title = models.Attribute(fulltext=True)
+            body = models.Attribute(fulltext=True, indexed=False)
+            published = models.BooleanField()
+
+        a = Article.objects.create(title="Redis", body="Redis in Python",
+                                   published=True)
+        b = Article.objects.create(title="Python",
+                                   body="Python, python and python",
+                                   published=True)
+        c = Article.objects.create(title="Draft", body="redis internals",
+                                   published=False)
+
+        ids = lambda q: [o.id for o in q]
+        self.assertEqual([b.id, a.id], ids(Article.objects.search("Python")))
+        self.assertEqual([a.id], ids(Article.objects.search("python redis")))
+        self.assertEqual(set([a.id, b.id, c.id]),
+                set(ids(Article.objects.search("python redis",
+                                               operator='or'))))
+        self.assertEqual([a.id],
+                ids(Article.objects.filter(published=True).search("redis")))
+        self.assertEqual([a.id],
+                ids(Article.objects.search("redis").filter(published=True)))
+        self.assertEqual([], ids(Article.objects.search("java")))
+        self.assertEqual([], ids(Article.objects.search("")))
+        self.assertEqual(2, len(Article.objects.search("redis")))
+        self.assertEqual({True: 1, False: 1},
+                Article.objects.search("redis").count_by('published'))
+
+        c.body = "Java internals"
+        c.save()
+        self.assertEqual([a.id], ids(Article.objects.search("redis")))
+        b.delete()
+        self.assertEqual([a.id], ids(Article.objects.search("python")))
+        self.assertEqual(0, self.client.exists(
+            Article._fulltext_index_key('body', 'and')))
+
+        class Plain(models.Model):
+            name = models.Attribute()
+        self.assertRaises(models.AttributeNotIndexed,
+                          Plain.objects.search, "name")
+
+
+    def test_geo_field(self):
+        class Shop(models.Model):
+            name = models.Attribute()
+            location = models.GeoField()
+
+        louvre = Shop.objects.create(name="Louvre",
+                                     location=(48.8606, 2.3376))
+        eiffel = Shop.objects.create(name="Eiffel", location=(48.8584, 2.2945))
+        lyon = Shop.objects.create(name="Bellecour",
+                                   location=(45.7578, 4.8320))
+        self.assertEqual((48.8606, 2.3376),
+                         Shop.objects.get_by_id(louvre.id).location)
+
+        ids = lambda q: sorted(s.id for s in q)
+        self.assertEqual(sorted([louvre.id, eiffel.id]), ids(
+            Shop.objects.filter(location__near=(48.8566, 2.3522, 10))))
+        self.assertEqual([louvre.id], ids(
+            Shop.objects.filter(location__near=(48.8566, 2.3522, 2))))
+        self.assertEqual([eiffel.id], ids(
+            Shop.objects.filter(location__near=(48.8566, 2.3522, 10),
+                                name="Eiffel")))
+        self.assertEqual([lyon.id], ids(
+            Shop.objects.exclude(location__box=(48.8566, 2.3522, 20, 20))))
+
+        eiffel.location = (45.76, 4.83)
+        eiffel.save()
+        self.assertEqual(sorted([eiffel.id, lyon.id]), ids(
+            Shop.objects.filter(location__near=(45.7578, 4.8320, 5))))
+        eiffel.delete()
+        self.assertEqual(2, self.client.zcard(Shop._key['location']))
+
+        self.assertFalse(Shop(name="Nowhere", location=(91, 0)).is_valid())
+        self.assertRaises(models.AttributeNotIndexed, lambda: list(
+            Shop.objects.filter(name__near=(0, 0, 1))))
+
+
+    def test_bitmap_index(self):
+        class Account(models.Model):
+            active = models.BooleanField(bitmap=True)
+            plan = models.Attribute(bitmap=True)
+            name = models.Attribute()
+
+        for active, plan, name in ((True, "free", "a"), (True, "pro", "b"),
+                                   (False, "free", "c"), (True, "team", "d")):
+            Account.objects.create(active=active, plan=plan, name=name)
+
+        self.assertEqual("string", self.client.type("Account:active:1"))
+        self.assertEqual(3, Account.objects.filter(active=True).count())
+        self.assertEqual(2, Account.objects.filter(
+            active=True, plan__in=["pro", "team"]).count())
+        self.assertEqual(2, Account.objects.filter(active=True).exclude(
+            plan="pro").count())
+        self.assertEqual(0, Account.objects.filter(plan="gold").count())
+
+        names = lambda q: sorted(a.name for a in q)
+        self.assertEqual(["a", "d"], names(Account.objects.filter(
+            active=True).exclude(plan="pro")))
+        self.assertEqual(["c"], names(Account.objects.filter(
+            plan="free", name="c")))
+        self.assertEqual(1, len(Account.objects.filter(active=True,
+                                                       name="b")))
+        self.assertEqual({"free": 2, "pro": 1, "team": 1},
+                         Account.objects.count_by("plan"))
+        self.assertEqual({"free": 1, "pro": 1, "team": 1},
+                         Account.objects.filter(active=True).count_by("plan"))
+
+        b = Account.objects.filter(name="b")[0]
+        b.active = False
+        b.save()
+        self.assertEqual(2, Account.objects.filter(active=True).count())
+        b.delete()
+        self.assertEqual(1, Account.objects.filter(active=False).count())
+        self.assertEqual(["a", "c", "d"],
+                         names(Account.objects.order('name')))
+
+
+    def test_rebuild_indices(self):
+        class Book(models.Model):
+            title = models.Attribute(indexed=False)
+            year = models.IntegerField(indexed=False)
+            class Meta:
+                key = 'Book'
+
+        for title, year in (("Dune", 1965), ("Emma", 1815), ("Dune", 1984)):
+            Book.objects.create(title=title, year=year)
+
+        class IndexedBook(models.Model):
+            title = models.Attribute()
+            year = models.IntegerField()
+            class Meta:
+                key = 'Book'
+                compound_indices = [('title', 'year')]
+
+        self.assertEqual(0, len(IndexedBook.objects.filter(title="Dune")))
+        self.assertEqual(3, IndexedBook.objects.rebuild_indices(
+            fields=['title'], batch_size=2))
+        self.assertEqual(2, len(IndexedBook.objects.filter(title="Dune")))
+        self.assertEqual(0, len(IndexedBook.objects.zfilter(year__gt=1900)))
+        self.assertEqual(1, len(IndexedBook.objects.filter(title="Dune",
+                                                           year=1984)))
+
+        self.assertEqual(3, IndexedBook.objects.rebuild_indices())
+        self.assertEqual(3, IndexedBook.objects.rebuild_indices())
+        self.assertEqual(2, len(IndexedBook.objects.zfilter(year__gt=1900)))
+        self.assertEqual({"Dune": 2, "Emma": 1},
+                         IndexedBook.objects.count_by('title'))
+        self.assertRaises(models.AttributeNotIndexed,
+                          IndexedBook.objects.rebuild_indices, ['author'])
+
+
+    def test_check_indices(self):
+        class Member(models.Model):
+            name = models.Attribute()
+            age = models.IntegerField()
+            class Meta:
+                compound_indices = [('name', 'age')]
+
+        a = Member.objects.create(name="Ann", age=30)
+        b = Member.objects.create(name="Bob", age=40)
+        c = Member.objects.create(name="Cid", age=50)
+
+        report = Member.objects.check_indices()
+        self.assertEqual(3, report['objects'])
+        self.assertEqual(0, sum(v for k, v in report.items()
+                                if k not in ('objects', 'index_keys')))
+
+        # a crash left b half indexed, c without data and a stray id
+        self.client.srem(Member._key['name']['Bob'], b.id)
+        self.client.zrem(Member._key['age'], b.id)
+        self.client.delete(c.key())
+        self.client.sadd(Member._key['name']['Ann'], 999)
+
+        checker = maintenance.IndexChecker(Member, count=1)
+        while checker.step():
+            self.assertTrue(checker.cursor[0] in ('objects', 'keys',
+                                                  'registry'))
+        self.assertEqual(1, checker.report['dangling_objects'])
+        self.assertEqual(2, checker.report['missing_entries'])
+        self.assertEqual(1, checker.report['orphan_ids'])
+        self.assertEqual(2, checker.report['registry_mismatches'])
+        self.assertEqual(2, len(Member.objects.filter(name="Ann")))
+
+        report = Member.objects.check_indices(repair=True)
+        self.assertEqual(2, report['repaired_objects'])
+        self.assertEqual([a.id], [m.id for m in
+                                  Member.objects.filter(name="Ann")])
+        self.assertEqual(1, len(Member.objects.filter(name="Bob")))
+        self.assertEqual(1, len(Member.objects.zfilter(age__gt=35)))
+        self.assertEqual(0, len(Member.objects.filter(name="Cid")))
+        self.assertEqual({"Ann": 1, "Bob": 1},
+                         Member.objects.count_by('name'))
+
+        report = Member.objects.check_indices()
+        self.assertEqual(2, report['objects'])
+        self.assertEqual(0, sum(v for k, v in report.items()
+                                if k not in ('objects', 'index_keys')))
+
+    def test_check_indices_lists_only(self):
+        class Playlist(models.Model):
+            songs = models.ListField(str)
+
+        playlist = Playlist.objects.create(songs=["Ode", "Air"])
+        self.assertFalse(self.client.exists(playlist.key()))
+
+        report = Playlist.objects.check_indices(repair=True)
+        self.assertEqual(0, report['dangling_objects'])
+        self.assertEqual(0, report['repaired_objects'])
+        self.assertEqual(["Ode", "Air"], Playlist.objects.get_by_id(
+            playlist.id).songs)
+
+    def test_temporary_keys(self):
+        class Pet(models.Model):
+            name = models.Attribute()
+            kind = models.Attribute()
+
+        for name, kind in (("Rex", "dog"), ("Tom", "cat"), ("Kit", "cat")):
+            Pet.objects.create(name=name, kind=kind)
+
+        pets = Pet.objects.filter(kind__in=["cat", "dog"]).exclude(
+            name="Tom").order('name').expire(300)
+        self.assertEqual(["Kit", "Rex"], [p.name for p in pets])
+        self.assertEqual([pets._set.key], self.client.keys("*~*"))
+        self.assertTrue(self.client.ttl(pets._set.key) > 60)
+        pets.release()
+        self.assertEqual([], self.client.keys("*~*"))
+        self.assertEqual([], self.client.keys("*#*"))
+
+        self.assertEqual({"cat": 2}, Pet.objects.exclude(
+            name="Rex").count_by('kind'))
+        self.assertEqual([], self.client.keys("~*"))
+
+        with Pet.objects.filter(kind="cat") as cats:
+            self.assertEqual(2, len(cats))
+        self.assertEqual([], self.client.keys("*#*"))
+
+        self.client.sadd("~leftover.42", 1)
+        self.assertEqual(1, maintenance.sweep_temporary_keys())
+        self.assertTrue(self.client.ttl("~leftover.42") > 0)
+
+        rex = Pet.objects.filter(name="Rex")[0]
+        self.client.delete(rex.key()['_indices'])
+        rex.delete()
+        report = maintenance.sweep(Pet)
+        self.assertEqual(2, report['orphan_ids'])
+        self.assertFalse(self.client.exists(Pet._key['name']['Rex']))
+        self.assertEqual({"cat": 2}, Pet.objects.count_by('kind'))
+
+
+    def test_bulk_delete(self):
+        class Note(models.Model):
+            title = models.Attribute(lex_indexed=True)
+            body = models.Attribute(fulltext=True)
+            year = models.IntegerField()
+
+        notes = [Note.objects.create(title="n%d" % i, body="word %d" % i,
+                                     year=2000 + i % 3)
+                 for i in range(7)]
+
+        ModelSet = Note.objects.all().__class__
+        self.assertEqual(2, Note.objects.zfilter(year__gt=2000).filter(
+            year=2001).delete())
+        self.assertEqual(0, len(Note.objects.filter(year=2001)))
+        self.assertEqual(5, len(Note.objects.search("word")))
+
+        self.assertEqual(2, Note.objects.bulk_delete(
+            [notes[0].id, notes[2].id, "12345"]))
+        self.assertEqual(["n3", "n5", "n6"],
+                         [n.title for n in Note.objects.order('title')])
+        self.assertEqual({2000: 2, 2002: 1}, Note.objects.count_by('year'))
+        self.assertEqual(3, self.client.zcard(Note._lex_index_key('title')))
+        self.assertFalse(self.client.exists(notes[0].key()))
+        self.assertFalse(self.client.exists(notes[0].key()['_indices']))
+
+        ModelSet.BULK_CHUNK_SIZE = 1
+        try:
+            self.assertEqual(3, Note.objects.all().delete())
+        finally:
+            ModelSet.BULK_CHUNK_SIZE = 1000
+        self.assertEqual(0, self.client.scard(Note._key['all']))
+        self.assertEqual([], self.client.keys("Note:_*"))
+        self.assertFalse(self.client.exists(Note._key['year']))
+
+
+    def test_bulk_update(self):
+        class Task(models.Model):
+            title = models.Attribute(fulltext=True)
+            status = models.Attribute()
+            done = models.BooleanField(bitmap=True)
+            priority = models.IntegerField()
+            class Meta:
+                compound_indices = [('status', 'priority')]
+
+        for i in range(5):
+            Task.objects.create(title="task %d" % i, status="open",
+                                done=False, priority=i)
+
+        self.assertEqual(3, Task.objects.zfilter(priority__lt=3).update(
+            status="closed", done=True, priority=10))
+        self.assertEqual(2, len(Task.objects.filter(status="open")))
+        self.assertEqual(3, len(Task.objects.filter(status="closed",
+                                                    priority=10)))
+        self.assertEqual(3, Task.objects.filter(done=True).count())
+        self.assertEqual(3, len(Task.objects.zfilter(priority__gt=5)))
+        self.assertEqual({"open": 2, "closed": 3},
+                         Task.objects.count_by('status'))
+        self.assertEqual({3: 1, 4: 1, 10: 3},
+                         Task.objects.count_by('priority'))
+
+        task = Task.objects.filter(status="closed")[0]
+        self.assertEqual("closed", task.status)
+        self.assertEqual(10, task.priority)
+        self.assertTrue(task.done)
+
+        Task.objects.filter(status="closed").update(title="archived work")
+        self.assertEqual(3, len(Task.objects.search("archived")))
+        self.assertEqual(2, len(Task.objects.search("task")))
+
+        report = Task.objects.check_indices()
+        self.assertEqual(0, sum(v for k, v in report.items()
+                                if k not in ('objects', 'index_keys')))
+        task.delete()
+        self.assertEqual({"open": 2, "closed": 2},
+                         Task.objects.count_by('status'))
+        self.assertRaises(AttributeError, Task.objects.all().update,
+                          owner="me")
+
+
+    def test_batched_iteration(self):
+        for i in range(7):
+            Person.objects.create(first_name="Name%d" % i, last_name="Last",
+                                  active=i % 2 == 0)
+        Person.objects.create(first_name="Other")
+        people = Person.objects.filter(last_name="Last").order('first_name')
+        people.FETCH_CHUNK_SIZE = 3
+        self.assertEqual(["Name%d" % i for i in range(7)],
+                         [p.first_name for p in people])
+        self.assertEqual([True, False, True, False, True, False, True],
+                         [p.active for p in people])
+        self.assertEqual(["Name2", "Name3"],
+                         [p.first_name for p in people[2:4]])
+        self.assertEqual([], people[10:12])
+        self.assertEqual(people[4], list(people)[4])
+
+    def test_autopipeline(self):
+        from redisco.containers import List
+
+        class Page(models.Model):
+            title = models.Attribute()
+            hits = models.Counter()
+
+        pages = [Page.objects.create(title="p%d" % i) for i in range(3)]
+        pages[0].incr('hits', 2)
+
+        with redisco.autopipeline() as pipe:
+            self.assertTrue(redisco.get_client() is pipe)
+            fetched = [Page.objects.get_by_id(p.id) for p in pages]
+            fetched.append(Page.objects.get_by_id(1000))
+            self.assertEqual(12, len(pipe))
+            self.assertEqual("p1", fetched[1].title)
+            self.assertEqual(0, len(pipe))
+            self.assertEqual(None, redisco.resolve(fetched[3]))
+
+            hits = [p.hits for p in fetched[:3]]
+            self.assertEqual(3, len(pipe))
+            self.assertEqual([2, 0, 0], hits)
+
+            redisco.get_client().sadd('autopiped', 'a')
+            redisco.get_client().sadd('autopiped', 'b')
+            self.assertEqual(2, len(pipe))
+            self.assertEqual(0, self.client.scard('autopiped'))
+            self.assertEqual(2, redisco.get_client().scard('autopiped'))
+            self.assertEqual(0, len(pipe))
+            redisco.get_client().sadd('autopiped', 'c')
+            self.assertEqual(1, len(pipe))
+            self.assertTrue(List('autopiped_list').pop() is None)
+            self.assertEqual(0, len(pipe))
+            pages[1].incr('hits')
+            self.assertEqual(1, len(pipe))
+
+        self.assertFalse(redisco.get_client() is pipe)
+        self.assertEqual(3, self.client.scard('autopiped'))
+        self.assertEqual("p0", Page.objects.get_by_id(pages[0].id).title)
+        self.assertEqual(1, Page.objects.get_by_id(pages[1].id).hits)
+
+    def test_batch(self):
+        from redisco.containers import Set
+
+        class Visitor(models.Model):
+            name = models.Attribute(indexed=True)
+            visits = models.Counter()
+
+        alice = Visitor.objects.create(name="Alice")
+        with redisco.batch() as batch:
+            bob = Visitor(name="Bob")
+            self.assertTrue(bob.save())
+            alice.incr('visits', 3)
+            alice.name = "Alicia"
+            alice.save()
+            active = Set('active')
+            active.add(alice.id, bob.id)
+            members = active.members
+            self.assertRaises(redisco.PendingResult, len, members)
+            self.assertEqual(0, self.client.scard('active'))
+            self.assertEqual(1, len(Visitor.objects.all()))
+            self.assertTrue(len(batch) > 0)
+
+        self.assertEqual(set([alice.id, bob.id]), members)
+        self.assertEqual(2, len(Visitor.objects.all()))
+        self.assertEqual(3, Visitor.objects.get_by_id(alice.id).visits)
+        self.assertEqual(1, len(Visitor.objects.filter(name="Alicia")))
+        self.assertEqual(0, len(Visitor.objects.filter(name="Alice")))
+        self.assertEqual(1, len(Visitor.objects.filter(name="Bob")))
+
+        try:
+            with redisco.batch():
+                alice.incr('visits')
+                bob.delete()
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(3, Visitor.objects.get_by_id(alice.id).visits)
+        self.assertEqual(2, len(Visitor.objects.all()))
+
+    def test_batch_saves_twice(self):
+        class Visitor(models.Model):
+            name = models.Attribute(indexed=True)
+            city = models.Attribute(indexed=True)
+
+        alice = Visitor.objects.create(name="Alice", city="Paris")
+        lock = alice.key('_lock')
+        with redisco.batch():
+            alice.name = "Alicia"
+            alice.save()
+            self.assertTrue(self.client.exists(lock))
+            alice.name = "Ally"
+            alice.city = "Lyon"
+            alice.save()
+            bob = Visitor(name="Bob", city="Paris")
+            bob.save()
+            bob.city = "Lyon"
+            bob.save()
+        self.assertFalse(self.client.exists(lock))
+
+        self.assertEqual(set(['Visitor:name:Ally', 'Visitor:city:Lyon']),
+                         self.client.smembers(alice.key()['_indices']))
+        self.assertEqual(set(['Visitor:name:Bob', 'Visitor:city:Lyon']),
+                         self.client.smembers(bob.key()['_indices']))
+        for name in ("Alice", "Alicia"):
+            self.assertFalse(self.client.exists('Visitor:name:%s' % name))
+        self.assertFalse(self.client.exists('Visitor:city:Paris'))
+        self.assertEqual(set([alice.id, bob.id]),
+                         self.client.smembers('Visitor:city:Lyon'))
+        self.assertEqual([('Ally', 1.0), ('Bob', 1.0)],
+                         self.client.zrange('Visitor:_values:name', 0, -1,
+                                            withscores=True))
+        self.assertEqual([('Lyon', 2.0)],
+                         self.client.zrange('Visitor:_values:city', 0, -1,
+                                            withscores=True))
+
+    def test_replica_reads(self):
+        class Book(models.Model):
+            title = models.Attribute()
+            genre = models.Attribute()
+            year = models.IntegerField()
+
+        for i, genre in enumerate(["sf", "sf", "crime", "sf", "poetry"]):
+            Book.objects.create(title="Book %d" % i, genre=genre,
+                                year=2000 + i)
+        ids = lambda q: [b.id for b in q]
+
+        redisco.connection_setup(replicas=[{}, {}])
+        try:
+            primary = redisco.get_client()
+            first = redisco.get_read_client()
+            self.assertFalse(first is primary)
+            self.assertFalse(first is redisco.get_read_client())
+            self.assertTrue(first is redisco.get_read_client())
+
+            books = Book.objects.filter(genre="sf").exclude(year=2001)
+            self.assertEqual(["1", "4"], ids(books))
+            self.assertTrue(isinstance(books._set, list))
+            self.assertEqual(["1", "3", "4"],
+                             ids(Book.objects.filter(genre__in=["sf", "crime"],
+                                                     year__in=[2000, 2002, 2003])))
+            self.assertEqual(["2", "3"], ids(Book.objects.all().limit(2, 1)))
+            self.assertEqual([], ids(Book.objects.filter(genre__in=[])))
+            sf = Book.objects.filter(genre="sf")
+            self.assertEqual(3, sf.count())
+            self.assertFalse(hasattr(sf, '_cached_set'))
+            self.assertEqual(1, len(Book.objects.filter(genre="sf",
+                                                        year=2003)))
+            self.assertEqual(5, Book.objects.all().count())
+            self.assertEqual(["5", "4", "3", "2", "1"],
+                             ids(Book.objects.order('-year')))
+            self.assertEqual(["4", "2", "1"],
+                             ids(Book.objects.filter(genre="sf").order('-year')))
+            self.assertEqual("Book 2", Book.objects.get_by_id(3).title)
+            self.assertFalse(isinstance(Book.objects.primary()
+                                        .filter(genre="sf")._set, list))
+
+            with redisco.autopipeline():
+                self.assertTrue(redisco.get_read_client() is
+                                redisco.get_client())
+
+            redisco.connection_setup(replica_selection='latency')
+            replica = redisco.get_read_client()
+            self.assertFalse(replica is redisco.get_client())
+            self.assertTrue(replica is redisco.get_read_client())
+        finally:
+            redisco.connection_setup(replicas=None, replica_selection=None)
+
+    def test_cluster_argument_order(self):
+        from redisco import cluster
+
+        class Recorder(object):
+            def _record(self, *args):
+                return args
+
+        class Legacy(Recorder):
+            # redis.Redis of redis-py 2, RedisCluster of redis-py-cluster 1
+            def zadd(self, name, *args, **kwargs):
+                return self._record(name, *args)
+            def zincrby(self, name, value, amount=1):
+                return self._record(name, value, amount)
+            def lrem(self, name, value, num=0):
+                return self._record(name, value, num)
+            def setex(self, name, value, time):
+                return self._record(name, value, time)
+
+        class Strict(Legacy):
+            # StrictRedis of redis-py 2
+            def zadd(self, name, *args, **kwargs):
+                return self._record(name, *args)
+            def lrem(self, name, count, value):
+                return self._record(name, count, value)
+            def setex(self, name, time, value):
+                return self._record(name, time, value)
+
+        class Mapping(Strict):
+            # redis-py 3 and later
+            def zadd(self, name, mapping, nx=False, xx=False):
+                return self._record(name, mapping)
+            def zincrby(self, name, amount, value):
+                return self._record(name, amount, value)
+
+        for base, zadd, zincrby, lrem, setex in (
+                (Legacy, ('z', 'a', 1), ('z', 'a', 2), ('l', 'v', 0),
+                 ('k', 'v', 60)),
+                (Strict, ('z', 1, 'a'), ('z', 'a', 2), ('l', 0, 'v'),
+                 ('k', 60, 'v')),
+                (Mapping, ('z', {'a': 1}), ('z', 2, 'a'), ('l', 0, 'v'),
+                 ('k', 60, 'v'))):
+            client = cluster._legacy_class(base)()
+            self.assertEqual(zadd, client.zadd('z', 'a', 1))
+            self.assertEqual(zincrby, client.zincrby('z', 'a', 2))
+            self.assertEqual(lrem, client.lrem('l', 'v'))
+            self.assertEqual(setex, client.setex('k', 'v', 60))
+
+    def test_hash_tagged_keys(self):
+        from redisco import cluster
+        from redisco.containers import Set
+        from redisco.models.base import from_key
+
+        self.assertEqual(12182, cluster.key_slot("foo"))
+        self.assertEqual(12739, cluster.key_slot("123456789"))
+        self.assertEqual(cluster.key_slot("{user1000}.following"),
+                         cluster.key_slot("{user1000}.followers"))
+        self.assertEqual(cluster.key_slot("{}foo"), cluster.key_slot("{}foo"))
+        self.assertNotEqual(cluster.key_slot("{}foo"), cluster.key_slot("foo"))
+
+        class Tagged(models.Model):
+            name = models.Attribute()
+            rank = models.IntegerField()
+            class Meta:
+                hash_tag = True
+
+        class TenantTagged(models.Model):
+            name = models.Attribute()
+            class Meta:
+                hash_tag = 'acme'
+
+        self.assertEqual("{Tagged}", Tagged._key)
+        self.assertEqual("{acme}:TenantTagged", TenantTagged._key)
+        a = Tagged.objects.create(name="a", rank=1)
+        Tagged.objects.create(name="b", rank=2)
+        TenantTagged.objects.create(name="a")
+        self.assertTrue(self.client.exists("{Tagged}:1"))
+        self.assertEqual(["a"], [t.name for t in
+                                 Tagged.objects.filter(name="a")
+                                 .zfilter(rank__lt=2).order('-rank')])
+        self.assertEqual(a, from_key("{Tagged}:1"))
+        self.assertEqual("a", from_key("{acme}:TenantTagged:1").name)
+
+        class Untagged(models.Model):
+            name = models.Attribute()
+
+        self.assertEqual("Untagged", Untagged._key)
+
+        settings = redisco.client.connection_settings
+        settings['cluster'] = True
+        try:
+            # the models defined before the cluster mode is on get tagged
+            self.assertEqual("{Untagged}", Untagged._key)
+            self.assertEqual("{Tagged}", Tagged._key)
+            Set("{Tagged}:x").union("{Tagged}:y", Set("{Tagged}:z"))
+            self.assertRaises(cluster.CrossSlotError,
+                              Set("{Tagged}:x").union, "other",
+                              Set("{Tagged}:z"))
+            self.assertRaises(cluster.CrossSlotError,
+                              Set("foo").sinter, Set("bar"))
+        finally:
+            del settings['cluster']
+        self.assertEqual("Untagged", Untagged._key)
+
+    def test_sharded_model(self):
+        from redisco.models.aggregates import Sum, Max
+        # the shards are two other databases of the test server, only the
+        # keys of the models of the test are removed from them
+        settings = redisco.client.connection_settings
+        db = settings.get('db', 0)
+        dbs = os.environ.get('REDIS_SHARD_DBS',
+                             '%d,%d' % ((db - 2) % 16, (db - 1) % 16))
+        nodes = [redis.Redis(host=settings.get('host', 'localhost'),
+                             port=settings.get('port', 6379), db=int(n))
+                 for n in dbs.split(',')]
+
+        def clear():
+            for shard in nodes:
+                for pattern in ('*Order*', '*Visit*', '*Post*'):
+                    keys = list(shard.scan_iter(match=pattern))
+                    if keys:
+                        shard.delete(*keys)
+        clear()
+
+        class Order(models.Model):
+            customer = models.Attribute()
+            status = models.Attribute()
+            amount = models.IntegerField()
+            class Meta:
+                shards = list(nodes)
+
+        class Visit(models.Model):
+            user = models.Attribute()
+            page = models.Attribute()
+            class Meta:
+                shards = list(nodes)
+                shard_key = 'user'
+
+        class Post(models.Model):
+            title = models.Attribute(fulltext=True)
+            class Meta:
+                shards = list(nodes)
+
+        try:
+            for i in range(20):
+                Order.objects.create(customer="c%d" % (i % 3),
+                                     status="open" if i % 2 else "paid",
+                                     amount=i)
+            self.assertFalse(self.client.keys("Order:*"))
+            self.assertEqual("20", nodes[0].get("Order:id"))
+            self.assertTrue(all(shard.scard("Order:all") for shard in nodes))
+            self.assertEqual(20, Order.objects.all().count())
+            self.assertEqual(range(1, 21), [int(o.id) for o in Order.objects.all()])
+            self.assertEqual([19, 18, 17],
+                             [o.amount for o in Order.objects.order('-amount')
+                                                             .limit(3)])
+            self.assertEqual([2, 4, 6],
+                             [o.amount for o in Order.objects.filter(status="paid")
+                                                             .order('amount')
+                                                             .limit(3, 1)])
+            self.assertEqual(10, Order.objects.filter(status="open").count())
+            self.assertEqual({'open': 10, 'paid': 10},
+                             Order.objects.count_by('status'))
+            self.assertEqual(["c0", "c1", "c2"], Order.objects.distinct('customer'))
+            r = Order.objects.aggregate(total=Sum('amount'), peak=Max('amount'))
+            self.assertEqual((190.0, 19.0), (r['total'], r['peak']))
+            self.assertEqual([(0, 10, 10), (10, 20, 10)],
+                             Order.objects.histogram('amount', [0, 10, 20]))
+
+            order = Order.objects.get_by_id(8)
+            self.assertEqual(7, order.amount)
+            self.assertTrue(order.db.exists("Order:8"))
+            self.assertEqual(7, Order.objects.filter(customer="c1")
+                                             .get_by_id(8).amount)
+            self.assertEqual(None, Order.objects.filter(customer="c0")
+                                                .get_by_id(8))
+            self.assertTrue(Order.exists(8))
+            order.status = "paid"
+            self.assertTrue(order.save())
+            self.assertEqual(11, Order.objects.filter(status="paid").count())
+            self.assertEqual(9, Order.objects.filter(status="open").update(
+                status="void"))
+            self.assertEqual(9, Order.objects.filter(status="void").delete())
+            self.assertEqual(11, Order.objects.all().count())
+            self.assertRaises(TypeError, getattr, Order.objects.all(), 'db')
+
+            for user, page in [("ann", "a"), ("bob", "b"), ("ann", "c")]:
+                Visit.objects.create(user=user, page=page)
+            visits = Visit.objects.filter(user="ann")
+            self.assertEqual(["a", "c"], [v.page for v in visits])
+            self.assertEqual(1, len(set(v.db.connection_pool.connection_kwargs['db']
+                                        for v in visits)))
+            visit = Visit.objects.get_by_id(2)
+            self.assertEqual("bob", visit.user)
+            self.assertTrue(Visit._find_shard(2) is
+                            Visit._shards.get_node("bob"))
+            self.assertEqual(None, Visit._find_shard(4))
+            visit.user = "ann"
+            if visit.db is not Visit._shards.get_node("ann"):
+                self.assertRaises(ValueError, visit.save)
+            self.assertRaises(ValueError, Visit.objects.all().update, user="eve")
+            Visit.objects.get_by_id(1).delete()
+            Visit.objects.filter(user="bob").delete()
+            ann = Visit._shards.name_of(Visit._shards.get_node("ann"))
+            self.assertEqual({"3": ann}, nodes[0].hgetall("Visit:_shards"))
+
+            titles = ["redis", "redis redis redis", "python", "redis redis"]
+            posts = [Post.objects.create(title=t) for t in titles]
+            self.assertEqual([posts[1].id, posts[3].id, posts[0].id],
+                             [p.id for p in Post.objects.search("redis")])
+            self.assertEqual([posts[1].id],
+                             [p.id for p in Post.objects.search("redis")
+                                                        .limit(1)])
+        finally:
+            clear()
 
 class Event(models.Model):
     name = models.CharField(required=True)
@@ -983,3 +1954,70 @@ class MutexTestCase(RediscoTestCase):
         Mutex(self.p1).lock()
         with Mutex(self.p2):
             self.assert_(True)
+
+
+class ClusterTestCase(unittest.TestCase):
+    """
+    Runs on the Redis Cluster a node of which listens on
+    REDIS_CLUSTER_PORT. WARNING: the cluster is flushed.
+    """
+    def setUp(self):
+        if not os.environ.get('REDIS_CLUSTER_PORT'):
+            self.skipTest("REDIS_CLUSTER_PORT is not set.")
+        self.settings = redisco.client.connection_settings
+        redisco.client.connection_settings = {}
+        redisco.connection_setup(host="localhost", cluster=True,
+                                 port=int(os.environ['REDIS_CLUSTER_PORT']))
+        self.client = redisco.get_client()
+        self.client.flushdb()
+
+    def tearDown(self):
+        self.client.flushdb()
+        redisco.client.connection_settings = self.settings
+        redisco.connection_setup()
+
+    def test_models(self):
+        self.assertEqual("{Person}", Person._key)
+
+        class Player(models.Model):
+            name = models.Attribute()
+            score = models.IntegerField()
+            tags = models.ListField(str)
+            wins = models.Counter()
+
+        a = Player.objects.create(name="a", score=10, tags=["x", "y"])
+        b = Player.objects.create(name="b", score=20, tags=["y"])
+        self.assertTrue(self.client.exists("{Player}:%s" % a.id))
+        a.score = 30
+        a.save()
+        a.incr('wins')
+        ids = lambda q: [p.id for p in q]
+        self.assertEqual([b.id, a.id], ids(Player.objects.order('score')))
+        self.assertEqual([a.id], ids(Player.objects.zfilter(score__gt=20)))
+        self.assertEqual([a.id, b.id],
+                         ids(Player.objects.filter(tags="y").order('name')))
+        self.assertEqual(1, Player.objects.get_by_id(a.id).wins)
+        b.delete()
+        self.assertEqual([a.id], ids(Player.objects.filter(tags="y")))
+        self.assertEqual([('a', 1.0)],
+                         self.client.zrange('{Player}:_values:name', 0, -1,
+                                            withscores=True))
+
+    def test_containers(self):
+        from redisco.containers import List, SortedSet
+
+        scores = SortedSet('{c}:scores')
+        scores.add('a', 10)
+        scores.add({'b': 20, 'c': 5})
+        self.assertEqual(['c', 'a', 'b'], scores.members)
+        scores.zincrby('c', 20)
+        self.assertEqual(25, scores.score('c'))
+
+        l = List('{c}:list')
+        l.extend(['a', 'b', 'a'])
+        self.assertEqual(1, l.remove('a'))
+        self.assertEqual(['b', 'a'], l.members)
+        self.assertEqual('a', l.pop())
+        self.client.setex('{c}:expiring', 'v', 100)
+        self.assertEqual('v', self.client.get('{c}:expiring'))
+        self.assertTrue(0 < self.client.ttl('{c}:expiring') <= 100)
@@ -0,0 +1,618 @@
+"""
+Maintenance of the indices of the models.
+"""
+import re
+import time
+import threading
+import redisco
+from redisco.pipelining import resolve
+from .attributes import Counter
+from .exceptions import AttributeNotIndexed
+
+
+def rebuild_indices(model_class, fields=None, batch_size=1000, processes=None):
+    """
+    Indexes the objects of ``model_class`` that are missing from their
+    indices, ie: after ``indexed=True`` or a ``Meta.indices`` entry was
+    added to a model that already has objects.
+
+    The ids are streamed with ``SSCAN`` over the set of all the objects.
+    For every batch, the needed fields are read with ``HMGET`` in a
+    single pipeline and the index entries are written in another one.
+    Entries that already exist are left untouched so the reference
+    counts of the indexed values stay right when it is run twice.
+
+    :param fields: the names of the indices to rebuild, all of them when
+                   None.
+    :param batch_size: the number of objects handled per round trip.
+    :param processes: when set, the batches are dispatched to a pool of
+                      that many processes. The model class has to be
+                      importable from its module.
+    :returns: the number of objects visited.
+
+    >>> from redisco import models
+    >>> class Foo(models.Model):
+    ...     name = models.Attribute(indexed=False)
+    ...     class Meta:
+    ...         key = 'Foo'
+    ...
+    >>> Foo(name="Einstein").save()
+    True
+    >>> class Bar(models.Model):
+    ...     name = models.Attribute()
+    ...     class Meta:
+    ...         key = 'Foo'
+    ...
+    >>> len(Bar.objects.filter(name="Einstein"))
+    0
+    >>> Bar.objects.rebuild_indices()
+    1
+    >>> len(Bar.objects.filter(name="Einstein"))
+    1
+    >>> [f.delete() for f in Bar.objects.all()] # doctest: +ELLIPSIS
+    [...]
+    """
+    plan = _plan(model_class, fields)
+    if processes:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes, initializer=_init_worker)
+        try:
+            counts = pool.imap_unordered(
+                    _rebuild_batch_in_worker,
+                    ((model_class, plan, ids) for ids in
+                     _scan_ids(model_class, batch_size)))
+            return sum(counts)
+        finally:
+            pool.close()
+            pool.join()
+    return sum(_rebuild_batch(model_class, plan, ids)
+               for ids in _scan_ids(model_class, batch_size))
+
+
+def _plan(model_class, fields):
+    """
+    Returns what has to be rebuilt as a dict of lists: the ``indices``,
+    ``compound`` indices, ``lex`` and ``fulltext`` indices, and the
+    ``attributes`` and ``lists`` to read to compute them.
+    """
+    known = (set(model_class._indices) | set(model_class._lex_indices) |
+             set(model_class._fulltext_indices))
+    for fields_ in model_class._compound_indices:
+        known.update(fields_)
+    if fields is None:
+        fields = known
+    else:
+        for field in fields:
+            if field not in known:
+                raise AttributeNotIndexed(
+                        "Attribute %s is not indexed in %s class." %
+                        (field, model_class.__name__))
+    plan = {
+        'indices': [f for f in model_class._indices if f in fields],
+        'compound': [c for c in model_class._compound_indices
+                     if set(c) & set(fields)],
+        'lex': [f for f in model_class._lex_indices if f in fields],
+        'fulltext': [f for f in model_class._fulltext_indices if f in fields],
+    }
+    needed = set(plan['lex']) | set(plan['fulltext'])
+    for fields_ in plan['compound']:
+        needed.update(fields_)
+    plan['lists'] = [a for a in plan['indices'] if a in model_class._lists]
+    for att in plan['indices']:
+        if att in model_class._lists:
+            continue
+        if att not in model_class._attributes:
+            # an index on a method or a property may use any attribute
+            needed.update(model_class._attributes)
+            break
+        needed.add(att)
+    plan['attributes'] = sorted(a for a in needed
+                                if a in model_class._attributes)
+    return plan
+
+
+def _scan_ids(model_class, batch_size):
+    """Yields the ids of all the objects, ``batch_size`` at a time."""
+    db = model_class._meta['db'] or redisco.get_client()
+    cursor, batch = 0, set()
+    while True:
+        cursor, ids = db.sscan(model_class._key['all'], cursor,
+                               count=batch_size)
+        batch.update(ids)
+        if len(batch) >= batch_size:
+            yield list(batch)
+            batch = set()
+        if not int(cursor):
+            break
+    if batch:
+        yield list(batch)
+
+
+def _init_worker():
+    # the forked workers must not share the connections of the parent
+    redisco.client.disconnect()
+
+
+def _rebuild_batch_in_worker(args):
+    return _rebuild_batch(*args)
+
+
+def _rebuild_batch(model_class, plan, ids):
+    """
+    Writes the missing index entries of the objects ``ids``.
+    """
+    db = model_class._meta['db'] or redisco.get_client()
+    attributes, lists = plan['attributes'], plan['lists']
+    pipe = db.pipeline(transaction=False)
+    for id in ids:
+        key = model_class._key[id]
+        if attributes:
+            pipe.hmget(key, attributes)
+        pipe.smembers(key['_indices'])
+        if plan['lex']:
+            pipe.hgetall(key['_lexindices'])
+        for att in lists:
+            pipe.lrange(key[att], 0, -1)
+    results = iter(pipe.execute())
+
+    objects = []
+    for id in ids:
+        values = next(results) if attributes else []
+        existing = set(k.decode('utf-8') for k in next(results))
+        lex = next(results) if plan['lex'] else {}
+        instance = _instance(model_class, id, attributes, values)
+        for att in lists:
+            model_class._lists[att].__set__(instance, next(results))
+        objects.append((instance, existing, lex))
+    _load_lists(model_class, lists, [o[0] for o in objects])
+
+    pipe = db.pipeline(transaction=False)
+    for instance, existing, lex in objects:
+        for att in plan['indices']:
+            index = instance._index_key_for(att)
+            if index is None:
+                continue
+            keys = _index_keys(index)
+            if keys and keys <= existing:
+                continue
+            instance._add_to_index(att, pipeline=pipe)
+        for fields in plan['compound']:
+            instance._add_to_compound_index(fields, pipeline=pipe)
+        for att in plan['lex']:
+            old = lex.get(model_class._lex_index_key(att))
+            if old is not None:
+                pipe.zrem(model_class._lex_index_key(att), old)
+            instance._add_to_lex_index(att, pipeline=pipe)
+        for att in plan['fulltext']:
+            instance._add_to_fulltext_index(att, pipeline=pipe)
+    pipe.execute()
+    return len(ids)
+
+
+def _instance(model_class, id, attributes, values):
+    """
+    Returns an instance of model_class with the given id and values
+    without reading the whole object.
+    """
+    instance = model_class()
+    instance._id = str(id)
+    for att, value in zip(attributes, values):
+        descriptor = model_class._attributes[att]
+        if value is not None and not isinstance(descriptor, Counter):
+            descriptor.__set__(instance, descriptor.typecast_for_read(value))
+    return instance
+
+
+def _load_lists(model_class, lists, instances):
+    """
+    Typecasts the members of the ``lists`` read for ``instances``, as
+    their descriptor does. The objects referenced by the lists of models
+    are looked up within an autopipeline.
+    """
+    for att in lists:
+        descriptor = model_class._lists[att]
+        klass = descriptor.value_type()
+        if not descriptor._redisco_model:
+            for instance in instances:
+                descriptor.__set__(instance,
+                                   [klass(v) for v in getattr(instance, att)])
+            continue
+        with redisco.autopipeline():
+            for instance in instances:
+                descriptor.__set__(instance,
+                                   [klass.objects.get_by_id(v)
+                                    for v in getattr(instance, att)])
+        for instance in instances:
+            descriptor.__set__(instance,
+                               [o for o in map(resolve, getattr(instance, att))
+                                if o is not None])
+
+
+def _index_keys(index):
+    """
+    Returns the set keys, as recorded in the _indices set of an object,
+    of an index tuple returned by ``Model._index_key_for``.
+    """
+    t, index = index
+    if t == 'attribute':
+        return set([index])
+    elif t == 'list':
+        return set(index)
+    elif t == 'sortedset':
+        return set([index[1]])
+    # the GEO index is not recorded in _indices, GEOADD is idempotent
+    return None
+
+
+class IndexChecker(object):
+    """
+    Verifies, and optionally repairs, the indices of a model.
+
+    The check is done in three passes, a batch of ``count`` keys at a
+    time:
+
+    * the objects of ``Model:all`` are scanned. Objects without data,
+      neither a hash nor a list, are ``dangling_objects``. The index entries an object should have but
+      has not are ``missing_entries`` and the ones recorded in its
+      ``_indices`` and ``_zindices`` that it should not have are
+      ``stale_entries``. Repairing reindexes the object, or removes it
+      when it is dangling.
+    * the index sets of the model are scanned. The ids whose object does
+      not record the set in its ``_indices``, including the ids of the
+      objects that do not exist anymore, are ``orphan_ids``. Repairing
+      removes them.
+    * the registry of the values of every indexed attribute is compared
+      with the index sets. Values missing from the registry or counted
+      wrongly are ``registry_mismatches``. Repairing fixes the counts.
+
+    ``cursor`` tells where the check is, so it can be stopped and resumed
+    later by passing it back. ``step`` checks one batch, which allows to
+    throttle the check on a live instance, and ``run`` checks everything.
+
+    >>> from redisco import models
+    >>> class Foo(models.Model):
+    ...     name = models.Attribute()
+    ...
+    >>> f = Foo(name="Einstein")
+    >>> f.save()
+    True
+    >>> _ = f.db.sadd(Foo._key['name']['Edison'], f.id)
+    >>> report = IndexChecker(Foo, repair=True).run()
+    >>> report['orphan_ids'], report['registry_mismatches']
+    (1, 0)
+    >>> len(Foo.objects.filter(name="Edison"))
+    0
+    >>> [f.delete() for f in Foo.objects.all()] # doctest: +ELLIPSIS
+    [...]
+    """
+    REPORT = ('objects', 'dangling_objects', 'missing_entries',
+              'stale_entries', 'repaired_objects', 'index_keys',
+              'orphan_ids', 'registry_mismatches')
+
+    def __init__(self, model_class, count=1000, repair=False, cursor=None):
+        self.model_class = model_class
+        self.count = count
+        self.repair = repair
+        self.cursor = cursor or ('objects', 0)
+        self.report = dict.fromkeys(self.REPORT, 0)
+        self.db = model_class._meta['db'] or redisco.get_client()
+        self._plan = _plan(model_class, None)
+        self._plan['attributes'] = sorted(model_class._attributes)
+
+    def run(self, pause=0):
+        """
+        Checks everything, sleeping ``pause`` seconds between the batches.
+
+        :returns: the report, a dict of counts.
+        """
+        while self.step():
+            if pause:
+                time.sleep(pause)
+        return self.report
+
+    def step(self):
+        """
+        Checks the next batch.
+
+        :returns: False once everything has been checked.
+        """
+        phase, cursor = self.cursor
+        if phase == 'objects':
+            cursor, ids = self.db.sscan(self.model_class._key['all'], cursor,
+                                        count=self.count)
+            self._check_objects(set(ids))
+            self.cursor = ('objects', cursor) if int(cursor) else ('keys', 0)
+        elif phase == 'keys':
+            cursor, keys = self.db.scan(cursor,
+                                        match=self.model_class._key['*'],
+                                        count=self.count)
+            self._check_index_keys(keys)
+            self.cursor = ('keys', cursor) if int(cursor) else ('registry', 0)
+        elif phase == 'registry':
+            if cursor < len(self.model_class._indices):
+                self._check_registry(self.model_class._indices[cursor])
+                self.cursor = ('registry', cursor + 1)
+            else:
+                self.cursor = ('done', 0)
+        return self.cursor[0] != 'done'
+
+    def _expected(self, instance):
+        """
+        Returns the index sets and the sorted sets the instance should
+        be in.
+        """
+        indices, zindices = set(), set()
+        for att in self._plan['indices']:
+            index = instance._index_key_for(att)
+            if index is None:
+                continue
+            t, key = index
+            if t == 'sortedset':
+                zindices.add(key[0])
+            elif t == 'geo':
+                zindices.add(key)
+            indices.update(_index_keys(index) or [])
+        for fields in self._plan['compound']:
+            values = [getattr(instance, att) for att in fields]
+            values = [v() if callable(v) else v for v in values]
+            if None not in values:
+                indices.add(self.model_class._compound_index_key(fields,
+                                                                 values))
+        for att in self._plan['fulltext']:
+            descriptor = self.model_class._attributes[att]
+            for token in descriptor.tokenize(getattr(instance, att)):
+                zindices.add(self.model_class._fulltext_index_key(att, token))
+        return indices, zindices
+
+    def _check_objects(self, ids):
+        model_class = self.model_class
+        attributes, lists = self._plan['attributes'], self._plan['lists']
+        pipe = self.db.pipeline(transaction=False)
+        for id in ids:
+            key = model_class._key[id]
+            pipe.exists(key)
+            pipe.hmget(key, attributes)
+            for att in lists:
+                pipe.lrange(key[att], 0, -1)
+            # the bookkeeping read by Model._fetch_indices, for the repairs
+            pipe.smembers(key['_indices'])
+            pipe.smembers(key['_zindices'])
+            if model_class._lex_indices:
+                pipe.hgetall(key['_lexindices'])
+        results = iter(pipe.execute())
+
+        checks = []
+        for id in ids:
+            exists, values = next(results), next(results)
+            instance = _instance(model_class, id, attributes, values)
+            for att in lists:
+                items = next(results)
+                # an object may have nothing but lists
+                exists = exists or bool(items)
+                model_class._lists[att].__set__(instance, items)
+            bookkeeping = [next(results), next(results)]
+            if model_class._lex_indices:
+                bookkeeping.append(next(results))
+            checks.append((instance, exists, bookkeeping))
+        _load_lists(model_class, lists,
+                    [i for i, exists, _ in checks if exists])
+
+        pipe = self.db.pipeline(transaction=False)
+        counts = []
+        for instance, exists, bookkeeping in checks:
+            if not exists:
+                counts.append(None)
+                continue
+            id = instance.id
+            indices, zindices = self._expected(instance)
+            for index in indices:
+                att, _ = model_class._split_index_key(index)
+                if att in model_class._bitmap_indices:
+                    pipe.getbit(index, int(id))
+                else:
+                    pipe.sismember(index, id)
+            for zindex in zindices:
+                pipe.zscore(zindex, id)
+            recorded = set(k.decode('utf-8') for k in bookkeeping[0])
+            zrecorded = set(k.decode('utf-8') for k in bookkeeping[1])
+            stale = len(recorded - indices) + len(zrecorded - zindices)
+            counts.append(((len(indices), len(zindices)), stale))
+        results = iter(pipe.execute())
+
+        pipe = self.db.pipeline(transaction=False)
+        registries = set()
+        for (instance, exists, bookkeeping), count in zip(checks, counts):
+            self.report['objects'] += 1
+            if count is None:
+                self.report['dangling_objects'] += 1
+                if self.repair:
+                    instance._remove_from_indices(pipe, *bookkeeping,
+                                                  registries=registries)
+                    pipe.srem(model_class._key['all'], instance.id)
+                    self.report['repaired_objects'] += 1
+                continue
+            n, stale = count
+            missing = len([r for r in (next(results) for i in range(n[0]))
+                           if not r])
+            missing += len([r for r in (next(results) for i in range(n[1]))
+                            if r is None])
+            self.report['missing_entries'] += missing
+            self.report['stale_entries'] += stale
+            if self.repair and (missing or stale):
+                instance._remove_from_indices(pipe, *bookkeeping,
+                                              registries=registries)
+                instance._add_to_indices(pipe)
+                self.report['repaired_objects'] += 1
+        for registry in registries:
+            pipe.zremrangebyscore(registry, '-inf', 0)
+        if len(pipe):
+            pipe.execute()
+
+    def _check_index_keys(self, keys):
+        model_class = self.model_class
+        names = set(a for a in model_class._indices
+                    if a not in model_class._bitmap_indices)
+        names.update('+'.join(c) for c in model_class._compound_indices)
+        candidates = []
+        for key in keys:
+            key = key.decode('utf-8')
+            att, value = model_class._split_index_key(key)
+            if att in names and value:
+                candidates.append((key, att, value))
+        pipe = self.db.pipeline(transaction=False)
+        for key, att, value in candidates:
+            pipe.type(key)
+        types = pipe.execute()
+        candidates = [c for c, t in zip(candidates, types) if t == 'set']
+
+        pipe = self.db.pipeline(transaction=False)
+        for key, att, value in candidates:
+            pipe.smembers(key)
+            if att in model_class._indices:
+                pipe.zscore(model_class._values_key(att), value)
+        results = iter(pipe.execute())
+
+        pipe = self.db.pipeline(transaction=False)
+        entries = []
+        for key, att, value in candidates:
+            ids = list(next(results))
+            registered = (next(results) if att in model_class._indices
+                          else None)
+            entries.append((key, att, value, ids, registered))
+            for id in ids:
+                pipe.sismember(model_class._key[id]['_indices'], key)
+        results = iter(pipe.execute())
+
+        pipe = self.db.pipeline(transaction=False)
+        for key, att, value, ids, registered in entries:
+            self.report['index_keys'] += 1
+            orphans = [id for id in ids if not next(results)]
+            self.report['orphan_ids'] += len(orphans)
+            card = len(ids) - len(orphans)
+            # registered values are checked by _check_registry
+            unregistered = (att in model_class._indices and
+                            registered is None and card)
+            if unregistered:
+                self.report['registry_mismatches'] += 1
+            if not self.repair:
+                continue
+            if orphans:
+                pipe.srem(key, *orphans)
+            if unregistered:
+                pipe.zadd(model_class._values_key(att), value, card)
+        if len(pipe):
+            pipe.execute()
+
+    def _check_registry(self, att):
+        model_class = self.model_class
+        registry = model_class._values_key(att)
+        values = self.db.zrange(registry, 0, -1, withscores=True)
+        pipe = self.db.pipeline(transaction=False)
+        for value, score in values:
+            key = model_class._key[att][value.decode('utf-8')]
+            if att in model_class._bitmap_indices:
+                pipe.bitcount(key)
+            else:
+                pipe.scard(key)
+        cards = pipe.execute() if values else []
+
+        pipe = self.db.pipeline(transaction=False)
+        for (value, score), card in zip(values, cards):
+            if int(score) == card:
+                continue
+            self.report['registry_mismatches'] += 1
+            if not self.repair:
+                continue
+            if card:
+                pipe.zadd(registry, value, card)
+            else:
+                pipe.zrem(registry, value)
+        if len(pipe):
+            pipe.execute()
+
+
+def sweep(model_class, count=1000, pause=0):
+    """
+    Removes the ids of deleted objects left in the index sets of
+    ``model_class``, so the sets that end up empty disappear, and drops
+    from the registry the values that are not used anymore.
+
+    It runs the last passes of ``IndexChecker`` in repair mode, a batch
+    of ``count`` keys at a time with ``pause`` seconds in between.
+
+    :returns: the report of the checker.
+    """
+    checker = IndexChecker(model_class, count=count, repair=True,
+                           cursor=('keys', 0))
+    return checker.run(pause)
+
+
+_TEMPORARY_KEY = re.compile(r'(^~|#).*\.\d+$')
+
+
+def sweep_temporary_keys(db=None, count=1000, pause=0):
+    """
+    Sets ``redisco.default_expire_time`` on the temporary keys of the
+    lookups that do not expire, ie: left behind by a process that died
+    before expiring them.
+
+    :returns: the number of keys found without expiration.
+    """
+    db = db or redisco.get_client()
+    found = 0
+    for pattern in ('~*', '*#*'):
+        cursor = 0
+        while True:
+            cursor, keys = db.scan(cursor, match=pattern, count=count)
+            keys = [k for k in keys if _TEMPORARY_KEY.search(k)]
+            pipe = db.pipeline(transaction=False)
+            for key in keys:
+                pipe.ttl(key)
+            ttls = pipe.execute() if keys else []
+            pipe = db.pipeline(transaction=False)
+            for key, ttl in zip(keys, ttls):
+                if ttl is None or ttl == -1:
+                    pipe.expire(key, redisco.default_expire_time)
+                    found += 1
+            if len(pipe):
+                pipe.execute()
+            if not int(cursor):
+                break
+            if pause:
+                time.sleep(pause)
+    return found
+
+
+class Sweeper(threading.Thread):
+    """
+    Background thread that sweeps the temporary keys and the indices of
+    ``models`` every ``interval`` seconds.
+
+    Example::
+
+        sweeper = Sweeper([Person, Event], interval=600, pause=0.1)
+        sweeper.start()
+        ...
+        sweeper.stop()
+    """
+    def __init__(self, models, interval=300, count=1000, pause=0):
+        super(Sweeper, self).__init__()
+        self.daemon = True
+        self.models = models
+        self.interval = interval
+        self.count = count
+        self.pause = pause
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            self.sweep()
+            self._stopped.wait(self.interval)
+
+    def sweep(self):
+        sweep_temporary_keys(count=self.count, pause=self.pause)
+        for model_class in self.models:
+            sweep(model_class, count=self.count, pause=self.pause)
+
+    def stop(self):
+        self._stopped.set()
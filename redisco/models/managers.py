@@ -1,4 +1,5 @@
-from .modelset import ModelSet
+from .modelset import ModelSet, ShardedModelSet
+from .maintenance import rebuild_indices, IndexChecker
 
 ############
 # Managers #
@@ -20,6 +21,8 @@ class Manager(object):
         self.model_class = model_class
 
     def get_model_set(self):
+        if self.model_class._shards is not None:
+            return ShardedModelSet(self.model_class)
         return ModelSet(self.model_class)
 
     def all(self):
@@ -31,11 +34,11 @@ class Manager(object):
     def get_or_create(self, **kwargs):
         return self.get_model_set().get_or_create(**kwargs)
 
-    def filter(self, **kwargs):
-        return self.get_model_set().filter(**kwargs)
+    def filter(self, *args, **kwargs):
+        return self.get_model_set().filter(*args, **kwargs)
 
-    def exclude(self, **kwargs):
-        return self.get_model_set().exclude(**kwargs)
+    def exclude(self, *args, **kwargs):
+        return self.get_model_set().exclude(*args, **kwargs)
 
     def get_by_id(self, id):
         return self.get_model_set().get_by_id(id)
@@ -43,7 +46,34 @@ class Manager(object):
     def order(self, field):
         return self.get_model_set().order(field)
 
+    def primary(self):
+        return self.get_model_set().primary()
+
     def zfilter(self, **kwargs):
         return self.get_model_set().zfilter(**kwargs)
 
+    def search(self, terms, operator='and'):
+        return self.get_model_set().search(terms, operator)
+
+    def aggregate(self, **kwargs):
+        return self.get_model_set().aggregate(**kwargs)
+
+    def histogram(self, field, buckets):
+        return self.get_model_set().histogram(field, buckets)
+
+    def count_by(self, field):
+        return self.get_model_set().count_by(field)
+
+    def distinct(self, field):
+        return self.get_model_set().distinct(field)
+
+    def bulk_delete(self, ids):
+        return self.get_model_set()._delete_ids(list(ids))
+
+    def rebuild_indices(self, fields=None, batch_size=1000, processes=None):
+        return rebuild_indices(self.model_class, fields=fields,
+                               batch_size=batch_size, processes=processes)
 
+    def check_indices(self, repair=False, count=1000, pause=0):
+        return IndexChecker(self.model_class, count=count,
+                            repair=repair).run(pause)
@@ -2,13 +2,47 @@
 Handles the queries.
 """
 from .attributes import IntegerField, DateTimeField
+from redis.exceptions import ResponseError
 import redisco
+from redisco.pipelining import AutoPipeline, pipelined
 from redisco.containers import SortedSet, Set, List, NonPersistentList
 from .exceptions import AttributeNotIndexed
-from .attributes import ZINDEXABLE
+from .attributes import ZINDEXABLE, GeoField, Counter
+from .query import Q
+from .maintenance import _instance, _index_keys
+from .scripts import ZSTATS, LEXRANGESTORE, LEXSORTSTORE, GEOSEARCHSETSTORE, \
+        BITMAPSTORE
 
 # Model Set
+def _has_intercard(db):
+    """
+    Tells if the server of ``db`` has ``SINTERCARD`` and ``ZINTERCARD``,
+    which came with Redis 7.0. The answer is remembered by the client.
+    """
+    if isinstance(db, AutoPipeline):
+        db = db.client
+    has = getattr(db, '_has_intercard', None)
+    if has is None:
+        version = db.info().get('redis_version', '0')
+        has = db._has_intercard = int(str(version).split('.')[0]) >= 7
+    return has
+
+
 class ModelSet(Set):
+    LOOKUPS = ('in', 'startswith', 'lt', 'lte', 'gt', 'gte', 'near', 'box')
+    LEX_LOOKUPS = ('startswith', 'lt', 'lte', 'gt', 'gte')
+    GEO_LOOKUPS = ('near', 'box')
+    AGGREGATE_CHUNK_SIZE = 1000
+    # Delete the intermediate keys of a lookup as soon as its result is
+    # stored instead of letting them expire.
+    DELETE_TEMPORARY_KEYS = True
+    BULK_CHUNK_SIZE = 1000
+    # Number of objects read in one pipeline while iterating.
+    FETCH_CHUNK_SIZE = 100
+    # A filtered set ordered on a lexicographic index is sorted with SORT
+    # when the index is this many times larger.
+    LEX_SORT_RATIO = 10
+
     def __init__(self, model_class):
         self.model_class = model_class
         self.key = model_class._key['all']
@@ -17,10 +51,16 @@ class ModelSet(Set):
         self._db = model_class._meta['db'] or redisco.get_client()
         self._filters = {}
         self._exclusions = {}
+        self._qfilters = []
+        self._qexclusions = []
         self._zfilters = []
+        self._search = None
         self._ordering = []
         self._limit = None
         self._offset = None
+        self._expire_time = None
+        self._temporary_keys = set()
+        self._use_primary = False
 
     #################
     # MAGIC METHODS #
@@ -31,7 +71,7 @@ class ModelSet(Set):
         Will look in _set to get the id and simply return the instance of the model.
         """
         if isinstance(index, slice):
-            return map(lambda id: self._get_item_with_id(id), self._set[index])
+            return self._get_items_with_ids(self._set[index])
         else:
             id = self._set[index]
             if id:
@@ -44,19 +84,28 @@ class ModelSet(Set):
             m = self._set[:30]
         else:
             m = self._set
-        s = map(lambda id: self._get_item_with_id(id), m)
+        s = self._get_items_with_ids(m)
         return "%s" % s
 
     def __iter__(self):
-        for id in self._set:
-            yield self._get_item_with_id(id)
+        ids = list(self._set)
+        for start in xrange(0, len(ids), self.FETCH_CHUNK_SIZE):
+            for instance in self._get_items_with_ids(
+                    ids[start:start + self.FETCH_CHUNK_SIZE]):
+                yield instance
 
     def __len__(self):
-        return len(self._set)
+        return self.count()
 
     def __contains__(self, val):
         return val.id in self._set
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
     ##########################################
     # METHODS THAT RETURN A SET OF INSTANCES #
     ##########################################
@@ -80,10 +129,25 @@ class ModelSet(Set):
         >>> [f.delete() for f in Foo.objects.all()] # doctest: +ELLIPSIS
         [...]
         """
-        if (self._filters or self._exclusions or self._zfilters) and str(id) not in self._set:
+        if (self._filters or self._exclusions or self._zfilters or
+                self._qfilters or self._qexclusions or self._search) and \
+                str(id) not in self._set:
             return
-        if self.model_class.exists(id):
-            return self._get_item_with_id(id)
+        id = str(id)
+        key = self.model_class._key[id]
+
+        def instance(exists, member, stored_attrs):
+            if not (exists or member):
+                return None
+            instance = self.model_class()
+            instance._id = id
+            instance._load(stored_attrs)
+            return instance
+        # Within redisco.autopipeline() the lookups of several ids are
+        # sent together and the instance is a LazyResult.
+        return pipelined(self._read_db, [('exists', (key,)),
+                                    ('sismember', (self.model_class._key['all'], id)),
+                                    ('hgetall', (key,))], instance)
 
     def first(self):
         """
@@ -114,10 +178,14 @@ class ModelSet(Set):
     # METHODS THAT MODIFY THE MODEL SET #
     #####################################
 
-    def filter(self, **kwargs):
+    def filter(self, *args, **kwargs):
         """
         Filter a collection on criteria
 
+        Besides equality, a field can be matched against several values
+        with ``field__in=[...]`` and ``Q`` objects (see
+        :class:`redisco.models.query.Q`) can be passed to OR lookups.
+
         >>> from redisco import models
         >>> class Foo(models.Model):
         ...     name = models.Attribute()
@@ -135,11 +203,13 @@ class ModelSet(Set):
         if not clone._filters:
             clone._filters = {}
         clone._filters.update(kwargs)
+        clone._qfilters.extend(args)
         return clone
 
-    def exclude(self, **kwargs):
+    def exclude(self, *args, **kwargs):
         """
-        Exclude a collection within a lookup.
+        Exclude a collection within a lookup. It accepts the same lookups
+        as ``filter``.
 
 
         >>> from redisco import models
@@ -160,6 +230,42 @@ class ModelSet(Set):
         if not clone._exclusions:
             clone._exclusions = {}
         clone._exclusions.update(kwargs)
+        clone._qexclusions.extend(args)
+        return clone
+
+    def search(self, terms, operator='and'):
+        """
+        Restricts the collection to the objects whose full-text indexed
+        attributes contain the words of ``terms``: all of them when
+        ``operator`` is ``'and'``, any of them when it is ``'or'``.
+
+        The word sets are combined by Redis with ``ZINTERSTORE`` or
+        ``ZUNIONSTORE`` and, unless the collection is ordered, the
+        objects come out by decreasing number of occurrences of the words.
+
+        >>> from redisco import models
+        >>> class Foo(models.Model):
+        ...    body = models.Attribute(fulltext=True)
+        ...
+        >>> Foo(body="The quick brown fox").save()
+        True
+        >>> Foo(body="A fox, a fox and a fox").save()
+        True
+        >>> [f.body for f in Foo.objects.search("fox")]
+        [u'A fox, a fox and a fox', u'The quick brown fox']
+        >>> [f.body for f in Foo.objects.search("quick fox")]
+        [u'The quick brown fox']
+        >>> [f.delete() for f in Foo.objects.all()] # doctest: +ELLIPSIS
+        [...]
+        """
+        if operator not in ('and', 'or'):
+            raise ValueError("operator should be 'and' or 'or'.")
+        if not self.model_class._fulltext_indices:
+            raise AttributeNotIndexed(
+                    "%s class has no full-text indexed attribute." %
+                    self.model_class.__name__)
+        clone = self._clone()
+        clone._search = (terms, operator)
         return clone
 
     def zfilter(self, **kwargs):
@@ -193,7 +299,8 @@ class ModelSet(Set):
         [...]
         """
         fname = field.lstrip('-')
-        if fname not in self.model_class._indices:
+        if (fname not in self.model_class._indices and
+                fname not in self.model_class._lex_indices):
             raise ValueError("Order parameter should be an indexed attribute.")
         alpha = True
         if fname in self.model_class._attributes:
@@ -214,6 +321,50 @@ class ModelSet(Set):
         clone._offset = offset
         return clone
 
+    def primary(self):
+        """
+        Read the collection from the primary even if replicas are
+        configured, to see the writes the replicas may not have received
+        yet.
+        """
+        clone = self._clone()
+        clone._use_primary = True
+        return clone
+
+    def expire(self, seconds):
+        """
+        Keep the result of the lookup in Redis for *seconds* instead of
+        ``redisco.default_expire_time``.
+        """
+        clone = self._clone()
+        clone._expire_time = seconds
+        return clone
+
+    def release(self):
+        """
+        Delete the result of the lookup from Redis. It is looked up again
+        if the collection is used afterwards. The collection can also be
+        used as a context manager to release it when leaving the block.
+
+        >>> from redisco import models
+        >>> class Foo(models.Model):
+        ...     name = models.Attribute()
+        ...
+        >>> Foo(name="Einstein").save()
+        True
+        >>> with Foo.objects.filter(name="Einstein") as foos:
+        ...     foos[0].name
+        u'Einstein'
+        >>> [f.delete() for f in Foo.objects.all()] # doctest: +ELLIPSIS
+        [...]
+        """
+        self._delete_temporary_keys()
+        if hasattr(self, '_cached_set'):
+            key = getattr(self._cached_set, 'key', self.key)
+            if key != self.key:
+                self.db.delete(key)
+            del self._cached_set
+
     def create(self, **kwargs):
         """
         Create an object of the class.
@@ -241,6 +392,81 @@ class ModelSet(Set):
         """
         return self._clone()
 
+    def delete(self):
+        """
+        Deletes the objects of the collection, ``BULK_CHUNK_SIZE`` at a
+        time. For each chunk the bookkeeping of the indices of all the
+        objects is read in one pipeline and everything is removed in a
+        second one. Like ``Model.delete``, it skips the validations and
+        the locks.
+
+        :returns: the number of deleted objects.
+
+        >>> from redisco import models
+        >>> class Foo(models.Model):
+        ...     name = models.Attribute()
+        ...
+        >>> [Foo(name=n).save() for n in ("Einstein", "Edison", "Tesla")]
+        [True, True, True]
+        >>> Foo.objects.exclude(name="Tesla").delete()
+        2
+        >>> [f.name for f in Foo.objects.all()]
+        [u'Tesla']
+        >>> [f.delete() for f in Foo.objects.all()] # doctest: +ELLIPSIS
+        [...]
+        """
+        # the ids to delete are read from the primary
+        collection = self.primary()
+        deleted = self._delete_ids(collection._set)
+        collection.release()
+        self.release()
+        return deleted
+
+    def update(self, **kwargs):
+        """
+        Sets the attributes given as keyword arguments on all the objects
+        of the collection, ``BULK_CHUNK_SIZE`` at a time. For each chunk
+        the current values are read in one pipeline, then the hash fields
+        are rewritten and the ids moved between the index sets in a
+        second one, keeping the bookkeeping of the indices and the
+        registry of the values right.
+
+        The objects are neither loaded, validated nor locked.
+
+        :returns: the number of updated objects.
+
+        >>> from redisco import models
+        >>> class Foo(models.Model):
+        ...     name = models.Attribute()
+        ...     status = models.Attribute()
+        ...
+        >>> [Foo(name=n, status="open").save() for n in ("Einstein", "Tesla")]
+        [True, True]
+        >>> Foo.objects.filter(name="Tesla").update(status="archived")
+        1
+        >>> Foo.objects.count_by('status') == {'open': 1, 'archived': 1}
+        True
+        >>> [f.delete() for f in Foo.objects.all()] # doctest: +ELLIPSIS
+        [...]
+        """
+        for att in kwargs:
+            descriptor = self.model_class._attributes.get(att)
+            if descriptor is None:
+                raise AttributeError("%s is not an attribute of %s." %
+                                     (att, self.model_class.__name__))
+            if isinstance(descriptor, Counter) or descriptor.unique:
+                raise ValueError("%s cannot be updated in bulk." % att)
+        # the ids to update are read from the primary
+        collection = self.primary()
+        ids = collection._set
+        updated = 0
+        for start in xrange(0, len(ids), self.BULK_CHUNK_SIZE):
+            updated += self._update_chunk(
+                    ids[start:start + self.BULK_CHUNK_SIZE], kwargs)
+        collection.release()
+        self.release()
+        return updated
+
     def get_or_create(self, **kwargs):
         """
         Return an element of the collection or create it if necessary.
@@ -266,12 +492,257 @@ class ModelSet(Set):
         else:
             return self.create(**kwargs)
 
-    #
+    ####################################
+    # METHODS THAT RETURN NUMBERS ONLY #
+    ####################################
+
+    def count(self):
+        """
+        Returns the number of objects in the collection.
+
+        When the collection is only filtered and excluded on attributes
+        with a bitmap index, the count is done by Redis with ``BITOP``
+        and ``BITCOUNT`` without building any set of ids.
+
+        >>> from redisco import models
+        >>> class Foo(models.Model):
+        ...     active = models.BooleanField(bitmap=True)
+        ...     status = models.Attribute(bitmap=True)
+        ...
+        >>> [Foo(active=a, status=s).save() for a, s in
+        ...  ((True, "open"), (True, "paid"), (False, "open"))]
+        [True, True, True]
+        >>> Foo.objects.filter(active=True).count()
+        2
+        >>> Foo.objects.filter(active=True).exclude(status="paid").count()
+        1
+        >>> [f.delete() for f in Foo.objects.all()] # doctest: +ELLIPSIS
+        [...]
+        """
+        if not hasattr(self, '_cached_set'):
+            bitmaps = self._bitmap_lookups()
+            if bitmaps is not None:
+                return self._bitmap_count(*bitmaps)
+            db = self._read_db
+            if db is not self._db:
+                count = self._read_count(db)
+                if count is not None:
+                    return count
+        return len(self._set)
+
+    def aggregate(self, **kwargs):
+        """
+        Compute aggregations over numeric indexed attributes of the
+        collection. The values are read from the sorted set index of each
+        field by Redis, no instance is loaded. Limits and ordering are
+        ignored.
+
+        :param kwargs: name of the result => ``Count``, ``Sum``, ``Avg``,
+                       ``Min`` or ``Max`` instance.
+        :returns: a dict with the same keys and the computed values.
+
+        >>> from redisco import models
+        >>> from redisco.models.aggregates import Sum, Max
+        >>> class Foo(models.Model):
+        ...     amount = models.IntegerField()
+        ...
+        >>> Foo(amount=10).save()
+        True
+        >>> Foo(amount=32).save()
+        True
+        >>> r = Foo.objects.aggregate(total=Sum('amount'), peak=Max('amount'))
+        >>> r['total'], r['peak']
+        (42.0, 32.0)
+        >>> [f.delete() for f in Foo.objects.all()] # doctest: +ELLIPSIS
+        [...]
+        """
+        stats = self._stats(list(set(a.field for a in kwargs.values())))
+        return dict((name, a.resolve(stats[a.field]))
+                    for name, a in kwargs.iteritems())
+
+    def _stats(self, fields):
+        """
+        Returns a dict field => ``count``, ``sum``, ``min`` and ``max`` of
+        the values of the numeric indexed ``fields`` in the collection.
+        """
+        zkeys = [self._zindex_key(f) for f in fields]
+        s = self._build_set()
+        pipe = self.db.pipeline(transaction=False)
+        positions = []
+        for field, zkey in zip(fields, zkeys):
+            source = self._zindex_for_set(zkey, s, pipe)
+            positions.append(len(pipe))
+            ZSTATS(pipe, keys=[source], args=[self.AGGREGATE_CHUNK_SIZE])
+            if source != zkey:
+                pipe.delete(source)
+        self._delete_temporary_keys(pipe)
+        results = pipe.execute()
+        stats = {}
+        for field, r in zip(fields, [results[i] for i in positions]):
+            stats[field] = {'count': int(r[0]), 'sum': 0.0,
+                            'min': None, 'max': None}
+            if stats[field]['count']:
+                stats[field].update({'sum': float(r[1]),
+                                     'min': float(r[2]),
+                                     'max': float(r[3])})
+        return stats
+
+    def histogram(self, field, buckets):
+        """
+        Count the objects of the collection in each bucket of the values
+        of a numeric indexed attribute. The counts are done by Redis on the
+        sorted set index of the field.
+
+        :param field: the name of the attribute.
+        :param buckets: the sorted edges of the buckets. Each bucket
+                        includes its lower edge, the last one also
+                        includes its upper edge.
+        :returns: a list of ``(low, high, count)`` tuples.
+
+        >>> from redisco import models
+        >>> class Foo(models.Model):
+        ...     amount = models.IntegerField()
+        ...
+        >>> [Foo(amount=a).save() for a in (1, 5, 10, 20)]
+        [True, True, True, True]
+        >>> Foo.objects.histogram('amount', [0, 10, 20])
+        [(0, 10, 2), (10, 20, 2)]
+        >>> [f.delete() for f in Foo.objects.all()] # doctest: +ELLIPSIS
+        [...]
+        """
+        zkey = self._zindex_key(field)
+        desc = self.model_class._attributes[field]
+        edges = [float(desc.typecast_for_storage(b)) for b in buckets]
+        s = self._build_set()
+        pipe = self.db.pipeline(transaction=False)
+        source = self._zindex_for_set(zkey, s, pipe)
+        n = len(pipe)
+        for i in range(len(edges) - 1):
+            high = "%f" % edges[i + 1]
+            if i < len(edges) - 2:
+                high = "(" + high
+            pipe.zcount(source, "%f" % edges[i], high)
+        if source != zkey:
+            pipe.delete(source)
+        self._delete_temporary_keys(pipe)
+        counts = pipe.execute()[n:n + len(edges) - 1]
+        return [(buckets[i], buckets[i + 1], int(counts[i]))
+                for i in range(len(counts))]
+
+    def count_by(self, field):
+        """
+        Count the objects of the collection for each value of an indexed
+        attribute. The values are read from the registry maintained when
+        saving and deleting the objects and every count is done by Redis in a single
+        pipeline (``SINTERCARD`` when the collection is filtered, or a
+        temporary intersection before Redis 7.0).
+        Limits and ordering are ignored.
+
+        :param field: the name of the indexed attribute.
+        :returns: a dict value => count. Values without objects are
+                  omitted.
+
+        >>> from redisco import models
+        >>> class Foo(models.Model):
+        ...     status = models.Attribute()
+        ...
+        >>> [Foo(status=s).save() for s in ("open", "open", "paid")]
+        [True, True, True]
+        >>> Foo.objects.count_by('status') == {'open': 2, 'paid': 1}
+        True
+        >>> [f.delete() for f in Foo.objects.all()] # doctest: +ELLIPSIS
+        [...]
+        """
+        if field not in self.model_class._indices:
+            raise AttributeNotIndexed(
+                    "Attribute %s is not indexed in %s class." %
+                    (field, self.model_class.__name__))
+        values = self.db.zrange(self.model_class._values_key(field), 0, -1)
+        if not values:
+            return {}
+        s = self._build_set()
+        index = self.model_class._key[field]
+        bitmap = field in self.model_class._bitmap_indices
+        intercard = s.key != self.key and _has_intercard(self.db)
+        pipe = self.db.pipeline(transaction=False)
+        # the positions of the counts among the replies
+        positions = []
+        for value in values:
+            key = index[value.decode('utf-8')]
+            if bitmap and s.key == self.key:
+                positions.append(len(pipe))
+                pipe.bitcount(key)
+                continue
+            elif bitmap:
+                key = self._materialize_bitmaps([key], pipe)
+            if s.key == self.key:
+                positions.append(len(pipe))
+                pipe.scard(key)
+            elif intercard:
+                positions.append(len(pipe))
+                pipe.execute_command(
+                        'ZINTERCARD' if self._search else 'SINTERCARD',
+                        2, s.key, key)
+            else:
+                # Redis older than 7.0: the intersection is stored
+                new_key = self._temporary_key("~(%s&%s)" % (s.key, key))
+                if self._search:
+                    pipe.zinterstore(new_key, [s.key, key])
+                else:
+                    pipe.sinterstore(new_key, [s.key, key])
+                pipe.expire(new_key, redisco.default_expire_time)
+                positions.append(len(pipe))
+                if self._search:
+                    pipe.zcard(new_key)
+                else:
+                    pipe.scard(new_key)
+        self._delete_temporary_keys(pipe)
+        replies = pipe.execute()
+        counts = [replies[p] for p in positions]
+        values = self._typecast_values(field, values)
+        return dict((v, c) for v, c in zip(values, counts) if c)
+
+    def distinct(self, field):
+        """
+        Returns the values of an indexed attribute in the collection.
+        Without any lookup this is a single read of the registry of the
+        values of the attribute.
+
+        >>> from redisco import models
+        >>> class Foo(models.Model):
+        ...     status = models.Attribute()
+        ...
+        >>> [Foo(status=s).save() for s in ("open", "open", "paid")]
+        [True, True, True]
+        >>> sorted(Foo.objects.distinct('status'))
+        [u'open', u'paid']
+        >>> [f.delete() for f in Foo.objects.all()] # doctest: +ELLIPSIS
+        [...]
+        """
+        if (self._filters or self._exclusions or self._zfilters or
+                self._qfilters or self._qexclusions or self._search):
+            return self.count_by(field).keys()
+        if field not in self.model_class._indices:
+            raise AttributeNotIndexed(
+                    "Attribute %s is not indexed in %s class." %
+                    (field, self.model_class.__name__))
+        values = self.db.zrange(self.model_class._values_key(field), 0, -1)
+        return self._typecast_values(field, values)
 
     @property
     def db(self):
         return self._db
 
+    @property
+    def _read_db(self):
+        """
+        The client the ids and the objects are read from: a replica when
+        some are configured, unless ``primary`` was called.
+        """
+        if self._use_primary or self.model_class._meta['db']:
+            return self._db
+        return redisco.get_read_client()
+
     ###################
     # PRIVATE METHODS #
     ###################
@@ -283,19 +754,160 @@ class ModelSet(Set):
         filtered and ordered. This set is build hen we first access
         it and is cached for has long has the ModelSet exist.
         """
-        # For performance reasons, only one zfilter is allowed.
         if hasattr(self, '_cached_set'):
             return self._cached_set
-        s = Set(self.key)
+        db = self._read_db
+        if db is not self._db:
+            ids = self._read_ids(db)
+            if ids is not None:
+                self._cached_set = ids
+                return ids
+        s = self._build_set()
+        n = self._order(s.key)
+        self._delete_temporary_keys()
+        self._cached_set = n
+        return self._cached_set
+
+    def _read_ids(self, db):
+        """
+        Returns the list of the ids of the collection read without storing
+        any key, so that a replica can answer, or None if the lookups need
+        temporary keys. Only equality and ``__in`` lookups on set indices
+        qualify, with an ordering if there is no lookup at all.
+        """
+        lookups = self._read_lookup_keys()
+        if lookups is None:
+            return None
+        keys, excluded = lookups
+        if [] in keys:
+            # an __in lookup without any value matches nothing
+            return []
+        num, start = self._get_limit_and_offset()
+        if self._ordering:
+            if keys or excluded:
+                return None
+            return self._read_sorted_ids(db, start, num)
+        pipe = db.pipeline(transaction=False)
+        single = [k[0] for k in keys if len(k) == 1]
+        unions = [k for k in keys if len(k) > 1]
+        if single:
+            pipe.sinter(single)
+        elif not unions:
+            pipe.smembers(self.key)
+        for k in unions:
+            pipe.sunion(k)
+        if excluded:
+            pipe.sunion(sum(excluded, []))
+        results = pipe.execute()
+        if excluded:
+            ids = reduce(set.intersection, results[:-1]) - results[-1]
+        else:
+            ids = reduce(set.intersection, results)
+        ids = sorted(ids, key=int)
+        if num is not None:
+            ids = ids[start:start + num]
+        return ids
+
+    def _read_count(self, db):
+        """
+        Returns the number of objects of the collection counted by Redis
+        without storing any key, so that a replica can answer, or None if
+        the lookups need more than the intersection of set indices.
+        """
+        if self._exclusions or self._limit is not None:
+            return None
+        lookups = self._read_lookup_keys()
+        if lookups is None:
+            return None
+        keys, _ = lookups
+        if [] in keys:
+            return 0
+        if [k for k in keys if len(k) > 1]:
+            return None
+        keys = [k[0] for k in keys]
+        if not keys:
+            return db.scard(self.key)
+        if len(keys) == 1:
+            return db.scard(keys[0])
+        if not _has_intercard(db):
+            return None
+        return db.execute_command('SINTERCARD', len(keys), *keys)
+
+    def _read_lookup_keys(self):
+        """
+        Returns the set index keys of the filters, a list of keys to
+        intersect the unions of, and of the exclusions, or None if a
+        lookup cannot be read without temporary keys.
+        """
+        if (self._zfilters or self._qfilters or self._qexclusions or
+                self._search):
+            return None
+        filters = dict(self._filters)
+        keys = [[k] for k in self._build_keys_from_compound_indices(filters)]
+        for lookup, value in filters.iteritems():
+            keys.append(self._read_index_keys(lookup, value))
+        excluded = []
+        for lookup, value in self._exclusions.iteritems():
+            excluded.append(self._read_index_keys(lookup, value))
+        if None in keys or None in excluded:
+            return None
+        return keys, excluded
+
+    def _read_index_keys(self, lookup, value):
+        """
+        Returns the set index keys of an equality or ``__in`` lookup, or
+        None if the lookup needs a temporary key.
+        """
+        field, op = lookup, None
+        if lookup.endswith('__in'):
+            field, op = lookup[:-len('__in')], 'in'
+        if (field not in self.model_class._indices or
+                field in self.model_class._bitmap_indices or
+                isinstance(self.model_class._attributes.get(field), GeoField)):
+            return None
+        if op == 'in':
+            return [self._build_key_from_filter_item(field, v) for v in value]
+        return [self._build_key_from_filter_item(field, value)]
+
+    def _read_sorted_ids(self, db, start, num):
+        """
+        Returns all the ids ordered with ``SORT_RO``, which replicas
+        accept, or None if the ordering or the server does not allow it.
+        """
+        field, alpha = self._ordering[0]
+        fname = field.lstrip('-')
+        if fname in self.model_class._lex_indices:
+            return None
+        args = [self.key, 'BY', "%s->%s" % (self.model_class._key['*'],
+                                            fname)]
+        if num is not None:
+            args.extend(['LIMIT', start, num])
+        if field.startswith('-'):
+            args.append('DESC')
+        if alpha:
+            args.append('ALPHA')
+        try:
+            return db.execute_command('SORT_RO', *args)
+        except ResponseError:
+            # Redis older than 7.0
+            return None
+
+    def _build_set(self):
+        """
+        Applies the lookups and returns the (unordered) Set of the
+        matching ids.
+        """
+        # For performance reasons, only one zfilter is allowed.
+        s = Set(self.key, db=self.db)
         if self._zfilters:
             s = self._add_zfilters(s)
-        if self._filters:
+        if self._filters or self._qfilters:
             s = self._add_set_filter(s)
-        if self._exclusions:
+        if self._exclusions or self._qexclusions:
             s = self._add_set_exclusions(s)
-        n = self._order(s.key)
-        self._cached_set = n
-        return self._cached_set
+        if self._search:
+            s = self._add_search(s)
+        return s
 
     def _add_set_filter(self, s):
         """
@@ -303,24 +915,100 @@ class ModelSet(Set):
         It simply creates a new "intersection" of indexed keys (the filter) and
         the previous filtered keys (if any).
 
+        ``__in`` lookups and ``Q`` objects are first resolved into temporary
+        sets in the same pipeline that fetches the cardinalities used by
+        ``_plan_intersection``.
+
         .. Note:: This function uses the ``Set`` container class.
 
         :return: the new Set
         """
-        indices = []
-        for k, v in self._filters.iteritems():
-            index = self._build_key_from_filter_item(k, v)
-            if k not in self.model_class._indices:
-                raise AttributeNotIndexed(
-                        "Attribute %s is not indexed in %s class." %
-                        (k, self.model_class.__name__))
-            indices.append(index)
-        new_set_key = "~%s.%s" % ("+".join([self.key] + indices), id(self))
-        s.intersection(new_set_key, *[Set(n, db=self.db) for n in indices])
+        pipe = self.db.pipeline(transaction=False)
+        filters = dict(self._filters)
+        indices = self._build_keys_from_compound_indices(filters)
+        for k, v in filters.iteritems():
+            indices.append(self._union_keys(
+                self._build_keys_from_lookup(k, v, pipe), pipe))
+        for q in self._qfilters:
+            indices.append(self._build_key_from_q(q, pipe))
+        new_set_key = self._temporary_key(
+                "~%s" % "+".join([self.key] + indices))
+        keys = self._plan_intersection(s, indices, pipe)
+        if keys is None:
+            # One of the sets is empty, so is the intersection.
+            return Set(new_set_key, db=self.db)
+        if len(keys) == 1:
+            # Nothing to intersect with, read the index directly.
+            return Set(keys[0], db=self.db)
+        Set(keys[0], db=self.db).intersection(new_set_key,
+                *[Set(n, db=self.db) for n in keys[1:]])
         new_set = Set(new_set_key, db=self.db)
         new_set.set_expire()
         return new_set
 
+    def _plan_intersection(self, s, indices, pipe):
+        """
+        Returns the keys that have to be intersected to apply the filters,
+        smallest set first, or None if one of them is empty.
+
+        The cardinalities are fetched with the commands already queued in
+        ``pipe``. Every index set is a subset of ``Model:all`` so the latter
+        is only kept if ``s`` has already been narrowed (by a zfilter for
+        instance).
+        """
+        keys = list(indices)
+        if s.key != self.key:
+            keys.append(s.key)
+        for k in keys:
+            pipe.scard(k)
+        results = pipe.execute()
+        cards = results[len(results) - len(keys):]
+        if not all(cards):
+            return None
+        return [k for c, k in sorted(zip(cards, keys))]
+
+    def _add_search(self, s):
+        """
+        Combines the word indices of the searched terms into a sorted
+        set scored by the number of occurrences, restricted to the
+        members of ``s``.
+
+        .. Note:: The result is a sorted set, not a set.
+
+        :return: the new SortedSet
+        """
+        terms, operator = self._search
+        pipe = self.db.pipeline(transaction=False)
+        keys = []
+        tokens = self._search_tokens()
+        for token in sorted(tokens):
+            keys.append(self._zunion_keys(
+                [self.model_class._fulltext_index_key(field, token)
+                 for field in self.model_class._fulltext_indices], pipe))
+        new_set_key = self._temporary_key("~%s.search(%s)" % (
+            s.key, ("&" if operator == 'and' else "|").join(sorted(tokens))))
+        if operator == 'or' and keys:
+            keys = [self._zunion_keys(keys, pipe)]
+        if keys:
+            weights = dict((k, 1) for k in keys)
+            weights[s.key] = 0
+            pipe.zinterstore(new_set_key, weights)
+        else:
+            pipe.delete(new_set_key)
+        pipe.expire(new_set_key, redisco.default_expire_time)
+        if self._is_temporary_key(s.key):
+            pipe.expire(s.key, redisco.default_expire_time)
+        pipe.execute()
+        return SortedSet(new_set_key, db=self.db)
+
+    def _search_tokens(self):
+        """Returns the set of the words of the searched terms."""
+        tokens = set()
+        for field in self.model_class._fulltext_indices:
+            tokens.update(self.model_class._attributes[field].tokenize(
+                self._search[0]))
+        return tokens
+
     def _add_set_exclusions(self, s):
         """
         This function is the internals of the `filter` function.
@@ -331,20 +1019,183 @@ class ModelSet(Set):
 
         :return: the new Set
         """
+        pipe = self.db.pipeline(transaction=False)
         indices = []
         for k, v in self._exclusions.iteritems():
-            index = self._build_key_from_filter_item(k, v)
-            if k not in self.model_class._indices:
-                raise AttributeNotIndexed(
-                        "Attribute %s is not indexed in %s class." %
-                        (k, self.model_class.__name__))
-            indices.append(index)
-        new_set_key = "~%s.%s" % ("-".join([self.key] + indices), id(self))
+            indices.extend(self._build_keys_from_lookup(k, v, pipe))
+        for q in self._qexclusions:
+            indices.append(self._build_key_from_q(q, pipe))
+        if len(pipe):
+            pipe.execute()
+        new_set_key = self._temporary_key(
+                "~%s" % "-".join([self.key] + indices))
         s.difference(new_set_key, *[Set(n, db=self.db) for n in indices])
         new_set = Set(new_set_key, db=self.db)
         new_set.set_expire()
         return new_set
 
+    def _build_keys_from_lookup(self, lookup, value, pipe):
+        """
+        Returns the index keys matched by a lookup such as ``name`` or
+        ``name__in``. The latter matches any of the keys.
+
+        Lookups on the lexicographic index are queued in ``pipe``.
+        """
+        field, op = lookup, None
+        if '__' in lookup:
+            f, o = lookup.rsplit('__', 1)
+            if o in self.LOOKUPS:
+                field, op = f, o
+        if op in self.LEX_LOOKUPS:
+            return [self._build_key_from_lex_lookup(field, op, value, pipe)]
+        if op in self.GEO_LOOKUPS:
+            return [self._build_key_from_geo_lookup(field, op, value, pipe)]
+        if field not in self.model_class._indices:
+            raise AttributeNotIndexed(
+                    "Attribute %s is not indexed in %s class." %
+                    (field, self.model_class.__name__))
+        if op == 'in':
+            keys = [self._build_key_from_filter_item(field, v) for v in value]
+        else:
+            keys = [self._build_key_from_filter_item(field, value)]
+        if field in self.model_class._bitmap_indices:
+            return [self._materialize_bitmaps(keys, pipe)]
+        return keys
+
+    def _materialize_bitmaps(self, keys, pipe):
+        """
+        Queues the conversion of the union of the bitmap indices ``keys``
+        into a temporary set of ids so it can take part in the set
+        operations, and returns the key of that set.
+        """
+        source = keys[0]
+        if len(keys) > 1:
+            source = self._temporary_key("~(%s)" % "|".join(keys))
+            pipe.bitop('OR', source, *keys)
+            pipe.expire(source, redisco.default_expire_time)
+        new_set_key = self._temporary_key("~%s.ids" % source)
+        BITMAPSTORE(pipe, keys=[source, new_set_key],
+                    args=[redisco.default_expire_time])
+        return new_set_key
+
+    def _build_key_from_lex_lookup(self, field, op, value, pipe):
+        """
+        Queues the range query on the lexicographic index of ``field``
+        and returns the key of the set that will hold the matching ids.
+        """
+        if field not in self.model_class._lex_indices:
+            raise AttributeNotIndexed(
+                    "Attribute %s is not lex indexed in %s class." %
+                    (field, self.model_class.__name__))
+        value = self.model_class._attributes[field].typecast_for_storage(value)
+        value = value.encode('utf-8')
+        # Members are "<value>\x00<id>": \x00\xff sorts after all the
+        # members of a value and before any longer value.
+        if op == 'startswith':
+            min, max = '[' + value, '[' + value + '\xff'
+        elif op == 'lt':
+            min, max = '-', '(' + value
+        elif op == 'lte':
+            min, max = '-', '[' + value + '\x00\xff'
+        elif op == 'gt':
+            min, max = '(' + value + '\x00\xff', '+'
+        else:
+            min, max = '[' + value, '+'
+        new_set_key = self._temporary_key("~%s:%s:%s" % (
+            self.model_class._lex_index_key(field), op,
+            value.decode('utf-8')))
+        LEXRANGESTORE(pipe, keys=[self.model_class._lex_index_key(field),
+                                  new_set_key],
+                      args=[min, max, redisco.default_expire_time])
+        return new_set_key
+
+    def _build_key_from_geo_lookup(self, field, op, value, pipe):
+        """
+        Queues the ``GEOSEARCH`` on the GEO index of ``field`` and returns
+        the key of the set that will hold the matching ids.
+        """
+        descriptor = self.model_class._attributes.get(field)
+        if (not isinstance(descriptor, GeoField) or
+                field not in self.model_class._indices):
+            raise AttributeNotIndexed(
+                    "Attribute %s is not a geo indexed field in %s class." %
+                    (field, self.model_class.__name__))
+        if op == 'near':
+            lat, lon, radius = value
+            shape = ['BYRADIUS', radius, 'km']
+        else:
+            lat, lon, width, height = value
+            shape = ['BYBOX', width, height, 'km']
+        new_set_key = self._temporary_key("~%s:%s:%s" % (
+            self.model_class._key[field], op,
+            ",".join(str(v) for v in value)))
+        GEOSEARCHSETSTORE(pipe, keys=[self.model_class._key[field],
+                                      new_set_key],
+                          args=[redisco.default_expire_time, 'FROMLONLAT',
+                                lon, lat] + shape)
+        return new_set_key
+
+    def _build_keys_from_compound_indices(self, filters):
+        """
+        Returns the keys of the compound indices covering equality
+        lookups of ``filters``, the widest first. The covered lookups are
+        removed from ``filters`` so each of them is read from one set
+        only.
+        """
+        keys = []
+        for fields in sorted(self.model_class._compound_indices,
+                             key=len, reverse=True):
+            if all(f in filters for f in fields):
+                values = [filters.pop(f) for f in fields]
+                keys.append(self.model_class._compound_index_key(fields,
+                                                                 values))
+        return keys
+
+    def _build_key_from_q(self, q, pipe):
+        """
+        Queues the commands that resolve ``q`` into a single set and
+        returns its key.
+        """
+        keys = []
+        for child in q.children:
+            if isinstance(child, Q):
+                keys.append(self._build_key_from_q(child, pipe))
+            else:
+                keys.append(self._union_keys(
+                    self._build_keys_from_lookup(child[0], child[1], pipe),
+                    pipe))
+        if q.connector == Q.OR:
+            return self._union_keys(keys, pipe)
+        if len(keys) == 1:
+            return keys[0]
+        new_set_key = self._temporary_key("~(%s)" % "&".join(keys))
+        pipe.sinterstore(new_set_key, keys)
+        pipe.expire(new_set_key, redisco.default_expire_time)
+        return new_set_key
+
+    def _union_keys(self, keys, pipe):
+        """
+        Queues the union of ``keys`` and returns the key holding it.
+        """
+        if len(keys) == 1:
+            return keys[0]
+        new_set_key = self._temporary_key("~(%s)" % "|".join(keys))
+        if keys:
+            pipe.sunionstore(new_set_key, keys)
+            pipe.expire(new_set_key, redisco.default_expire_time)
+        return new_set_key
+
+    def _zunion_keys(self, keys, pipe):
+        """
+        Same as ``_union_keys`` for sorted sets: the scores of the keys
+        are summed by ``ZUNIONSTORE``.
+        """
+        if len(keys) == 1:
+            return keys[0]
+        new_set_key = self._temporary_key("~(%s)" % "|".join(keys))
+        pipe.zunionstore(new_set_key, keys)
+        pipe.expire(new_set_key, redisco.default_expire_time)
+        return new_set_key
     def _add_zfilters(self, s):
         """
         This function is the internals of the zfilter function.
@@ -363,8 +1214,10 @@ class ModelSet(Set):
         desc = self.model_class._attributes[att]
         zset = SortedSet(index, db=self.db)
         limit, offset = self._get_limit_and_offset()
-        new_set_key = "~%s.%s" % ("+".join([self.key, att, op]), id(self))
-        new_set_key_temp = "#%s.%s" % ("+".join([self.key, att, op]), id(self))
+        new_set_key = self._temporary_key(
+                "~%s" % "+".join([self.key, att, op]))
+        new_set_key_temp = self._temporary_key(
+                "#%s" % "+".join([self.key, att, op]))
         members = []
         if isinstance(v, (tuple, list,)):
             min, max = v
@@ -385,13 +1238,13 @@ class ModelSet(Set):
         elif op == 'in':
             members = zset.between(min, max, limit, offset)
 
-        temp_set = Set(new_set_key_temp)
+        temp_set = Set(new_set_key_temp, db=self.db)
         if members:
             temp_set.add(*members)
         temp_set.set_expire()
 
         s.intersection(new_set_key, temp_set)
-        new_set = Set(new_set_key)
+        new_set = Set(new_set_key, db=self.db)
         new_set.set_expire()
         return new_set
 
@@ -421,41 +1274,395 @@ class ModelSet(Set):
             else:
                 desc = False
             new_set_key = "%s#%s.%s" % (old_set_key, ordering, id(self))
-            by = "%s->%s" % (self.model_class._key['*'], ordering)
-            self.db.sort(old_set_key,
-                         by=by,
-                         store=new_set_key,
-                         alpha=alpha,
-                         start=start,
-                         num=num,
-                         desc=desc)
-            if old_set_key != self.key:
+            if ordering in self.model_class._lex_indices:
+                self._lex_sort(old_set_key, ordering, new_set_key,
+                               desc, start, num)
+            else:
+                by = "%s->%s" % (self.model_class._key['*'], ordering)
+                self.db.sort(old_set_key,
+                             by=by,
+                             store=new_set_key,
+                             alpha=alpha,
+                             start=start,
+                             num=num,
+                             desc=desc)
+            if self._is_temporary_key(old_set_key):
                 Set(old_set_key, db=self.db).set_expire()
             new_list = List(new_set_key, db=self.db)
-            new_list.set_expire()
+            new_list.set_expire(self._expire_time)
             return new_list
 
+    def _lex_sort(self, skey, field, new_key, desc, start, num):
+        """
+        Stores in ``new_key`` the ids of ``skey`` ordered by walking the
+        lexicographic index of ``field`` instead of sorting the strings.
+
+        The walk goes through the whole index, so a filtered set holding
+        less than ``1 / LEX_SORT_RATIO`` of it is sorted with ``SORT``
+        instead.
+        """
+        if skey != self.key:
+            pipe = self.db.pipeline(transaction=False)
+            if self._search:
+                pipe.zcard(skey)
+            else:
+                pipe.scard(skey)
+            pipe.zcard(self.model_class._lex_index_key(field))
+            card, total = pipe.execute()
+            if card * self.LEX_SORT_RATIO < total:
+                self.db.sort(skey,
+                             by="%s->%s" % (self.model_class._key['*'], field),
+                             store=new_key,
+                             alpha=True,
+                             start=start,
+                             num=num,
+                             desc=desc)
+                return
+        LEXSORTSTORE(self.db,
+                     keys=[self.model_class._lex_index_key(field), skey,
+                           new_key],
+                     args=[int(desc), start or 0,
+                           -1 if num is None else num,
+                           redisco.default_expire_time,
+                           int(skey != self.key)])
+
     def _set_without_ordering(self, skey):
         """
         Final call for "non-ordered" looked up.
         We order by id anyway and this is done by redis (same as above).
+        The results of a search are ordered by decreasing score instead.
 
         :returns: A Set of `id`
         """
-        # sort by id
         num, start = self._get_limit_and_offset()
         old_set_key = skey
         new_set_key = "%s#.%s" % (old_set_key, id(self))
-        self.db.sort(old_set_key,
-                     store=new_set_key,
-                     start=start,
-                     num=num)
-        if old_set_key != self.key:
+        if self._search:
+            # keep the order of the sorted set
+            self.db.sort(old_set_key,
+                         by='nosort',
+                         store=new_set_key,
+                         start=start,
+                         num=num,
+                         desc=True)
+        else:
+            # sort by id
+            self.db.sort(old_set_key,
+                         store=new_set_key,
+                         start=start,
+                         num=num)
+        if self._is_temporary_key(old_set_key):
             Set(old_set_key, db=self.db).set_expire()
         new_list = List(new_set_key, db=self.db)
-        new_list.set_expire()
+        new_list.set_expire(self._expire_time)
         return new_list
 
+    def _bitmap_lookups(self):
+        """
+        Returns the bitmap keys of the filters and of the exclusions when
+        every lookup of the collection can be answered by the bitmap
+        indices, None otherwise.
+        """
+        if (not self._filters or self._zfilters or self._qfilters or
+                self._qexclusions or self._search or
+                self._limit is not None or self._offset):
+            return None
+        lookups = []
+        for lookups_dict in (self._filters, self._exclusions):
+            keys = []
+            for lookup, value in lookups_dict.iteritems():
+                field, op = lookup, None
+                if lookup.endswith('__in'):
+                    field, op = lookup[:-len('__in')], 'in'
+                if field not in self.model_class._bitmap_indices:
+                    return None
+                if op == 'in':
+                    keys.append([self._build_key_from_filter_item(field, v)
+                                 for v in value])
+                else:
+                    keys.append([self._build_key_from_filter_item(field,
+                                                                  value)])
+            lookups.append(keys)
+        return lookups
+
+    def _bitmap_count(self, filters, exclusions):
+        """
+        Counts the ids set in all the ``filters`` bitmaps and in none of
+        the ``exclusions`` bitmaps. Each filter is a list of keys whose
+        union is taken.
+        """
+        pipe = self.db.pipeline(transaction=False)
+        temp = []
+
+        def union(keys):
+            if len(keys) == 1:
+                return keys[0]
+            key = "~(%s).%s" % ("|".join(keys), id(self))
+            pipe.bitop('OR', key, *keys)
+            temp.append(key)
+            return key
+
+        keys = [union(k) for k in filters]
+        result = "~(%s).%s" % ("&".join(keys), id(self))
+        pipe.bitop('AND', result, *keys)
+        temp.append(result)
+        if exclusions:
+            excluded = union(sum(exclusions, []))
+            # A AND NOT B == A XOR (A AND B), which also holds when B is
+            # shorter than A.
+            both = "~(%s&%s).%s" % (result, excluded, id(self))
+            pipe.bitop('AND', both, result, excluded)
+            pipe.bitop('XOR', result, result, both)
+            temp.append(both)
+        pipe.bitcount(result)
+        n = len(pipe) - 1
+        pipe.delete(*temp)
+        return pipe.execute()[n]
+
+    def _typecast_values(self, field, values):
+        """
+        Typecasts the values of the registry of an attribute.
+        """
+        desc = self.model_class._attributes.get(field)
+        if desc:
+            return [desc.typecast_for_read(v) for v in values]
+        return values
+
+    def _zindex_key(self, field):
+        """
+        Returns the key of the sorted set index of a numeric attribute.
+        """
+        desc = self.model_class._attributes.get(field)
+        if (not isinstance(desc, ZINDEXABLE) or
+                field not in self.model_class._indices):
+            raise AttributeNotIndexed(
+                    "Attribute %s is not a numeric index of %s class." %
+                    (field, self.model_class.__name__))
+        return self.model_class._key[field]
+
+    def _zindex_for_set(self, zkey, s, pipe):
+        """
+        Queues the restriction of the sorted set index ``zkey`` to the
+        members of ``s`` and returns the key holding the result.
+        Set members weigh 0 so the scores are kept.
+        """
+        if self._is_temporary_key(s.key):
+            pipe.expire(s.key, redisco.default_expire_time)
+        elif s.key == self.key:
+            return zkey
+        new_key = "~%s&%s.%s" % (zkey, s.key, id(self))
+        pipe.zinterstore(new_key, {zkey: 1, s.key: 0})
+        return new_key
+
+    def _delete_ids(self, ids):
+        """
+        Deletes the objects ``ids``, a list or a List, by chunks.
+
+        :returns: the number of objects that existed.
+        """
+        deleted = 0
+        for start in xrange(0, len(ids), self.BULK_CHUNK_SIZE):
+            deleted += self._delete_chunk(
+                    ids[start:start + self.BULK_CHUNK_SIZE])
+        return deleted
+
+    def _delete_chunk(self, ids):
+        """
+        Deletes the objects ``ids`` with two pipelines: one reading the
+        bookkeeping of their indices, one removing them.
+        """
+        instances = []
+        pipe = self.db.pipeline(transaction=False)
+        for id in ids:
+            instance = self.model_class()
+            instance._id = str(id)
+            instance._fetch_indices(pipe)
+            instances.append(instance)
+        results = iter(pipe.execute())
+        n = 3 if self.model_class._lex_indices else 2
+
+        registries = set()
+        pipe = self.db.pipeline()
+        for instance in instances:
+            fetched = [next(results) for i in range(n)]
+            instance._remove_from_indices(pipe, *fetched,
+                                          registries=registries)
+            pipe.delete(instance.key())
+        for registry in registries:
+            pipe.zremrangebyscore(registry, '-inf', 0)
+        position = len(pipe)
+        pipe.srem(self.model_class._key['all'], *[i.id for i in instances])
+        deleted = pipe.execute()[position]
+        self.model_class._forget_shards([i.id for i in instances])
+        return deleted
+
+    def _update_chunk(self, ids, values):
+        """
+        Sets ``values`` on the objects ``ids`` and moves them between the
+        indices affected by the change.
+        """
+        model_class = self.model_class
+        changed = set(values)
+        indices = [att for att in model_class._indices
+                   if att not in model_class._lists and
+                   (att in changed or att not in model_class._attributes)]
+        compounds = [fields for fields in model_class._compound_indices
+                     if changed & set(fields)]
+        lex = [att for att in model_class._lex_indices if att in changed]
+        fulltext = [att for att in model_class._fulltext_indices
+                    if att in changed]
+        needed = set(changed)
+        for fields in compounds:
+            needed.update(fields)
+        if len(indices) > len(changed & set(indices)):
+            # indices on methods or properties may use any attribute
+            needed.update(model_class._attributes)
+        attributes = sorted(needed)
+
+        pipe = self.db.pipeline(transaction=False)
+        for id in ids:
+            pipe.hmget(model_class._key[id], attributes)
+        current = pipe.execute()
+
+        storage = {}
+        for att, value in values.iteritems():
+            if value is not None:
+                descriptor = model_class._attributes[att]
+                storage[att] = descriptor.typecast_for_storage(value)
+
+        registries = set()
+        pipe = self.db.pipeline()
+        for id, stored in zip(ids, current):
+            old = _instance(model_class, id, attributes, stored)
+            new = _instance(model_class, id, attributes, stored)
+            for att, value in values.iteritems():
+                model_class._attributes[att].__set__(new, value)
+            key = model_class._key[id]
+            if storage:
+                pipe.hmset(key, storage)
+            for att in changed - set(storage):
+                pipe.hdel(key, att)
+            for att in indices:
+                self._move_in_index(pipe, att, old, new, registries)
+            for fields in compounds:
+                self._move_in_compound_index(pipe, fields, old, new)
+            for att in lex:
+                value = getattr(old, att)
+                if value is None:
+                    value = u''
+                else:
+                    value = old.attributes[att].typecast_for_storage(value)
+                pipe.zrem(model_class._lex_index_key(att),
+                          u"%s\x00%s" % (value, id))
+                new._add_to_lex_index(att, pipeline=pipe)
+            for att in fulltext:
+                descriptor = model_class._attributes[att]
+                tokens = set(descriptor.tokenize(getattr(new, att)))
+                for token in set(descriptor.tokenize(getattr(old, att))):
+                    if token not in tokens:
+                        zindex = model_class._fulltext_index_key(att, token)
+                        pipe.zrem(zindex, id)
+                        pipe.srem(key['_zindices'], zindex)
+                new._add_to_fulltext_index(att, pipeline=pipe)
+        for registry in registries:
+            pipe.zremrangebyscore(registry, '-inf', 0)
+        pipe.execute()
+        return len(ids)
+
+    def _move_in_index(self, pipe, att, old, new, registries):
+        """
+        Queues the move of the object from the index of ``att`` for its
+        old value to the one for its new value.
+        """
+        model_class = self.model_class
+        id = new.id
+        bookkeeping = new.key()['_indices']
+        bitmap = att in model_class._bitmap_indices
+        old_index = old._index_key_for(att)
+        new_index = new._index_key_for(att)
+        old_keys = (_index_keys(old_index) if old_index else None) or set()
+        new_keys = (_index_keys(new_index) if new_index else None) or set()
+        for index in old_keys - new_keys:
+            if bitmap:
+                pipe.setbit(index, int(id), 0)
+            else:
+                pipe.srem(index, id)
+            pipe.srem(bookkeeping, index)
+            pipe.zincrby(model_class._values_key(att),
+                         model_class._value_from_index_key(att, index), -1)
+            registries.add(model_class._values_key(att))
+        for index in new_keys - old_keys:
+            if bitmap:
+                pipe.setbit(index, int(id), 1)
+            else:
+                pipe.sadd(index, id)
+            pipe.sadd(bookkeeping, index)
+            pipe.zincrby(model_class._values_key(att),
+                         model_class._value_from_index_key(att, index), 1)
+        # the sorted set of the attribute does not depend on the value
+        if new_index and new_index[0] == 'sortedset':
+            descriptor = model_class._attributes[att]
+            pipe.zadd(new_index[1][0], id,
+                      descriptor.typecast_for_storage(getattr(new, att)))
+            pipe.sadd(new.key()['_zindices'], new_index[1][0])
+        elif new_index and new_index[0] == 'geo':
+            lat, lon = getattr(new, att)
+            pipe.execute_command('GEOADD', new_index[1], lon, lat, id)
+            pipe.sadd(new.key()['_zindices'], new_index[1])
+        elif old_index and old_index[0] in ('sortedset', 'geo'):
+            zindex = model_class._key[att]
+            pipe.zrem(zindex, id)
+            pipe.srem(new.key()['_zindices'], zindex)
+
+    def _move_in_compound_index(self, pipe, fields, old, new):
+        """
+        Queues the move of the object between the compound indices of
+        ``fields`` for its old and new values.
+        """
+        keys = []
+        for instance in (old, new):
+            values = [getattr(instance, att) for att in fields]
+            values = [v() if callable(v) else v for v in values]
+            keys.append(None if None in values else
+                        self.model_class._compound_index_key(fields, values))
+        old_key, new_key = keys
+        if old_key == new_key:
+            return
+        if old_key:
+            pipe.srem(old_key, new.id)
+            pipe.srem(new.key()['_indices'], old_key)
+        if new_key:
+            pipe.sadd(new_key, new.id)
+            pipe.sadd(new.key()['_indices'], new_key)
+
+    def _temporary_key(self, name):
+        """
+        Returns the key of an intermediate result of the lookup named
+        ``name``. The key is remembered so it can be deleted by
+        ``_delete_temporary_keys`` once the lookup is done.
+        """
+        key = "%s.%s" % (name, id(self))
+        self._temporary_keys.add(key)
+        return key
+
+    def _delete_temporary_keys(self, pipe=None):
+        """
+        Deletes, or queues in ``pipe`` the deletion of, the intermediate
+        keys created so far. They expire anyway if this is turned off
+        with ``DELETE_TEMPORARY_KEYS``.
+        """
+        if not self.DELETE_TEMPORARY_KEYS or not self._temporary_keys:
+            return
+        (pipe or self.db).delete(*self._temporary_keys)
+        self._temporary_keys = set()
+
+    def _is_temporary_key(self, key):
+        """
+        Returns True if the key has been created by the lookup. Index keys
+        can also end up being sorted and should never be expired.
+        """
+        return key.startswith('~')
+
     def _get_limit_and_offset(self):
         """
         Return the limit and offset of the looked up ids.
@@ -478,6 +1685,25 @@ class ModelSet(Set):
         instance.id = str(id)
         return instance
 
+    def _get_items_with_ids(self, ids):
+        """
+        Fetches the objects ``ids`` with a single pipeline and returns the
+        instances, in the same order.
+        """
+        ids = [str(id) for id in ids]
+        if not ids:
+            return []
+        pipe = self._read_db.pipeline(transaction=False)
+        for id in ids:
+            pipe.hgetall(self.model_class._key[id])
+        instances = []
+        for id, stored_attrs in zip(ids, pipe.execute()):
+            instance = self.model_class()
+            instance._id = id
+            instance._load(stored_attrs)
+            instances.append(instance)
+        return instances
+
     def _build_key_from_filter_item(self, index, value):
         """
         Build the keys from the filter so we can fetch the good keys
@@ -491,7 +1717,7 @@ class ModelSet(Set):
             value = desc.typecast_for_storage(value)
         return self.model_class._key[index][value]
 
-    def _clone(self):
+    def _clone(self, klass=None):
         """
         This function allows the chaining of lookup calls.
         Example:
@@ -499,16 +1725,256 @@ class ModelSet(Set):
 
         :returns: a modelset instance with all the previous filters.
         """
-        klass = self.__class__
+        klass = klass or self.__class__
         c = klass(self.model_class)
+        c._db = self._db
         if self._filters:
-            c._filters = self._filters
+            c._filters = dict(self._filters)
         if self._exclusions:
-            c._exclusions = self._exclusions
+            c._exclusions = dict(self._exclusions)
+        c._qfilters = list(self._qfilters)
+        c._qexclusions = list(self._qexclusions)
         if self._zfilters:
             c._zfilters = self._zfilters
         if self._ordering:
             c._ordering = self._ordering
+        c._search = self._search
+        c._use_primary = self._use_primary
         c._limit = self._limit
         c._offset = self._offset
+        c._expire_time = self._expire_time
         return c
+
+
+class ShardedModelSet(ModelSet):
+    """
+    Collection of a model spread over several Redis instances with
+    ``Meta.shards``. The lookups run on every shard and their ids are
+    merged: by id, or by the values of the first ordering field, which
+    are read from the hashes of the objects. The limit and the offset
+    apply to the merged ids, each shard returning at most
+    ``offset + limit`` of them. The objects are read from their shard.
+
+    The counts and the aggregations add up the results of the shards.
+    The results of a search without ordering are merged by relevance.
+
+    The collection has no database of its own: ``db`` raises a TypeError,
+    only the collections of the shards talk to Redis.
+    """
+    def __init__(self, model_class):
+        super(ShardedModelSet, self).__init__(model_class)
+        self._db = None
+        self._shard_of = {}
+
+    @property
+    def db(self):
+        raise TypeError("%s is sharded, its collections have no single "
+                        "database." % self.model_class.__name__)
+
+    _read_db = db
+
+    def get_by_id(self, id):
+        db = self.model_class._find_shard(id)
+        if db is None:
+            return None
+        with self._on_shard(db) as collection:
+            instance = collection.get_by_id(id)
+        if instance is not None:
+            instance._shard = db
+        return instance
+
+    def release(self):
+        if hasattr(self, '_cached_set'):
+            del self._cached_set
+        self._shard_of = {}
+
+    def delete(self):
+        deleted = sum(self._gather('delete'))
+        self.release()
+        return deleted
+
+    def update(self, **kwargs):
+        if self.model_class._meta['shard_key'] in kwargs:
+            raise ValueError("%s is the shard key of %s and cannot be "
+                             "updated." % (self.model_class._meta['shard_key'],
+                                           self.model_class.__name__))
+        updated = sum(self._gather('update', **kwargs))
+        self.release()
+        return updated
+
+    def count(self):
+        if hasattr(self, '_cached_set') or self._limit is not None:
+            return len(self._set)
+        return sum(self._gather('count'))
+
+    def histogram(self, field, buckets):
+        results = self._gather('histogram', field, buckets)
+        return [(low, high, sum(r[i][2] for r in results))
+                for i, (low, high, _) in enumerate(results[0])]
+
+    def count_by(self, field):
+        counts = {}
+        for result in self._gather('count_by', field):
+            for value, count in result.iteritems():
+                counts[value] = counts.get(value, 0) + count
+        return counts
+
+    def distinct(self, field):
+        return sorted(set(sum(self._gather('distinct', field), [])))
+
+    @property
+    def _set(self):
+        """
+        The merged ids of the lookups on the shards.
+        """
+        if hasattr(self, '_cached_set'):
+            return self._cached_set
+        num, start = self._get_limit_and_offset()
+        entries = []
+        for collection in self._shard_sets():
+            with collection:
+                ids = list(collection._set)
+            for id, key in zip(ids, self._sort_keys(collection.db, ids)):
+                self._shard_of[id] = collection.db
+                entries.append((key, id))
+        if self._ordering:
+            desc = self._ordering[0][0].startswith('-')
+        else:
+            # the best matches of a search come first
+            desc = bool(self._search)
+        entries.sort(reverse=desc)
+        ids = [id for key, id in entries]
+        if num is not None:
+            ids = ids[start:start + num]
+        self._cached_set = ids
+        return ids
+
+    def _sort_keys(self, db, ids):
+        """
+        Returns the keys the ids of the shard ``db`` are merged by: the
+        value of the first ordering field, or the score of the search,
+        then the id.
+        """
+        if not self._ordering and self._search:
+            return self._search_scores(db, ids)
+        if not self._ordering:
+            return [int(id) for id in ids]
+        field, alpha = self._ordering[0]
+        pipe = db.pipeline(transaction=False)
+        for id in ids:
+            pipe.hget(self.model_class._key[id], field.lstrip('-'))
+        keys = []
+        for id, value in zip(ids, pipe.execute()):
+            if alpha:
+                value = value or ''
+            else:
+                # SORT counts a missing value as 0
+                value = float(value or 0)
+            keys.append((value, int(id)))
+        return keys
+
+    def _search_scores(self, db, ids):
+        """
+        Returns the scores of the search of the ids of the shard ``db``:
+        the sum of their scores in the word indices of the searched
+        terms, as ``_add_search`` computes them.
+        """
+        model_class = self.model_class
+        keys = [model_class._fulltext_index_key(field, token)
+                for token in self._search_tokens()
+                for field in model_class._fulltext_indices]
+        pipe = db.pipeline(transaction=False)
+        for id in ids:
+            for key in keys:
+                pipe.zscore(key, id)
+        scores = iter(pipe.execute())
+        return [(sum(next(scores) or 0 for key in keys), int(id))
+                for id in ids]
+
+    def _shard_sets(self):
+        """
+        Returns the collection restricted to each shard, limited to the
+        ids the merge may need.
+        """
+        num, start = self._get_limit_and_offset()
+        collections = []
+        for db in self.model_class._shards:
+            collection = self._on_shard(db)
+            if num is not None:
+                collection._limit, collection._offset = (start or 0) + num, 0
+            collections.append(collection)
+        return collections
+
+    def _on_shard(self, db):
+        """Returns the collection restricted to the shard ``db``."""
+        collection = self._clone(ModelSet)
+        collection._db = db
+        collection._use_primary = True
+        return collection
+
+    def _gather(self, method, *args, **kwargs):
+        """
+        Calls ``method`` on the collection of every shard and returns the
+        list of the results.
+        """
+        results = []
+        for db in self.model_class._shards:
+            with self._on_shard(db) as collection:
+                results.append(getattr(collection, method)(*args, **kwargs))
+        return results
+
+    def _stats(self, fields):
+        stats = dict((f, {'count': 0, 'sum': 0.0, 'min': None, 'max': None})
+                     for f in fields)
+        for result in self._gather('_stats', fields):
+            for field, s in result.iteritems():
+                merged = stats[field]
+                merged['count'] += s['count']
+                merged['sum'] += s['sum']
+                for k, pick in (('min', min), ('max', max)):
+                    if s[k] is not None:
+                        merged[k] = s[k] if merged[k] is None else \
+                                pick(merged[k], s[k])
+        return stats
+
+    def _delete_ids(self, ids):
+        groups = {}
+        ids = list(ids)
+        for pk, db in zip(ids, self.model_class._find_shards(ids)):
+            if db is not None:
+                groups.setdefault(id(db), (db, []))[1].append(pk)
+        return sum(self._on_shard(db)._delete_ids(group)
+                   for db, group in groups.values())
+
+    def _get_item_with_id(self, id):
+        return self._get_items_with_ids([id])[0]
+
+    def _get_items_with_ids(self, ids):
+        """
+        Fetches the objects ``ids`` with a pipeline on each of their
+        shards and returns the instances, in the same order.
+        """
+        ids = [str(pk) for pk in ids]
+        shards, groups = {}, {}
+        unknown = [pk for pk in ids if pk not in self._shard_of]
+        found = dict(zip(unknown, self.model_class._find_shards(unknown)))
+        for pk in ids:
+            db = self._shard_of.get(pk) or found[pk]
+            if db is None:
+                db = self.model_class._shards.nodes[0]
+            shards[pk] = db
+            groups.setdefault(id(db), (db, []))[1].append(pk)
+        stored = {}
+        for db, group in groups.values():
+            pipe = db.pipeline(transaction=False)
+            for pk in group:
+                pipe.hgetall(self.model_class._key[pk])
+            stored.update(zip(group, pipe.execute()))
+        instances = []
+        for pk in ids:
+            instance = self.model_class()
+            instance._id = pk
+            instance._shard = shards[pk]
+            instance._load(stored[pk])
+            instances.append(instance)
+        return instances
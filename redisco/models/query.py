@@ -0,0 +1,51 @@
+"""
+Composable lookups for the ModelSet.
+"""
+
+
+class Q(object):
+    """
+    Encapsulates lookups so that they can be combined with ``|`` (OR)
+    and ``&`` (AND) before being handed to ``ModelSet.filter`` or
+    ``ModelSet.exclude``.
+
+    The whole expression is resolved by Redis with ``SUNIONSTORE`` and
+    ``SINTERSTORE`` over the index sets.
+
+    >>> from redisco import models
+    >>> class Foo(models.Model):
+    ...     name = models.Attribute()
+    ...     status = models.Attribute()
+    ...
+    >>> Foo(name="Einstein", status="dead").save()
+    True
+    >>> Foo(name="Edison", status="alive").save()
+    True
+    >>> len(Foo.objects.filter(models.Q(name="Einstein") | models.Q(status="alive")))
+    2
+    >>> [f.delete() for f in Foo.objects.all()] # doctest: +ELLIPSIS
+    [...]
+    """
+    AND = 'AND'
+    OR = 'OR'
+
+    def __init__(self, **kwargs):
+        self.connector = self.AND
+        self.children = sorted(kwargs.items())
+
+    def _combine(self, other, connector):
+        if not isinstance(other, Q):
+            raise TypeError("Can only combine a Q with another Q.")
+        q = Q()
+        q.connector = connector
+        q.children = [self, other]
+        return q
+
+    def __or__(self, other):
+        return self._combine(other, self.OR)
+
+    def __and__(self, other):
+        return self._combine(other, self.AND)
+
+    def __repr__(self):
+        return "<Q %s: %s>" % (self.connector, self.children)
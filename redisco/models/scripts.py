@@ -0,0 +1,156 @@
+"""
+Lua scripts run server side by the query engine.
+"""
+import redisco
+
+
+class LuaScript(object):
+    """
+    Wraps a Lua script so it is registered once and can then be run on
+    any client or pipeline. Redis loads it again if it does not know the
+    script yet.
+    """
+    def __init__(self, source):
+        self.source = source
+        self._script = None
+
+    def __call__(self, client, keys=[], args=[]):
+        if self._script is None:
+            self._script = redisco.get_client().register_script(self.source)
+        return self._script(keys=keys, args=args, client=client)
+
+
+# Returns the cardinality, the sum, the minimum and the maximum of the
+# scores of a sorted set. The set is walked ARGV[1] members at a time.
+ZSTATS = LuaScript("""
+local count = redis.call('ZCARD', KEYS[1])
+if count == 0 then
+    return {0}
+end
+local chunk = tonumber(ARGV[1])
+local sum = 0
+local start = 0
+while start < count do
+    local page = redis.call('ZRANGE', KEYS[1], start, start + chunk - 1,
+                            'WITHSCORES')
+    for i = 2, #page, 2 do
+        sum = sum + tonumber(page[i])
+    end
+    start = start + chunk
+end
+local first = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+local last = redis.call('ZRANGE', KEYS[1], -1, -1, 'WITHSCORES')
+return {count, string.format('%.17g', sum), first[2], last[2]}
+""")
+
+
+# Stores in the set KEYS[2] the ids of the members of the lexicographic
+# index KEYS[1] between ARGV[1] and ARGV[2]. The set expires after ARGV[3]
+# seconds.
+LEXRANGESTORE = LuaScript("""
+local members = redis.call('ZRANGEBYLEX', KEYS[1], ARGV[1], ARGV[2])
+local ids = {}
+for _, member in ipairs(members) do
+    ids[#ids + 1] = string.match(member, '%z([^%z]*)$')
+    if #ids == 1000 then
+        redis.call('SADD', KEYS[2], unpack(ids))
+        ids = {}
+    end
+end
+if #ids > 0 then
+    redis.call('SADD', KEYS[2], unpack(ids))
+end
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+return #members
+""")
+
+# Walks the lexicographic index KEYS[1] in order (reversed if ARGV[1] is
+# 1) and pushes to the list KEYS[3] the ids that are members of the set or
+# sorted set KEYS[2], unless ARGV[5] is 0 in which case every id is kept. The first
+# ARGV[2] ids are skipped and at most ARGV[3] ids are pushed (all of them
+# if negative). The list expires after ARGV[4] seconds.
+LEXSORTSTORE = LuaScript("""
+local total = redis.call('ZCARD', KEYS[1])
+local command = 'ZRANGE'
+if ARGV[1] == '1' then
+    command = 'ZREVRANGE'
+end
+local skip = tonumber(ARGV[2])
+local num = tonumber(ARGV[3])
+local pushed = 0
+local pos = 0
+local sorted = redis.call('TYPE', KEYS[2])['ok'] == 'zset'
+redis.call('DEL', KEYS[3])
+while pos < total and num ~= pushed do
+    local page = redis.call(command, KEYS[1], pos, pos + 999)
+    for _, member in ipairs(page) do
+        local id = string.match(member, '%z([^%z]*)$')
+        local member = ARGV[5] == '0'
+        if not member and sorted then
+            member = redis.call('ZSCORE', KEYS[2], id) ~= false
+        elseif not member then
+            member = redis.call('SISMEMBER', KEYS[2], id) == 1
+        end
+        if member then
+            if skip > 0 then
+                skip = skip - 1
+            else
+                redis.call('RPUSH', KEYS[3], id)
+                pushed = pushed + 1
+                if pushed == num then
+                    break
+                end
+            end
+        end
+    end
+    pos = pos + 1000
+end
+redis.call('EXPIRE', KEYS[3], ARGV[4])
+return pushed
+""")
+
+# Stores in the set KEYS[2] the offsets of the bits set in the bitmap
+# KEYS[1], ie: the ids of a bitmap index. The set expires after ARGV[1]
+# seconds.
+BITMAPSTORE = LuaScript("""
+local length = redis.call('STRLEN', KEYS[1])
+local ids = {}
+for offset = 0, length - 1, 4096 do
+    local chunk = redis.call('GETRANGE', KEYS[1], offset, offset + 4095)
+    for i = 1, #chunk do
+        local byte = string.byte(chunk, i)
+        if byte ~= 0 then
+            for b = 0, 7 do
+                if bit.band(byte, bit.rshift(128, b)) ~= 0 then
+                    ids[#ids + 1] = (offset + i - 1) * 8 + b
+                end
+            end
+        end
+        if #ids >= 1000 then
+            redis.call('SADD', KEYS[2], unpack(ids))
+            ids = {}
+        end
+    end
+end
+if #ids > 0 then
+    redis.call('SADD', KEYS[2], unpack(ids))
+end
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+return redis.call('SCARD', KEYS[2])
+""")
+
+# Stores in the set KEYS[2] the members of the GEO sorted set KEYS[1]
+# found by GEOSEARCH with the arguments following ARGV[1]. The set expires
+# after ARGV[1] seconds.
+GEOSEARCHSETSTORE = LuaScript("""
+local search = {}
+for i = 2, #ARGV do
+    search[#search + 1] = ARGV[i]
+end
+local members = redis.call('GEOSEARCH', KEYS[1], unpack(search))
+for i = 1, #members, 1000 do
+    redis.call('SADD', KEYS[2], unpack(members, i, math.min(i + 999, #members)))
+end
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+return #members
+""")
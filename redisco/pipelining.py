@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+"""
+Auto-pipelining and batches: the commands issued within
+``redisco.autopipeline()`` or ``redisco.batch()`` are buffered and sent to
+Redis in one pipeline.
+"""
+
+__all__ = ['AutoPipeline', 'Batch', 'LazyResult', 'PendingResult',
+           'pipelined', 'resolve']
+
+
+class PendingResult(Exception):
+    """Raised when the result of a batch is used before its execution."""
+
+
+# Commands whose result is rarely looked at. They are buffered and return
+# a LazyResult. Any other command flushes the buffer, runs in the same
+# round trip and returns its value. The commands returning a value the
+# caller needs, like INCR, the pops or SETNX, are not buffered: a
+# LazyResult would fail the ``is None`` tests on their result.
+WRITE_COMMANDS = frozenset([
+    'append', 'delete', 'expire', 'expireat', 'geoadd', 'hdel', 'hmset',
+    'hset', 'linsert', 'lpush', 'lpushx', 'lrem', 'lset', 'ltrim', 'mset',
+    'persist', 'pexpire', 'pexpireat', 'psetex', 'rename', 'rpush',
+    'rpushx', 'sadd', 'sdiffstore', 'set', 'setbit', 'setex', 'setrange',
+    'sinterstore', 'srem', 'sunionstore', 'zadd', 'zinterstore', 'zrem',
+    'zremrangebylex', 'zremrangebyrank', 'zremrangebyscore', 'zunionstore',
+])
+
+# Methods of the client that are not commands. They flush the buffer and
+# are called on the client itself.
+CLIENT_METHODS = frozenset([
+    'lock', 'pipeline', 'pubsub', 'register_script', 'transaction',
+])
+
+
+class LazyResult(object):
+    """
+    Result of a command buffered by an AutoPipeline. The buffer is flushed
+    the first time the result is used, and the result then behaves like
+    its value. ``resolve`` returns the value itself, for the ``is`` and
+    ``isinstance`` tests.
+    """
+    __slots__ = ('_compute', '_value', '_resolved')
+
+    def __init__(self, compute):
+        self._compute = compute
+        self._resolved = False
+
+    def resolve(self):
+        if not self._resolved:
+            self._value = self._compute()
+            self._resolved = True
+            self._compute = None
+        return self._value
+
+    def __getattr__(self, name):
+        return getattr(self.resolve(), name)
+
+    def __repr__(self):
+        return repr(self.resolve())
+
+    def __str__(self):
+        return str(self.resolve())
+
+    def __unicode__(self):
+        return unicode(self.resolve())
+
+    def __nonzero__(self):
+        return bool(self.resolve())
+
+    def __int__(self):
+        return int(self.resolve())
+
+    def __long__(self):
+        return long(self.resolve())
+
+    def __float__(self):
+        return float(self.resolve())
+
+    def __index__(self):
+        return self.resolve().__index__()
+
+    def __hash__(self):
+        return hash(self.resolve())
+
+    def __len__(self):
+        return len(self.resolve())
+
+    def __iter__(self):
+        return iter(self.resolve())
+
+    def __contains__(self, item):
+        return item in self.resolve()
+
+    def __getitem__(self, key):
+        return self.resolve()[key]
+
+    def __eq__(self, other):
+        return self.resolve() == resolve(other)
+
+    def __ne__(self, other):
+        return self.resolve() != resolve(other)
+
+    def __lt__(self, other):
+        return self.resolve() < resolve(other)
+
+    def __le__(self, other):
+        return self.resolve() <= resolve(other)
+
+    def __gt__(self, other):
+        return self.resolve() > resolve(other)
+
+    def __ge__(self, other):
+        return self.resolve() >= resolve(other)
+
+    def __add__(self, other):
+        return self.resolve() + resolve(other)
+
+    def __radd__(self, other):
+        return resolve(other) + self.resolve()
+
+    def __sub__(self, other):
+        return self.resolve() - resolve(other)
+
+    def __rsub__(self, other):
+        return resolve(other) - self.resolve()
+
+    def __mul__(self, other):
+        return self.resolve() * resolve(other)
+
+    def __rmul__(self, other):
+        return resolve(other) * self.resolve()
+
+    def __div__(self, other):
+        return self.resolve() / resolve(other)
+
+    def __rdiv__(self, other):
+        return resolve(other) / self.resolve()
+
+    def __truediv__(self, other):
+        return self.resolve() / resolve(other)
+
+    def __rtruediv__(self, other):
+        return resolve(other) / self.resolve()
+
+    def __neg__(self):
+        return -self.resolve()
+
+
+def resolve(value):
+    """Returns the value of a LazyResult, any other value as is."""
+    if isinstance(value, LazyResult):
+        return value.resolve()
+    return value
+
+
+class AutoPipeline(object):
+    """
+    Stands for a Redis client and buffers its write commands in a
+    pipeline. The buffer is sent when a result is needed: when a
+    LazyResult is used, when another command is issued (it is sent in the
+    same round trip) and when ``flush`` is called, which
+    ``redisco.autopipeline()`` does on exit.
+
+    Once closed, it hands every call to the client.
+    """
+    transaction = False
+
+    def __init__(self, client):
+        self.client = client
+        self.closed = False
+        self._pipe = None
+        self._slots = []
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if self.closed or not callable(attr) or name.startswith('_'):
+            return attr
+        if name in WRITE_COMMANDS:
+            def command(*args, **kwargs):
+                return self.defer(name, *args, **kwargs)
+        elif name in CLIENT_METHODS or name.endswith('_iter'):
+            def command(*args, **kwargs):
+                self.flush()
+                return attr(*args, **kwargs)
+        else:
+            def command(*args, **kwargs):
+                result = self.defer(name, *args, **kwargs)
+                self.flush()
+                return result.resolve()
+        return command
+
+    def __len__(self):
+        if self._pipe is None:
+            return 0
+        return len(self._pipe)
+
+    def _pipeline(self):
+        if self._pipe is None:
+            self._pipe = self.client.pipeline(transaction=self.transaction)
+        return self._pipe
+
+    def defer(self, name, *args, **kwargs):
+        """
+        Buffers the command ``name`` and returns its LazyResult.
+        """
+        if self.closed:
+            value = getattr(self.client, name)(*args, **kwargs)
+            return LazyResult(lambda: value)
+        pipe = self._pipeline()
+        # the position of the result in the replies of the pipeline
+        slot = [False, None, len(pipe)]
+        getattr(pipe, name)(*args, **kwargs)
+        self._slots.append(slot)
+        return LazyResult(lambda: self._result(slot))
+
+    def _result(self, slot):
+        if not slot[0]:
+            self.flush()
+        if isinstance(slot[1], Exception):
+            raise slot[1]
+        return slot[1]
+
+    def flush(self):
+        """
+        Sends the buffered commands. Raises the first error of the
+        commands, after all of them have been run.
+        """
+        if self._pipe is None:
+            return
+        pipe, slots = self._pipe, self._slots
+        self._pipe, self._slots = None, []
+        if not len(pipe):
+            return
+        results = pipe.execute(raise_on_error=False)
+        for slot in slots:
+            slot[0], slot[1] = True, results[slot[2]]
+        for value in results:
+            if isinstance(value, Exception):
+                raise value
+
+    def close(self):
+        self.flush()
+        self.closed = True
+
+
+class Batch(AutoPipeline):
+    """
+    Shared transaction of ``redisco.batch()``. Every command is queued,
+    the reads included, and the transaction is executed when the block
+    ends. The LazyResult of a command raises PendingResult if it is used
+    before that.
+
+    The pipelines returned by ``pipeline`` queue their commands in the
+    transaction too, and their ``execute`` does nothing.
+
+    ``indices`` keeps, by object key, the bookkeeping of the indices the
+    objects saved in the batch will have, since Redis does not have it
+    before the execution. The locks given to ``hold`` are released once
+    the transaction is executed or discarded.
+    """
+    transaction = True
+
+    def __init__(self, client):
+        super(Batch, self).__init__(client)
+        self.indices = {}
+        self._locks = {}
+
+    def hold(self, name, lock):
+        """
+        Acquires ``lock``, unless a lock called ``name`` is already held
+        by the batch, and keeps it until the end of the batch.
+        """
+        if name in self._locks:
+            return
+        lock.lock()
+        self._locks[name] = lock
+
+    def _release(self):
+        locks, self._locks = self._locks, {}
+        self.indices = {}
+        for lock in locks.values():
+            lock.unlock()
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if self.closed or not callable(attr) or name.startswith('_'):
+            return attr
+        if name in CLIENT_METHODS or name.endswith('_iter'):
+            return attr
+
+        def command(*args, **kwargs):
+            return self.defer(name, *args, **kwargs)
+        return command
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        if self.closed:
+            return self.client.pipeline(transaction, shard_hint)
+        return _SharedPipeline(self._pipeline())
+
+    def _result(self, slot):
+        if not slot[0]:
+            raise PendingResult("The batch has not been executed yet.")
+        return super(Batch, self)._result(slot)
+
+    def close(self):
+        try:
+            super(Batch, self).close()
+        finally:
+            self._release()
+
+    def discard(self):
+        """Drops the queued commands and closes the batch."""
+        if self._pipe is not None:
+            self._pipe.reset()
+        self._pipe, self._slots = None, []
+        self.closed = True
+        self._release()
+
+
+class _SharedPipeline(object):
+    """A pipeline whose commands are executed with its batch."""
+    def __init__(self, pipe):
+        self._pipe = pipe
+
+    def __getattr__(self, name):
+        return getattr(self._pipe, name)
+
+    def __len__(self):
+        return len(self._pipe)
+
+    def execute(self, raise_on_error=True):
+        return []
+
+
+def pipelined(db, commands, callback):
+    """
+    Runs ``commands``, a list of ``(name, args)`` tuples, in one round
+    trip and returns ``callback(*results)``. Within an autopipeline, the
+    commands are buffered with the others and a LazyResult is returned.
+    """
+    if isinstance(db, AutoPipeline) and not db.closed:
+        results = [db.defer(name, *args) for name, args in commands]
+        return LazyResult(
+            lambda: callback(*[r.resolve() for r in results]))
+    if len(commands) == 1:
+        name, args = commands[0]
+        return callback(getattr(db, name)(*args))
+    pipe = db.pipeline(transaction=False)
+    for name, args in commands:
+        getattr(pipe, name)(*args)
+    return callback(*pipe.execute())
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+Timeouts, retries and circuit breaking of the commands sent to Redis.
+
+A Policy given to ``redisco.connection_setup(policy=...)`` makes the
+clients of redisco:
+
+* give each command the timeout of its name, or the default one;
+* retry the idempotent reads failing with a connection error or a
+  timeout, after a jittered exponential backoff;
+* stop sending commands to a server for ``reset_timeout`` seconds after
+  ``failure_threshold`` consecutive failures, raising CircuitOpenError
+  at once instead of waiting for the connections to time out.
+"""
+import copy
+import random
+import threading
+import time
+
+import redis
+from redis.client import Pipeline
+from redis.exceptions import ConnectionError
+try:
+    from redis.exceptions import TimeoutError
+except ImportError:
+    # redis-py older than 2.10 raises ConnectionError on timeouts
+    TimeoutError = ConnectionError
+
+__all__ = ['Policy', 'CircuitBreaker', 'CircuitOpenError', 'PolicyClient',
+           'READ_COMMANDS']
+
+
+# Commands that can be sent again without changing anything.
+READ_COMMANDS = frozenset([
+    'BITCOUNT', 'DBSIZE', 'EXISTS', 'GEODIST', 'GEOHASH', 'GEOPOS',
+    'GEORADIUS_RO', 'GEORADIUSBYMEMBER_RO', 'GET', 'GETBIT', 'GETRANGE',
+    'HEXISTS', 'HGET', 'HGETALL', 'HKEYS', 'HLEN', 'HMGET', 'HSCAN', 'HVALS',
+    'INFO', 'KEYS', 'LINDEX', 'LLEN', 'LRANGE', 'MGET', 'PING', 'PTTL',
+    'SCAN', 'SCARD', 'SDIFF', 'SINTER', 'SINTERCARD', 'SISMEMBER',
+    'SMEMBERS', 'SORT_RO', 'SRANDMEMBER', 'SSCAN', 'STRLEN', 'SUNION',
+    'TTL', 'TYPE', 'ZCARD', 'ZCOUNT', 'ZINTERCARD', 'ZLEXCOUNT', 'ZRANGE',
+    'ZRANGEBYLEX', 'ZRANGEBYSCORE', 'ZRANK', 'ZREVRANGE', 'ZREVRANGEBYLEX',
+    'ZREVRANGEBYSCORE', 'ZREVRANK', 'ZSCAN', 'ZSCORE',
+])
+
+
+class CircuitOpenError(ConnectionError):
+    """Raised instead of sending a command while the circuit is open."""
+
+
+class CircuitBreaker(object):
+    """
+    Counts the consecutive failures of a server. The circuit opens after
+    ``failure_threshold`` of them: the commands fail at once for
+    ``reset_timeout`` seconds, then a single one is let through and the
+    circuit closes again if it succeeds.
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def before(self):
+        """Raises CircuitOpenError if the command should not be sent."""
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if time.time() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError("Redis is unavailable, retrying in "
+                                       "%.1f seconds." % (self.reset_timeout -
+                                       (time.time() - self.opened_at)))
+            # half-open: the next commands wait for this one
+            self.opened_at = time.time()
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+
+
+class Policy(object):
+    """
+    Settings of the timeouts, retries and circuit breaker.
+
+    ``timeout``
+        the timeout, in seconds, of the commands missing from
+        ``timeouts``. None keeps the ``socket_timeout`` of the connection.
+    ``timeouts``
+        a dict command name => timeout, for instance ``{'BLPOP': None}``.
+    ``retries``
+        how many times a read is sent again after a connection error or
+        a timeout. The writes are never retried.
+    ``backoff`` and ``max_backoff``
+        the wait before the nth retry is picked at random between 0 and
+        ``backoff * 2 ** n`` seconds, at most ``max_backoff``.
+    ``failure_threshold`` and ``reset_timeout``
+        the settings of the CircuitBreaker of each server, None to
+        disable it.
+    """
+    def __init__(self, timeout=None, timeouts=None, retries=2, backoff=0.05,
+                 max_backoff=1.0, failure_threshold=5, reset_timeout=30):
+        self.timeout = timeout
+        self.timeouts = dict((k.upper(), v)
+                             for k, v in (timeouts or {}).iteritems())
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+    def circuit_breaker(self):
+        """Returns a new CircuitBreaker, None if it is disabled."""
+        if self.failure_threshold is None:
+            return None
+        return CircuitBreaker(self.failure_threshold, self.reset_timeout)
+
+    def timeout_of(self, commands):
+        """
+        Returns the timeout of ``commands``, the longest one for a
+        pipeline.
+        """
+        timeouts = [self.timeouts.get(c.upper(), self.timeout)
+                    for c in commands]
+        if None in timeouts:
+            return None
+        return max(timeouts)
+
+    def delay(self, attempt):
+        """Returns the seconds to wait before the retry ``attempt``."""
+        return random.uniform(0, min(self.max_backoff,
+                                     self.backoff * 2 ** attempt))
+
+    def run(self, commands, func, breaker=None):
+        """
+        Returns ``func()``, which sends ``commands``, retrying it if they
+        are all reads.
+        """
+        retry = all(c.upper() in READ_COMMANDS for c in commands)
+        attempt = 0
+        while True:
+            if breaker is not None:
+                breaker.before()
+            try:
+                result = func()
+            except (ConnectionError, TimeoutError):
+                if breaker is not None:
+                    breaker.failure()
+                if not retry or attempt >= self.retries:
+                    raise
+                time.sleep(self.delay(attempt))
+                attempt += 1
+                continue
+            if breaker is not None:
+                breaker.success()
+            return result
+
+
+def _set_timeout(connection, timeout):
+    """
+    Sets the socket timeout of ``connection`` and returns the previous
+    one.
+    """
+    previous = connection.socket_timeout
+    connection.socket_timeout = timeout
+    if connection._sock is not None:
+        connection._sock.settimeout(timeout)
+    return previous
+
+
+class _TimeoutPool(object):
+    """
+    Stands for a connection pool and sets ``timeout`` on the connections
+    it hands out until they are released.
+    """
+    def __init__(self, pool, timeout):
+        self._pool = pool
+        self._timeout = timeout
+        self._previous = {}
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+    def get_connection(self, *args, **kwargs):
+        connection = self._pool.get_connection(*args, **kwargs)
+        self._previous[id(connection)] = _set_timeout(connection,
+                                                      self._timeout)
+        return connection
+
+    def release(self, connection):
+        _set_timeout(connection, self._previous.pop(id(connection)))
+        self._pool.release(connection)
+
+
+class PolicyPipeline(Pipeline):
+    """
+    A pipeline executed according to a Policy: it gets the timeout of its
+    slowest command and is retried if it only holds reads.
+    """
+    policy = None
+    breaker = None
+
+    def reset(self):
+        restore = getattr(self, '_restore_timeout', None)
+        if restore is not None:
+            self._restore_timeout = None
+            _set_timeout(*restore)
+        super(PolicyPipeline, self).reset()
+
+    def execute(self, raise_on_error=True):
+        stack = list(self.command_stack)
+        if self.policy is None or not stack:
+            return super(PolicyPipeline, self).execute(raise_on_error)
+        commands = [args[0] for args, options in stack]
+
+        def execute():
+            # execute empties the stack, even when it fails
+            self.command_stack = list(stack)
+            timeout = self.policy.timeout_of(commands)
+            if timeout is not None and self.connection is None:
+                self.connection = self.connection_pool.get_connection(
+                    'MULTI', self.shard_hint)
+                self._restore_timeout = (
+                    self.connection, _set_timeout(self.connection, timeout))
+            return super(PolicyPipeline, self).execute(raise_on_error)
+        return self.policy.run(commands, execute, self.breaker)
+
+
+class PolicyClient(redis.Redis):
+    """A Redis client sending its commands according to a Policy."""
+    pipeline_class = PolicyPipeline
+
+    def __init__(self, policy, breaker=None, **kwargs):
+        super(PolicyClient, self).__init__(**kwargs)
+        self.policy = policy
+        self.breaker = breaker
+
+    def execute_command(self, *args, **options):
+        if self.policy is None:
+            return super(PolicyClient, self).execute_command(*args, **options)
+        return self.policy.run([args[0]],
+                               lambda: self._execute(*args, **options),
+                               self.breaker)
+
+    def _execute(self, *args, **options):
+        timeout = self.policy.timeout_of([args[0]])
+        client = self
+        if timeout is not None:
+            # the command is sent by redis-py, reconnection included,
+            # through a pool giving its connections the timeout
+            client = copy.copy(self)
+            client.connection_pool = _TimeoutPool(self.connection_pool,
+                                                  timeout)
+        return super(PolicyClient, client).execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = self.pipeline_class(self.connection_pool,
+                                   self.response_callbacks, transaction,
+                                   shard_hint)
+        pipe.policy, pipe.breaker = self.policy, self.breaker
+        return pipe
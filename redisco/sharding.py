@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Client-side sharding: the objects of a model declaring ``Meta.shards``
+are spread over several Redis instances by consistent hashing.
+"""
+import bisect
+import hashlib
+
+__all__ = ['HashRing']
+
+
+class HashRing(object):
+    """
+    Consistent hashing of keys on nodes, the Redis clients of the shards.
+
+    ``nodes`` is a list of clients or a dict name => client. Each node
+    gets ``replicas`` points on the ring, placed from its name: the index
+    of a list or, for a stable placement when shards are added or
+    removed, the key of the dict. Only the keys of the points a new node
+    takes over move to it.
+    """
+    def __init__(self, nodes, replicas=160):
+        if isinstance(nodes, dict):
+            names = sorted(nodes)
+            self.nodes = [nodes[name] for name in names]
+        else:
+            self.nodes = list(nodes)
+            names = [str(i) for i in xrange(len(self.nodes))]
+        if not self.nodes:
+            raise ValueError("A hash ring needs at least one node.")
+        self._names = dict((id(node), unicode(name))
+                           for name, node in zip(names, self.nodes))
+        self._nodes_named = dict((unicode(name), node)
+                                 for name, node in zip(names, self.nodes))
+        self._nodes_at = {}
+        for name, node in zip(names, self.nodes):
+            for i in xrange(replicas):
+                self._nodes_at[self._hash("%s-%d" % (name, i))] = node
+        self._points = sorted(self._nodes_at)
+
+    @staticmethod
+    def _hash(key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+    def get_node(self, key):
+        """Returns the node of ``key``."""
+        i = bisect.bisect(self._points, self._hash(key))
+        return self._nodes_at[self._points[i % len(self._points)]]
+
+    def name_of(self, node):
+        """Returns the name of ``node``."""
+        return self._names[id(node)]
+
+    def node_named(self, name):
+        """Returns the node called ``name``, None if there is none."""
+        if isinstance(name, str):
+            name = name.decode('utf-8')
+        return self._nodes_named.get(unicode(name))
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __iter__(self):
+        return iter(self.nodes)
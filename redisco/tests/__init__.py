@@ -1,15 +1,18 @@
 import os
 import unittest
 from redisco.containerstests import (SetTestCase, ListTestCase, TypedListTestCase, 
-        SortedSetTestCase, HashTestCase)
+        SortedSetTestCase, HashTestCase, ConnectionPoolTestCase, PolicyTestCase,
+        InstrumentationTestCase)
 from redisco.models.basetests import (ModelTestCase, DateFieldTestCase, FloatFieldTestCase,
         BooleanFieldTestCase, ListFieldTestCase, ReferenceFieldTestCase,
         TimeDeltaFieldTestCase, DateTimeFieldTestCase, CounterFieldTestCase,
-        CharFieldTestCase, MutexTestCase)
+        CharFieldTestCase, MutexTestCase, ClusterTestCase)
 
 import redisco
 REDIS_DB = int(os.environ.get('REDIS_DB', 15)) # WARNING TESTS FLUSHDB!!!
 REDIS_PORT = int(os.environ.get('REDIS_PORT', 6379))
+# REDIS_CLUSTER_PORT, a node of a Redis Cluster, enables ClusterTestCase.
+# WARNING THE CLUSTER IS FLUSHED TOO!!!
 redisco.connection_setup(host="localhost", port=REDIS_PORT, db=REDIS_DB)
 
 typed_list_suite = unittest.TestLoader().loadTestsFromTestCase(TypedListTestCase)
@@ -32,4 +35,8 @@ def all_tests():
     suite.addTest(unittest.makeSuite(MutexTestCase))
     suite.addTest(unittest.makeSuite(HashTestCase))
     suite.addTest(unittest.makeSuite(CharFieldTestCase))
+    suite.addTest(unittest.makeSuite(ConnectionPoolTestCase))
+    suite.addTest(unittest.makeSuite(PolicyTestCase))
+    suite.addTest(unittest.makeSuite(InstrumentationTestCase))
+    suite.addTest(unittest.makeSuite(ClusterTestCase))
     return suite